@@ -1,7 +1,13 @@
+import math
+import time
+from bisect import bisect_right
+import numpy as np
 import config
-import RPi.GPIO as GPIO
+from config import GPIO
 
-ScanMode=0
+ScanMode=0 # 0 --> one input channel at a time, read continuously (RDATAC)
+           # 1 --> round-robin scan of several input channels, one conversion at a time (see ADS1256_ScanRead)
+ModeLocked=False # True while another process streams from the ADC (acquisition.AcquisitionEngine): ScanMode cannot change
 # Gains
 ADS1256_GAIN_E = {'ADS1256_GAIN_1' : 0, # GAIN   1
                   'ADS1256_GAIN_2' : 1, # GAIN   2
@@ -31,6 +37,25 @@ ADS1256_DRATE_E = {'ADS1256_30000SPS' : 0xF0, #1111 0000
                    'ADS1256_2d5SPS' : 0x03    #0000 0011
                   }
 
+# Samples per second corresponding to each data rate code
+ADS1256_DRATE_SPS = {0xF0 : 30000, 0xE0 : 15000, 0xD0 : 7500, 0xC0 : 3750, 0xB0 : 2000, 0xA1 : 1000,
+                     0x92 : 500, 0x82 : 100, 0x72 : 60, 0x63 : 50, 0x53 : 30, 0x43 : 25,
+                     0x33 : 15, 0x23 : 10, 0x13 : 5, 0x03 : 2.5,
+                    }
+
+# DRDY WAIT
+# 'poll'   --> busy loop on the DRDY pin (one core at 100%)
+# 'edge'   --> blocks on the falling edge of DRDY (core released, but wake-up costs ~100 us)
+# 'hybrid' --> busy loop for a short time, then blocks on the falling edge. Suited for 15/30 kSPS
+DRDY_MODES = ('poll', 'edge', 'hybrid')
+DRDY_TIMEOUT_PERIODS = 4        # timeout = 4 conversion periods ...
+DRDY_TIMEOUT_MIN_US = 5000      # ... but never less than 5 ms (settling after reset/SYNC)
+DRDY_SPIN_MAX_US = 200          # max busy loop time in hybrid mode
+DRDY_HIST_US = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 100000] # upper edges [us] of the wait time histogram
+
+# BLOCK TIMESTAMPS
+TIMESTAMP_EVERY = 64            # ADS1256_ReadBlock records time.monotonic() when DRDY goes LOW every 64 samples
+
 # REGISTER DEFINITION
 # Registers manage converter activity.
 # They contain all the information about multiplexing management, data rate, calibration, etc.
@@ -48,6 +73,13 @@ REG_E = {'REG_STATUS' : 0,  # x1H
          'REG_FSC2' : 10,   # xxH
         }
 
+# REGISTER SHADOW (see ADS1256_WriteRegs)
+# Bits compared when a written register is read back: STATUS ID and DRDY bits, ADCON bit 7 and IO input bits are read only
+REG_VERIFY_MASK = [0x0E, 0xFF, 0x7F, 0xFF, 0xF0, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF, 0xFF]
+REG_ACAL = 0x04                 # STATUS bit: self calibration after every change of ADCON or DRATE (it rewrites OFC and FSC)
+RREG_T6_US = 7                  # delay between the RREG command and the first data byte (t6 = 50 tCLKIN)
+VERIFY_WRITES = True            # read back and compare the registers after each ADS1256_WriteRegs
+
 # COMMAND DEFINITION
 # Commands control all converter operations.
 # The CS pin must remain LOW while sending commands. 
@@ -80,6 +112,18 @@ class ADS1256:
         self.rst_pin = config.RST_PIN
         self.cs_pin = config.CS_PIN
         self.drdy_pin = config.DRDY_PIN
+        self.raw = bytearray(0) # byte buffer reused by ADS1256_ReadBlock
+        self.timestamps = np.zeros((0, 2)) # [sample index, time.monotonic()] recorded by ADS1256_ReadBlock
+        self.block_timeouts = 0 # DRDY timeouts during the last ADS1256_ReadBlock
+
+        self.drdy_mode = 'hybrid'
+        self.drdy_spin_us = None # None --> min(conversion period, DRDY_SPIN_MAX_US)
+        self.drate = ADS1256_DRATE_E['ADS1256_30000SPS'] # power-up value
+        self.gain = ADS1256_GAIN_E['ADS1256_GAIN_1']
+        self.ch = 0
+        self.initialized = False # True after ADS1256_init, False after a reset
+        self.regs = [None] * len(REG_E) # shadow copy of the registers (None = unknown), see ADS1256_WriteRegs
+        self.ADS1256_ResetDRDYStats()
 
     # Hardware reset
     def ADS1256_reset(self):
@@ -89,6 +133,11 @@ class ADS1256:
         config.digital_write(self.rst_pin, GPIO.LOW) 
         config.delay_ms(200)
         config.digital_write(self.rst_pin, GPIO.HIGH)
+        self.drate = ADS1256_DRATE_E['ADS1256_30000SPS']
+        self.gain = ADS1256_GAIN_E['ADS1256_GAIN_1']
+        self.ch = 0
+        self.initialized = False
+        self.regs = [None] * len(REG_E)
         
     def ADS1256_WriteCmd(self, reg):
         """This function allows the use of commands"""
@@ -102,6 +151,7 @@ class ADS1256:
         config.digital_write(self.cs_pin, GPIO.LOW)#cs  0
         config.spi_writebyte([CMD['CMD_WREG'] | reg, 0x00, data])
         config.digital_write(self.cs_pin, GPIO.HIGH)#cs 1
+        self.ADS1256_UpdateShadow(reg, [data])
 
     def ADS1256_Read_data(self, reg):
         """ This function Takes in input the number of the desired register and reads the corresponding value of length 1 byte """
@@ -113,14 +163,159 @@ class ADS1256:
 
         return data
 
+    def ADS1256_UpdateShadow(self, reg, values):
+        """ It records in the shadow copy the values written from register "reg" on. 
+        With self calibration enabled, a change of ADCON or DRATE rewrites the calibration registers, which become unknown """
+        for i, value in enumerate(values):
+            self.regs[reg + i] = value
+        status = self.regs[REG_E['REG_STATUS']]
+        if (status is None or status & REG_ACAL) and reg <= REG_E['REG_DRATE'] and reg + len(values) > REG_E['REG_ADCON']:
+            self.regs[REG_E['REG_OFC0']:] = [None] * (len(REG_E) - REG_E['REG_OFC0'])
+
+    def ADS1256_Transaction(self, reg, values=None, n=0):
+        """ One SPI transaction (CS LOW for the whole exchange): optional WREG of "values" starting from register "reg", 
+        followed by RREG of n registers starting from "reg". The commands are sent with one xfer2 call, which waits 
+        RREG_T6_US before the end of the transfer, and the n registers are clocked out with a second xfer2 call.
+
+            Output:
+            - list of the n registers read"""
+
+        cmd = []
+        if values:
+            cmd += [CMD['CMD_WREG'] | reg, len(values) - 1] + list(values)
+        if n:
+            cmd += [CMD['CMD_RREG'] | reg, n - 1]
+
+        config.digital_write(self.cs_pin, GPIO.LOW)#cs  0
+        config.spi_xfer(cmd, RREG_T6_US if n else 0)
+        data = config.spi_xfer([0xFF] * n) if n else []
+        config.digital_write(self.cs_pin, GPIO.HIGH)#cs 1
+        return list(data)
+
+    def ADS1256_WriteRegs(self, reg, values, verify=None, force=False):
+        """ This function writes consecutive registers starting from register "reg" with a single WREG command.
+        Registers whose shadow copy (self.regs) already holds the value are not written: 
+        only the range between the first and the last changed register is sent.
+
+            Input:
+            - reg: first register (see REG_E)
+            - values: values of the registers reg, reg+1, ...
+            - verify: read back the written registers in the same transaction and compare them (default: VERIFY_WRITES)
+            - force: write all the registers, ignoring the shadow copy
+
+            Output:
+            - 0: registers written (or already holding the values)
+            -1: readback mismatch (the shadow copy of the mismatching registers is set to unknown)"""
+
+        if verify is None:
+            verify = VERIFY_WRITES
+        values = list(values)
+        changed = [i for i, value in enumerate(values) if force or self.regs[reg + i] != value]
+        if not changed:
+            return 0
+        reg, values = reg + changed[0], values[changed[0]:changed[-1] + 1]
+
+        readback = self.ADS1256_Transaction(reg, values, len(values) if verify else 0)
+        self.ADS1256_UpdateShadow(reg, values)
+        if verify:
+            bad = [reg + i for i, (w, r) in enumerate(zip(values, readback)) if (w ^ r) & REG_VERIFY_MASK[reg + i]]
+            if bad:
+                for i in bad:
+                    self.regs[i] = None
+                print("Register write failed: ", bad)
+                return -1
+        return 0
+
+    def ADS1256_ReadRegs(self, reg, n):
+        """ This function reads n consecutive registers starting from register "reg" in one transaction 
+        and refreshes their shadow copy """
+        data = self.ADS1256_Transaction(reg, n=n)
+        self.regs[reg:reg + n] = data
+        return data
+
+    def ADS1256_SetDRDYMode(self, mode, spin_us=None):
+        """ This function selects how ADS1256_WaitDRDY waits for the DRDY pin (see DRDY_MODES).
+
+        Input:
+        - mode: 'poll', 'edge' or 'hybrid'
+        - spin_us: busy loop time [us] before blocking in 'hybrid' mode. None --> min(conversion period, DRDY_SPIN_MAX_US)"""
+
+        if mode not in DRDY_MODES:
+            raise ValueError("DRDY mode must be one of " + str(DRDY_MODES))
+        self.drdy_mode = mode
+        self.drdy_spin_us = spin_us
+
+    def ADS1256_DRDYTimeout(self):
+        """ Timeout [us] of ADS1256_WaitDRDY for the active data rate """
+        period_us = 1e6 / ADS1256_DRATE_SPS.get(self.drate, 30000)
+        return max(DRDY_TIMEOUT_PERIODS * period_us, DRDY_TIMEOUT_MIN_US)
+
+    def ADS1256_ResetDRDYStats(self):
+        """ Clears the DRDY wait counters """
+        self.drdy_stats = {'waits' : 0,
+                           'timeouts' : 0,
+                           'total_us' : 0.0,
+                           'max_us' : 0.0,
+                           'hist_us' : DRDY_HIST_US,
+                           'hist' : [0]*(len(DRDY_HIST_US)+1), # hist[i] = waits shorter than hist_us[i]; last bin = longer waits
+                          }
+
+    def ADS1256_DRDYStats(self):
+        """ Returns a copy of the DRDY wait counters: number of waits, timeouts, total/max wait time [us] and wait time histogram """
+        stats = dict(self.drdy_stats)
+        stats['hist'] = list(stats['hist'])
+        stats['mean_us'] = stats['total_us'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
     def ADS1256_WaitDRDY(self):
         """It waits for the DRDY pin to go LOW, which indicates that the ADC is ready and the input value can be read.
-        When the input value has been read, the DRDY pin goes HIGH, while the input value is updated."""
-        for i in range(0,400000,1):
-            if(config.digital_read(self.drdy_pin) == 0):
-                break
-        if(i >= 400000):
-            print ("Time Out ...\r\n")
+        When the input value has been read, the DRDY pin goes HIGH, while the input value is updated.
+        
+        The wait is done according to self.drdy_mode (see ADS1256_SetDRDYMode) and it ends after ADS1256_DRDYTimeout() us.
+
+        Output:
+        - 0: DRDY is LOW
+        - -1: Time out"""
+
+        read = config.digital_read
+        pin = self.drdy_pin
+        stats = self.drdy_stats
+        t0 = time.perf_counter()
+
+        if read(pin) != 0:
+            deadline = t0 + self.ADS1256_DRDYTimeout() * 1e-6
+
+            if self.drdy_mode == 'poll':
+                spin_end = deadline
+            elif self.drdy_mode == 'hybrid':
+                spin_us = self.drdy_spin_us
+                if spin_us is None:
+                    spin_us = min(1e6 / ADS1256_DRATE_SPS.get(self.drate, 30000), DRDY_SPIN_MAX_US)
+                spin_end = t0 + spin_us * 1e-6
+            else:
+                spin_end = t0
+
+            now = t0
+            while now < spin_end and read(pin) != 0:
+                now = time.perf_counter()
+
+            if now >= spin_end and now < deadline and read(pin) != 0:
+                # If DRDY falls between the check above and the edge detection setup, the edge is lost:
+                # the level is checked again when wait_for_edge times out
+                GPIO.wait_for_edge(pin, GPIO.FALLING, timeout=max(1, int(math.ceil((deadline - now) * 1000))))
+
+            if read(pin) != 0:
+                stats['timeouts'] += 1
+                print ("Time Out ...\r\n")
+                return -1
+
+        wait_us = (time.perf_counter() - t0) * 1e6
+        stats['waits'] += 1
+        stats['total_us'] += wait_us
+        if wait_us > stats['max_us']:
+            stats['max_us'] = wait_us
+        stats['hist'][bisect_right(DRDY_HIST_US, wait_us)] += 1
+        return 0
 
 
     def ADS1256_init(self,gain,drate,ch):
@@ -153,16 +348,18 @@ class ADS1256:
         
         #Setting of gain, frequency and input channel 
         self.ADS1256_WaitDRDY()
+        self.drate = drate
+        self.gain = gain
+        self.ch = ch
         buf = [0,0,0,0]
         buf[0] = 0x04 
         buf[1] = (ch<<4)|0x08
         buf[2] = 0x01<<5 | gain
         buf[3] = drate
                
-        config.digital_write(self.cs_pin, GPIO.LOW)#cs  0
-        config.spi_writebyte([CMD['CMD_WREG'] | 0x00, 0x03])
         #Starting from register with address 0x00, it writes 4 registers (3+1)
-        config.spi_writebyte(buf)
+        if self.ADS1256_WriteRegs(REG_E['REG_STATUS'], buf, force=True) != 0:
+            return -1
         
         # Which registers am I writing via the buf array?
         # 0x00 Reg Status: 0000 0100 --> enable self calibration
@@ -170,11 +367,200 @@ class ADS1256:
         # 0x02 Reg A/D control register: 0010 0gain --> set clock to f(CLKIN), disable sensor detector and set the gain
         # 0x03 Reg drate: drate --> set the sampling frequency
 
-        config.digital_write(self.cs_pin, GPIO.HIGH)#cs 1
         config.delay_ms(1)
+        self.initialized = True
+
+        return 0
+
+    def ADS1256_SwitchChannel(self, gain, drate, ch):
+        """ Fast reconfiguration between signals: it writes only the MUX register (and ADCON/DRATE if the gain or the 
+        sampling rate change, see ADS1256_WriteRegs) with a single WREG command, then it restarts the conversions with SYNC and WAKEUP.
+        Reset, module initialisation and chip ID check are skipped, so it must be called after ADS1256_init:
+        if the chip has not been initialised yet (or it has been reset) it calls ADS1256_init.
+        If the ADC is in RDATAC mode (e.g. after ADS1256_ReadBlock) the continuous read is stopped first (SDATAC).
+
+            Input: see ADS1256_init
+
+            Output: 
+            - 0: Configuration successful 
+            -1: Error occurred during configuration (ADS1256_init failed or register readback mismatch)"""
+
+        if not self.initialized:
+            if self.ADS1256_init(gain, drate, ch) != 0:
+                return -1
+        else:
+            # register writes are ignored in RDATAC mode: SDATAC, sent when DRDY is LOW (no data being shifted out)
+            self.ADS1256_WaitDRDY()
+            self.ADS1256_WriteCmd(CMD['CMD_SDATAC'])
+            # MUX, ADCON and DRATE are consecutive: unchanged registers are skipped
+            if self.ADS1256_WriteRegs(REG_E['REG_MUX'], [(ch<<4)|0x08, 0x01<<5 | gain, drate]) != 0:
+                return -1
+            self.gain = gain
+            self.drate = drate
+            self.ch = ch
 
+        self.ADS1256_WriteCmd(CMD['CMD_SYNC'])
+        self.ADS1256_WriteCmd(CMD['CMD_WAKEUP'])
         return 0
 
+    def ADS1256_SetMode(self, mode):
+        """ This function selects the scan mode (see ScanMode): 0 = single channel, 1 = round-robin scan.
+        RuntimeError while another process streams from the ADC (ModeLocked, e.g. acquisition.AcquisitionEngine):
+        see vWPV.set_scan_mode, which stops and restarts it """
+        global ScanMode
+        if ModeLocked and mode != ScanMode:
+            raise RuntimeError("Scan mode cannot change while the acquisition process is running (see vWPV.set_scan_mode)")
+        ScanMode = mode
+
+    def ADS1256_ScanRead(self, ch):
+        """ Scan mode: single conversion on input channel ch. 
+        It selects the channel (the MUX register is written only if the channel changes), restarts the conversion 
+        with SYNC and WAKEUP, waits for DRDY (settled data) and reads the result with RDATA.
+        The ADC must be initialised (gain and data rate) and not in RDATAC mode.
+
+            Output:
+            - value [V], nan on DRDY timeout"""
+
+        if self.ch != ch:
+            self.ADS1256_WriteRegs(REG_E['REG_MUX'], [(ch<<4)|0x08], verify=False)
+            self.ch = ch
+        config.digital_write(self.cs_pin, GPIO.LOW)#cs  0
+        config.spi_writebyte([CMD['CMD_SYNC']])
+        config.spi_writebyte([CMD['CMD_WAKEUP']])
+        config.digital_write(self.cs_pin, GPIO.HIGH)#cs 1
+
+        if self.ADS1256_WaitDRDY() != 0:
+            return math.nan
+
+        config.digital_write(self.cs_pin, GPIO.LOW)#cs  0
+        config.spi_xfer([CMD['CMD_RDATA']], RREG_T6_US)
+        buf = config.spi_readbytes(3)
+        config.digital_write(self.cs_pin, GPIO.HIGH)#cs 1
+
+        read = (buf[0]<<16) | (buf[1]<<8) | buf[2]
+        if (read & 0x800000): # negative number
+            read -= 0x1000000
+        return read * 5.0 / 0x7fffff
+
+    def ADS1256_ReadBlock(self, n, out=None, dtype=np.float32):
+        """ This function reads n consecutive samples. The ADC must already be in RDATAC mode with CS LOW (see vWPV.ADC_configuration).
+        The loop only checks DRDY and copies the 3 raw bytes of each sample (one SPI read per conversion: in RDATAC mode
+        each DRDY edge brings one sample); the 24 bit two's complement decoding and the scaling to volts are done 
+        afterwards on the whole block.
+
+        Input:
+        - n: number of samples to be read
+        - out: optional preallocated array of length >= n to be filled (int32 --> raw codes, float --> volts)
+        - dtype: type of the returned array when out is not given (np.int32 --> raw codes, float --> volts)
+
+        Output:
+        - array of n samples (a view on out, if given)
+        
+        The time at which DRDY went LOW is recorded every TIMESTAMP_EVERY samples in self.timestamps (see ADS1256_SampleTimes)."""
+
+        if len(self.raw) < 3*n:
+            self.raw = bytearray(3*n)
+        raw = self.raw
+        wait = self.ADS1256_WaitDRDY
+        read = config.spi_readbytes
+        drdy = config.digital_read
+        pin = self.drdy_pin
+        monotonic = time.monotonic
+        stamps = []
+        stats = self.drdy_stats
+        timeouts = stats['timeouts']
+        waits = stats['waits']
+
+        # a conversion already available (DRDY LOW) is read at once: ADS1256_WaitDRDY (and its statistics) only when DRDY is HIGH
+        for start in range(0, 3*n, 3*TIMESTAMP_EVERY):
+            if drdy(pin) != 0:
+                wait()
+            stamps.append((start//3, monotonic()))
+            raw[start:start+3] = read(3)
+            for i in range(start+3, min(start+3*TIMESTAMP_EVERY, 3*n), 3):
+                if drdy(pin) != 0:
+                    wait()
+                raw[i:i+3] = read(3)
+        self.timestamps = np.array(stamps, dtype=float).reshape(-1, 2)
+        self.block_timeouts = stats['timeouts'] - timeouts
+        ready = n - (stats['waits'] - waits) - self.block_timeouts # samples read without waiting: 0 us waits
+        stats['waits'] += ready
+        stats['hist'][0] += ready
+
+        b = np.frombuffer(raw, dtype=np.uint8, count=3*n).reshape(n, 3).astype(np.int32)
+        codes = (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+        codes = (codes ^ 0x800000) - 0x800000 # sign extension: MSB = 1 --> negative number
+
+        if out is None:
+            out = np.empty(n, dtype=dtype)
+        else:
+            out = out[:n]
+
+        if np.issubdtype(out.dtype, np.integer):
+            out[:] = codes
+        else:
+            np.multiply(codes, 5.0 / 0x7fffff, out=out, casting='unsafe')
+        return out
+
+    def ADS1256_MissedSamples(self):
+        """ This function detects the samples lost during the last ADS1256_ReadBlock (in RDATAC mode a conversion not read
+        before the next one is overwritten). Each timestamp can only be late with respect to the nominal sampling period,
+        so the lower envelope of the timestamp delays (minimum over the following timestamps) only rises when samples are lost.
+
+        Output:
+        - missed: array, samples lost before each timestamp of self.timestamps (cumulative)"""
+
+        fs = ADS1256_DRATE_SPS.get(self.drate, 30000)
+        index, t = self.timestamps[:, 0], self.timestamps[:, 1]
+        if len(t) == 0:
+            return np.zeros(0, dtype=int)
+        floor = np.minimum.accumulate((t - index / fs)[::-1])[::-1]
+        return np.round((floor - floor[0]) * fs).astype(int)
+
+    def ADS1256_SampleTimes(self, n=None):
+        """ This function estimates the acquisition time of the samples of the last ADS1256_ReadBlock.
+        Each timestamp can only be late (scheduling, DRDY wait), so the earliest one with respect to the nominal
+        sampling period gives the time of the first sample. Lost samples (see ADS1256_MissedSamples) shift the following ones.
+
+        Input:
+        - n: number of samples (default: the whole last block)
+
+        Output:
+        - times: time.monotonic() [s] of each sample
+        - t0: time of the first sample [s]"""
+
+        fs = ADS1256_DRATE_SPS.get(self.drate, 30000)
+        index, t = self.timestamps[:, 0], self.timestamps[:, 1]
+        if n is None:
+            n = int(index[-1]) + 1 if len(index) else 0
+        if len(t) == 0:
+            return np.full(n, np.nan), np.nan
+        t0 = np.min(t - index / fs)
+        samples = np.arange(n)
+        missed = self.ADS1256_MissedSamples()[np.maximum(np.searchsorted(index, samples, 'right') - 1, 0)]
+        return t0 + (samples + missed) / fs, t0
+
+    def ADS1256_BlockQuality(self):
+        """ This function reports on the timing of the last ADS1256_ReadBlock.
+
+        Output: dict with
+        - fs_nominal: sampling frequency set in the DRATE register [Hz]
+        - fs_measured: achieved sampling frequency, from the first and last timestamps [Hz]
+        - missed: number of samples lost (the Raspberry Pi fell behind the ADC)
+        - gaps: list of (sample index, samples lost before it)
+        - timeouts: DRDY timeouts"""
+
+        fs = ADS1256_DRATE_SPS.get(self.drate, 30000)
+        index, t = self.timestamps[:, 0], self.timestamps[:, 1]
+        quality = {'fs_nominal' : fs, 'fs_measured' : float(fs), 'missed' : 0, 'gaps' : [], 'timeouts' : self.block_timeouts}
+        if len(t) >= 2 and t[-1] > t[0]:
+            quality['fs_measured'] = float((index[-1] - index[0]) / (t[-1] - t[0]))
+            missed = self.ADS1256_MissedSamples()
+            steps = np.diff(missed)
+            quality['missed'] = int(missed[-1])
+            quality['gaps'] = [(int(index[j+1]), int(steps[j])) for j in np.nonzero(steps > 0)[0]]
+        return quality
+
     
     def ADS1256_ReadChipID(self):
         """Using the status register, this function reads the byte corresponding to the ID.
@@ -0,0 +1,307 @@
+""" Software stand-in for the Waveshare AD/DA board (ADS1256 + RPi.GPIO + spidev).
+
+It is selected by config.py when the environment variable VPWV_BACKEND is set to "sim",
+so that ADS1256new.py and vWPV.py can be imported, profiled and benchmarked on a machine without the Raspberry Pi hardware.
+
+The emulator:
+    - decodes the command bytes sent on the SPI bus (WREG, RREG, RDATA, RDATAC, SDATAC, SYNC, WAKEUP, RESET, ...)
+    - keeps the 11 chip registers (REG_STATUS ... REG_FSC2)
+    - drives the DRDY pin at the data rate written in REG_DRATE
+    - plays back a sample stream (volts) for each input channel selected through REG_MUX
+
+Example:
+    import config
+    config.chip.set_channel(2, doppler_samples)   # doppler_samples: sequence of volts, played back in a loop
+"""
+
+import time
+import threading
+
+# Pin definition (same numbering as config.py)
+RST_PIN = 18
+CS_PIN = 22
+DRDY_PIN = 17
+
+# Command opcodes, see ADS1256new.CMD
+_WAKEUP = 0x00
+_RDATA = 0x01
+_RDATAC = 0x03
+_SDATAC = 0x0F
+_RREG = 0x10
+_WREG = 0x50
+_SYNC = 0xFC
+_STANDBY = 0xFD
+_RESET = 0xFE
+
+# Register values after power-up/reset: ID = 3 in the high nibble of REG_STATUS
+_REG_RESET = [0x31, 0x01, 0x20, 0xF0, 0xE0, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00]
+
+# Data rate register codes -> samples per second, see ADS1256new.ADS1256_DRATE_E
+DRATE_SPS = {0xF0: 30000, 0xE0: 15000, 0xD0: 7500, 0xC0: 3750, 0xB0: 2000,
+             0xA1: 1000, 0x92: 500, 0x82: 100, 0x72: 60, 0x63: 50,
+             0x53: 30, 0x43: 25, 0x33: 15, 0x23: 10, 0x13: 5, 0x03: 2.5}
+
+
+class ADS1256Emulator:
+    def __init__(self, realtime=True):
+        """ Emulated ADS1256 chip.
+
+        INPUT:
+        - realtime: if True, conversions are paced by the wall clock at the configured DRATE,
+                    so a slow reader loses samples exactly as on the real board.
+                    If False, DRDY is always LOW and every read returns the next sample of the stream
+                    (useful to benchmark the processing code as fast as possible).
+        """
+        self.realtime = realtime
+        self.channels = dict()
+        self.lock = threading.RLock()
+        self.rates = dict()
+        self.epoch = time.monotonic()
+        self.pins = {RST_PIN: 1, CS_PIN: 1, DRDY_PIN: 1}
+        self.pin_log = []   # (time.monotonic(), pin, value) for every output write
+        self.reset()
+
+    # --------------------------------- playback ---------------------------------
+
+    def set_channel(self, ch, samples, fs=None):
+        """ Sets the sample stream (volts) played back on input channel ch (0-7).
+        samples can be a sequence, played back in a loop, or a function of the conversion index.
+        If fs [Hz] is given, the stream is played back in time (sample int(t*fs) at the time t of the conversion)
+        instead of one sample per conversion, so that it does not restart when the channel is switched (scan mode)."""
+        self.channels[ch] = samples
+        self.rates[ch] = fs
+
+    def sample(self, index):
+        """ Value (volts) converted by the chip at conversion number index on the selected channel """
+        ch = self.regs[1] >> 4
+        src = self.channels.get(ch, 0.0)
+        if self.rates.get(ch):
+            t = self.t0 + (index + 1) / self.data_rate() if self.realtime else time.monotonic()
+            index = int((t - self.epoch) * self.rates[ch])
+        if callable(src):
+            return float(src(index))
+        if isinstance(src, (int, float)):
+            return float(src)
+        return float(src[index % len(src)])
+
+    def code(self, index):
+        """ 24 bit two's complement output code (bytes, MSB first) for conversion number index """
+        gain = 1 << (self.regs[2] & 0x07)
+        read = int(round(self.sample(index) * gain * 0x7fffff / 5.0))
+        read = max(-0x800000, min(0x7fffff, read)) & 0xffffff
+        return [(read >> 16) & 0xff, (read >> 8) & 0xff, read & 0xff]
+
+    # --------------------------------- timing -----------------------------------
+
+    def data_rate(self):
+        """ Current data rate [SPS] according to REG_DRATE """
+        return DRATE_SPS.get(self.regs[3], 30000)
+
+    def restart_conversions(self):
+        """ Restarts the conversion clock (SYNC/WAKEUP, RESET or MUX/DRATE writes) """
+        self.t0 = time.monotonic()
+        self.last_read = -1
+        self.counter = 0
+
+    def latest(self):
+        """ Index of the last completed conversion (-1 if none) """
+        if not self.realtime:
+            return self.counter
+        return int((time.monotonic() - self.t0) * self.data_rate()) - 1
+
+    def drdy(self):
+        """ Level of the DRDY pin: LOW when a conversion not yet read is available """
+        with self.lock:
+            return 0 if self.latest() > self.last_read else 1
+
+    def time_to_drdy(self):
+        """ Seconds until DRDY goes LOW (0 if already LOW) """
+        with self.lock:
+            if not self.realtime or self.latest() > self.last_read:
+                return 0.0
+            return max(0.0, self.t0 + (self.last_read + 2) / self.data_rate() - time.monotonic())
+
+    def take(self):
+        """ Reads the latest conversion and clears DRDY """
+        index = max(self.latest(), 0)
+        self.last_read = index
+        self.counter = index + 1
+        return self.code(index)
+
+    # ------------------------------- SPI decoding -------------------------------
+
+    def reset(self):
+        """ Reset to power-up values """
+        with self.lock:
+            self.regs = list(_REG_RESET)
+            self.continuous = False
+            self.parser = None   # pending WREG/RREG: [opcode, register, count or None, data]
+            self.out = []
+            self.restart_conversions()
+
+    def write(self, data):
+        """ Decodes the bytes sent by the host """
+        with self.lock:
+            for b in data:
+                self.feed(b & 0xff)
+
+    def feed(self, b):
+        if self.parser is not None:
+            op, reg, count, buf = self.parser
+            if count is None:
+                self.parser[2] = (b & 0x0f) + 1
+                if op == _RREG:
+                    self.out.extend(self.regs[(reg + i) % 11] for i in range(self.parser[2]))
+                    self.parser = None
+                return
+            buf.append(b)
+            if len(buf) == count:
+                for i, value in enumerate(buf):
+                    self.regs[(reg + i) % 11] = value
+                self.parser = None
+                if reg <= 3 < reg + count or reg <= 1 < reg + count:
+                    self.restart_conversions()
+            return
+
+        if self.continuous:
+            # in RDATAC mode only SDATAC and RESET are decoded
+            if b == _SDATAC:
+                self.continuous = False
+            elif b == _RESET:
+                self.reset()
+            return
+
+        if b & 0xf0 == _WREG:
+            self.parser = [_WREG, b & 0x0f, None, []]
+        elif b & 0xf0 == _RREG:
+            self.parser = [_RREG, b & 0x0f, None, []]
+        elif b == _RDATA:
+            self.out.extend(self.take())
+        elif b == _RDATAC:
+            self.continuous = True
+        elif b == _RESET:
+            self.reset()
+        elif b in (_SYNC, _WAKEUP):
+            self.restart_conversions()
+
+    def read(self, n):
+        """ Bytes clocked out by the chip for n SCLK bytes """
+        with self.lock:
+            if not self.out and self.continuous:
+                self.out.extend(self.take())
+            data = self.out[:n]
+            del self.out[:n]
+            return data + [0] * (n - len(data))
+
+    def transfer(self, data):
+        """ Full duplex transfer: pending output bytes are returned while the host clocks dummy bytes """
+        with self.lock:
+            result = []
+            for b in data:
+                if self.out:
+                    result.append(self.out.pop(0))
+                else:
+                    self.feed(b & 0xff)
+                    result.append(0)
+            return result
+
+    # ---------------------------------- pins ------------------------------------
+
+    def pin_write(self, pin, value):
+        with self.lock:
+            value = 1 if value else 0
+            if pin == RST_PIN and value == 0 and self.pins.get(RST_PIN, 1) == 1:
+                self.reset()
+            self.pins[pin] = value
+            self.pin_log.append((time.monotonic(), pin, value))
+
+    def pin_read(self, pin):
+        if pin == DRDY_PIN:
+            return self.drdy()
+        return self.pins.get(pin, 0)
+
+
+class SimSpiDev:
+    """ Stand-in for spidev.SpiDev connected to the emulated chip """
+
+    def __init__(self, chip, bus=0, device=0):
+        self.chip = chip
+        self.bus = bus
+        self.device = device
+        self.max_speed_hz = 2000000
+        self.mode = 0
+
+    def writebytes(self, data):
+        self.chip.write(data)
+
+    def readbytes(self, n):
+        return self.chip.read(n)
+
+    def xfer2(self, data, speed_hz=0, delay_usecs=0, bits_per_word=8):
+        return self.chip.transfer(data)
+
+    def close(self):
+        pass
+
+
+class SimGPIO:
+    """ Stand-in for the RPi.GPIO module driving the pins of the emulated chip """
+
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self, chip):
+        self.chip = chip
+        self.events = dict()
+
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        if initial is not None:
+            self.chip.pin_write(pin, initial)
+
+    def output(self, pin, value):
+        self.chip.pin_write(pin, value)
+
+    def input(self, pin):
+        return self.chip.pin_read(pin)
+
+    def wait_for_edge(self, pin, edge, timeout=None, bouncetime=None):
+        """ Blocks until DRDY goes LOW. timeout in ms as in RPi.GPIO; returns None on timeout """
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000.0
+        while True:
+            wait = self.chip.time_to_drdy() if pin == DRDY_PIN else 0.001
+            if pin == DRDY_PIN and wait == 0.0:
+                return pin
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return None
+                wait = min(wait, left)
+            time.sleep(wait)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.events[pin] = edge
+
+    def remove_event_detect(self, pin):
+        self.events.pop(pin, None)
+
+    def event_detected(self, pin):
+        return pin in self.events and self.chip.pin_read(pin) == 0
+
+    def cleanup(self, pin=None):
+        self.events.clear()
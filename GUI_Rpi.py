@@ -1,135 +1,283 @@
 # This represents the GUI of the program "vPWV.py" to evaluate vPWV.
 # The user starts the GUI, enters the value of delta x and possibly of the delay and starts the main program and the graph. 
-#"vPWV.py" takes the delay as input, and returns the latency value which is calculated from the doppler signal and written to a text file. 
-#To insert a new delay, the program must be paused using the appropriate buttons and restart it later. 
+#"vPWV.py" takes the delay as input, and returns the latency value which is calculated from the doppler signal and written to the session file. 
+#The measurement runs in a background thread (controller.py), so the window stays responsive: 
+#a new delay is used from the next pulse, Pause and Stop abandon the trigger search in progress at once. 
 
 ############################################## GUI_Rpi ############################################
 
-from turtle import delay
-from typing_extensions import IntVar
-from numpy import arange
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
-from matplotlib.figure import Figure
+# matplotlib is imported by the chart classes (Plot2D, WaveformPanel), after delta x has been entered
 import tkinter as tk
-from tkinter import ttk
+import tkinter.messagebox
 import numpy as np
 import time 
 
+import ADS1256new
 import vWPV
+import controller
+import detectors
+import display
+import session
+
+
+# The vPWV chart is redrawn at most every PLOT_REFRESH_MS ms, independently of the measurements (see Plot2D.refresh)
+PLOT_REFRESH_MS = 200
 
 
 class Plot2D(tk.Frame):
     def __init__(self,root,**kwargs):
+        """ vPWV chart. The line is created once and updated with set_data; 
+        only the axes area is redrawn (blitting) unless the x axis limits change """
         
         tk.Frame.__init__(self,root,**kwargs)
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
 
         self.traces=dict()
 
         self.f=Figure(figsize=(5,5), dpi=100)
         self.a=self.f.add_subplot(111)
+        self.a.set_ylim(-0.1,10)
+        self.a.set_xlabel('Time (s)')
+        self.a.set_ylabel('vPWV (m/s)')
+        self.line1, = self.a.plot([], [], "ro-", animated=True) # animated: drawn only by blitting, not by canvas.draw()
 
         self.canvas=FigureCanvasTkAgg(self.f, master=root)
         self.canvas.get_tk_widget().pack(side="top", fill="both", expand=1)
+
+        self.background = None  # axes area without the line, saved at each full redraw
+        self.dirty = False      # new data not drawn yet
+        self.full = True        # full redraw needed (axis limits changed)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.after(PLOT_REFRESH_MS, self.refresh)
+
+    def on_draw(self, event):
+        """ After a full redraw (also on window resize): saves the background and draws the line on it """
+        self.background = self.canvas.copy_from_bbox(self.a.bbox)
+        self.a.draw_artist(self.line1)
         
     # Setting of x and y axes taken as input by "plot.trace()"
     def trace(self,x,y):
-        if len(x)<=1:
-            self.a.set_xlim(x[0]-5,x[0]+5)
-        else:         
-            self.a.set_xlim(x[0]-5,x[-1]+5)   
-        
-        self.a.set_ylim(-0.1,10)
-        self.line1, = self.a.plot(x,y, "ro-")
-        self.a.set_xlabel('Time (s)')
-        self.a.set_ylabel('vPWV (m/s)')
-        self.canvas.draw()
+        """ Sets the data of the line. It is drawn by the next refresh() """
+        self.line1.set_data(list(x), list(y))
+        self.dirty = True
+
+        # the x axis is moved only when the points get out of it, with one window of margin on the right
+        left, right = self.a.get_xlim()
+        if x[0]-5 < left or x[-1]+5 > right:
+            self.a.set_xlim(x[0]-5, x[-1]+5 + max(5, x[-1]-x[0]))
+            self.full = True
+
+    def refresh(self):
+        """ Redraws the chart if there are new data. It calls itself every PLOT_REFRESH_MS ms """
+        if self.dirty:
+            if self.full or self.background is None:
+                self.canvas.draw() # on_draw draws the line
+                self.full = False
+            else:
+                self.canvas.restore_region(self.background)
+                self.a.draw_artist(self.line1)
+                self.canvas.blit(self.a.bbox)
+            self.dirty = False
+        self.after(PLOT_REFRESH_MS, self.refresh)
     
+# Live waveforms: signal code --> (title, sampling frequency [Hz], seconds shown)
+WAVEFORMS = {"R" : ("Breath", 50, 10), "E" : ("ECG", 500, 5), "D" : ("Doppler", 15000, 1)}
+WAVE_REFRESH_MS = 250
+WAVE_DECIMATION = 'minmax' # see display.DECIMATORS
+# The y limits of a waveform change only if the signal gets out of them or if it uses less than WAVE_YFILL of their range
+WAVE_YFILL = 0.25
+
+
+class WaveformPanel(tk.Frame):
+    def __init__(self,root,**kwargs):
+        """ Live breath, ECG and Doppler waveforms, fed by the acquisition thread through vWPV.monitor (see push)
+        or read from the ring buffer of the acquisition process (see attach).
+        Each signal is decimated to about two points per pixel column before being plotted (WAVE_DECIMATION) 
+        and the panel is redrawn at most every WAVE_REFRESH_MS ms, only if new samples arrived.
+        As in Plot2D the lines are animated: the x limits are fixed (the seconds shown), the y limits change rarely 
+        (see WAVE_YFILL), so only the lines of the changed axes are redrawn (blitting) """
+
+        tk.Frame.__init__(self,root,**kwargs)
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+        from matplotlib.figure import Figure
+
+        self.buffers = dict()
+        self.lines = dict()
+        self.counts = dict()
+        self.reader = None
+        self.f=Figure(figsize=(5,4), dpi=100)
+        for i, (code, (title, fs, seconds)) in enumerate(WAVEFORMS.items()):
+            a = self.f.add_subplot(len(WAVEFORMS), 1, i+1)
+            a.set_ylabel(title)
+            a.set_xlim(0, seconds)
+            self.lines[code], = a.plot([], [], "b-", linewidth=0.8, animated=True)
+            self.buffers[code] = display.LiveBuffer(fs, seconds)
+            self.counts[code] = 0
+        self.f.tight_layout()
+
+        self.canvas=FigureCanvasTkAgg(self.f, master=root)
+        self.canvas.get_tk_widget().pack(side="top", fill="both", expand=1)
+
+        self.backgrounds = dict()   # axes areas without the lines, saved at each full redraw
+        self.full = True            # full redraw needed (y limits changed)
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+        self.after(WAVE_REFRESH_MS, self.refresh)
+
+    def on_draw(self, event):
+        """ After a full redraw (also on window resize): saves the backgrounds and draws the lines on them """
+        for code, line in self.lines.items():
+            self.backgrounds[code] = self.canvas.copy_from_bbox(line.axes.bbox)
+            line.axes.draw_artist(line)
+
+    def fit_ylim(self, a, y):
+        """ It changes the y limits of the axes a only if y gets out of them or uses less than WAVE_YFILL of their range.
+        Returns True if they changed """
+        lo, hi = float(np.min(y)), float(np.max(y))
+        bottom, top = a.get_ylim()
+        if bottom <= lo and hi <= top and hi - lo >= WAVE_YFILL * (top - bottom):
+            return False
+        margin = 0.1*(hi - lo) + 1e-6
+        a.set_ylim(lo - margin, hi + margin)
+        return True
+
+    def push(self, code, samples):
+        """ Called by the acquisition thread (vWPV.monitor): it only stores the samples """
+        self.buffers[code].push(samples)
+
+    def attach(self, reader):
+        """ The waveforms are read from the ring buffer of the acquisition process (acquisition.RingReader) at each refresh """
+        self.reader = reader
+
+    def refresh(self):
+        if self.reader is not None:
+            channels = {channel : code for code, (gain, drate, channel) in vWPV.ADC_SETTINGS.items()}
+            for block in self.reader.poll():
+                for ch in np.unique(block['ch']):
+                    self.push(channels[int(ch)], block['value'][block['ch'] == ch])
+        changed = []
+        for code, line in self.lines.items():
+            y, count = self.buffers[code].snapshot()
+            if count == self.counts[code] or len(y) == 0:
+                continue
+            self.counts[code] = count
+            idx, y = display.DECIMATORS[WAVE_DECIMATION](y, line.axes.bbox.width)
+            line.set_data(idx / self.buffers[code].fs, y)
+            if self.fit_ylim(line.axes, y):
+                self.full = True
+            changed.append(code)
+        if changed:
+            if self.full or len(self.backgrounds) < len(self.lines):
+                self.canvas.draw() # on_draw draws the lines
+                self.full = False
+            else:
+                for code in changed:
+                    line = self.lines[code]
+                    self.canvas.restore_region(self.backgrounds[code])
+                    line.axes.draw_artist(line)
+                    self.canvas.blit(line.axes.bbox)
+        self.after(WAVE_REFRESH_MS, self.refresh)
+
         
 def up():
-    """ The up() function cycles by calling itself in order to update the graph.
-    It checks if the pause button has been pressed and then calls the processing script 
-    that outputs a latency value from the doppler signal. This value is used to calculate 
+    """ The up() function cycles by calling itself (root.after) in order to update the GUI.
+    The measurement runs in the background thread of the controller (see controller.py): up() reads the events it posted.
+    Each result carries the latency value computed from the doppler signal. This value is used to calculate 
     the speed, which will be plotted.
     """
+    global count, initializations
     
-    if flag_pause == False:
-        
-        if not len(v): #If v vector is empty (first cycle), initialization phase must be done 
-            global breath_threshold, ecg_threshold, count
-            text1.set("Initialization: ECG and breath monitoring (30 s).")
-            root.update_idletasks()
-            ecg_threshold, ECG = vWPV.initialization()
-            count=0
-
-            #Saving acquired signals 
-            file_ecg = open("ecg"+title1+".txt", "w")
-            file_ecg.write((str(ECG)+"\n"))
-            file_ecg.close()
-        
-        text1.set("Pulse delivery and doppler acquisition.")
-        root.update_idletasks()
-        latency, breath, ECG, doppler = vWPV.measure_loop(delay, ecg_threshold)          
-            
-        text1.set("vWPV vlue computation.")
-        root.update_idletasks()
-        time.sleep(0.5)
+    for event in ctrl.poll():
+        kind = event[0]
+
+        if kind == "state":
+            text1.set(event[1])
+
+        elif kind == "initialized":
+            #Saving acquired signals (-1, -2, ...: one initial ECG monitoring per Start Chart, see session.py)
+            initializations += 1
+            ECG = event[2]
+            session_file.write_signal(-initializations, "E", ECG, vWPV.fs_e, vWPV.ADC_SETTINGS["E"][2])
+            session_file.flush()
+
+        elif kind == "result":
+            latency, breath, ECG, doppler, info = event[1:]
+
+            text1.set("vWPV vlue computation.")
         
-        # Aggiornamento del vettore v sul grafico
-        # Attenzione agli indici: come in "arange", quando si usano i due punti (:), il primo valore
-        # è incluso, mentre l'ultimo è escluso (ricordiamo che i vettori sono composti da 6 valori)
+            # Aggiornamento del vettore v sul grafico
+            # Attenzione agli indici: come in "arange", quando si usano i due punti (:), il primo valore
+            # è incluso, mentre l'ultimo è escluso (ricordiamo che i vettori sono composti da 6 valori)
             
-        v.append(deltax/(latency*100)) 
-        x.append(time.time())
-        count += 1
+            v.append(deltax/(latency*100)) 
+            x.append(time.time())
+            outliers.append(vpwv_filter.push(v[-1])) # 3 std from the mean of the last 20 values
+            count += 1
         
-        #I represent 6 values at a time
-        if len(v)>6:
-            v.pop(0)
-            x.pop(0)                
+            #I represent 6 values at a time
+            if len(v)>6:
+                v.pop(0)
+                x.pop(0)                
+                outliers.pop(0)
  
-        string1 = "vWPV (m/s)"
-        for i in range(0,len(v)):
-            string1 = (string1 + "\n" +str(round(v[i],3)))
+            string1 = "vWPV (m/s)"
+            for i in range(0,len(v)):
+                string1 = (string1 + "\n" +str(round(v[i],3)))
+                if outliers[i]:
+                    string1 = string1 + " (outlier)"
             
-        text_vel.set(string1)       #Writes the updated speed values into text_vel variable which is printed as a column 
-
-        plot.trace(x,v)  
-
-        #Saving acquired signals
-        file_doppler = open("doppler_"+title1+".txt","a") 
-        file_doppler.write((str(doppler)+"\n"))
-        file_doppler.close()
-        
-        file_latency = open("latenze_"+title1+".txt", "a")
-        file_latency.write((str(latency)+"\n"))
-        file_latency.close()
-
-        file_vPWV = open("vPWV"+title1+".txt", "a")
-        file_vPWV.write((str(v[-1])+"\n"))
-        file_vPWV.close()
-
-        file_breath = open("respiratory_"+title1+".txt", "a")
-        file_breath.write((str(breath)+"\n"))
-        file_breath.close()
-
-        file_ecg = open("ecg"+title1+".txt", "a")
-        file_ecg.write((str(ECG)+"\n"))
-        file_ecg.close()
-
-        root.after(1,up)           
+            text_vel.set(string1)       #Writes the updated speed values into text_vel variable which is printed as a column 
+
+            plot.trace(x,v)  
+
+            #Saving acquired signals (measurement index = count-1)
+            for code, signal, fs, missed in (("D", doppler, info['fs'], info['missed']), ("R", breath, vWPV.fs_r, 0), ("E", ECG, vWPV.fs_e, 0)):
+                session_file.write_signal(count-1, code, signal, fs, vWPV.ADC_SETTINGS[code][2],
+                                          trigger_time=info['trigger_time'][1], delay=ctrl.delay, latency=latency, vpwv=v[-1], missed=missed,
+                                          trigger_start=info['trigger_time'][0], doppler_start=info['doppler_start'])
+            session_file.flush()
+
+        elif kind == "paused":
+            text1.set("Paused. Press restar to resume measurament")
+
+        elif kind == "error":
+            print(event[2])
+            text1.set("Error: " + str(event[1]))
+            tk.messagebox.showerror("Error", str(event[1]))
+
+        elif kind == "stopped":
+            text1.set(text1.get() + " Measurement stopped.")
+            buttons[0].config(state="normal") #Start Chart
+            btnscan.config(state="normal")
+            buttons[1].config(state="disabled") #Pause
+            buttons[2].config(state="disabled") #Resume
+            buttons[3].config(state="disabled") #Stop
+            return
+
+    root.after(50,up)           
         
 
 def f_grafico():
-    """ Function called by START CHART button which calls up(), 
-    disables the button and reassigns values to the variables used to create the graph """
+    """ Function called by START CHART button which starts the measurement thread (see controller.py) and up(), 
+    and disables the button """
 
-    global plot, flag_pause
+    global ctrl
     
-    flag_pause = False
+    # the acquisition process only runs in sequential mode: a new scan mode stops and restarts the workers
+    vWPV.set_scan_mode(scan_mode.get())
+    ctrl = controller.MeasurementController(delay/1000)
+    ctrl.start()
+    if vWPV.acquisition_engine is not None:
+        vWPV.monitor = None
+        waves.attach(vWPV.acquisition_engine.reader())
+    else:
+        vWPV.monitor = waves.push
     
     buttons[0].config(state="disabled")   #Start Chart
+    btnscan.config(state="disabled")
     buttons[1].config(state="normal") #Pause
     buttons[2].config(state="disabled") #Resume 
+    buttons[3].config(state="normal") #Stop
   
     up()
     
@@ -141,6 +289,8 @@ def f_invia(event):
         global delay
         delay=stringa.get()
         delay = int(delay)
+        if ctrl is not None:
+            ctrl.set_delay(delay/1000) # from the next pulse
 
         tk.messagebox.showinfo("Dealy", "Delay Updated: "+str(delay)+" ms")
     else:
@@ -152,21 +302,28 @@ def click2():
 
 
 def f_pause():
-    global flag_pause
-    flag_pause = True
+    """ The trigger search in progress is abandoned at once (a pulse already delivered is completed) """
+    ctrl.pause()
     print("Pause")
-    text1.set("Paused. Press restar to resume measurament")
-    root.update_idletasks()
+    text1.set("Pausing...")
     buttons[1].config(state="disabled") #pause
     buttons[2].config(state="normal") #resume 
     
 def f_resume():
-    global flag_pause
-    flag_pause = False
+    ctrl.resume()
     print("Resumed")
     buttons[1].config(state="normal") #pause
     buttons[2].config(state="disabled") #resume  
-    up()
+
+
+def f_stop():
+    """ Stops the measurement: the trigger search in progress is abandoned at once """
+    ctrl.cancel()
+    print("Stop")
+    text1.set("Stopping...")
+    buttons[1].config(state="disabled") #pause
+    buttons[2].config(state="disabled") #resume
+    buttons[3].config(state="disabled") #stop
          
     
 def f_start(event):
@@ -176,11 +333,16 @@ def f_start(event):
     """
     
    # Definizione di alcune variabili, definite globali perchè vengono richiamate anche da altre funzioni     
-    global deltax, frame21, frame24, frame25, text1, text_vel, lbltext, v, x, plot, delay, title1
+    global deltax, frame21, frame24, frame25, text1, text_vel, lbltext, v, x, plot, waves, delay, title1, outliers, vpwv_filter, session_file, count, initializations
+    global scan_mode, btnscan
     
     v=[]  
     x=[]
+    outliers=[]
+    vpwv_filter = detectors.OutlierFilter(w_size=20)
     delay = 0
+    count = 0 # measurement index in the session file
+    initializations = 0 # initial ECG monitorings written to the session file
     
     
     if entrydeltax.get().isdigit() == True:     
@@ -192,6 +354,10 @@ def f_start(event):
         else:
             title1=""
 
+        # Binary session file (see session.py): all the acquired signals, latencies and vPWV values
+        session_file = session.SessionWriter("session_"+title1+".vpwv", {'title' : title1, 'deltax' : deltax})
+        root.protocol("WM_DELETE_WINDOW", f_close)
+
        # Update of GUI aspect
         frame11.destroy()
         frame12.destroy()
@@ -224,10 +390,15 @@ def f_start(event):
         frame22.pack(side="top")
 
         btngrafico = tk.Button(frame22, text="Start Chart", command=f_grafico, font=("", 24,"bold"), height=3, width=15)  # Fa partire il grafico
-        btngrafico.pack(pady=30)
+        btngrafico.pack(pady=30, side="left")
 
         buttons.append(btngrafico)
 
+        # Scan mode (breath and ECG acquired together), applied by Start Chart
+        scan_mode = tk.IntVar(value=ADS1256new.ScanMode)
+        btnscan = tk.Checkbutton(frame22, text="Scan mode", variable=scan_mode, font=("", 18))
+        btnscan.pack(pady=30, side="left", padx=30)
+
         #"Pauese" and "Resume" buttons
         frame23=tk.Frame(root) 
         frame23.pack(side="top")
@@ -240,6 +411,10 @@ def f_start(event):
         btnresume.pack(pady = 10, side="left", padx=30)
         buttons.append(btnresume)
 
+        btnstop=tk.Button(frame23, text="Stop", command=f_stop, font=("",24))
+        btnstop.pack(pady = 10, side="left", padx=30)
+        buttons.append(btnstop)
+
         # String variable to be updated during the various stages of acquisition
         frame24 = tk.Frame(root) 
         frame24.pack(side="top")
@@ -260,11 +435,15 @@ def f_start(event):
 
         # Graph
         plot = Plot2D(root)
+
+        # Live waveforms
+        waves = WaveformPanel(root)
         
         # Buttons state
         buttons[0].config(state="normal") #start chart
         buttons[1].config(state="disabled") #pause
         buttons[2].config(state="disabled") #resume
+        buttons[3].config(state="disabled") #stop
             
     else:    
        tk.messagebox.showerror("Error", "Enter a numerical value")
@@ -276,6 +455,16 @@ def f_start(event):
 ######################################## FINE FUNZIONE START ######################################
 
 
+def f_close():
+    """ Stops the measurement, writes the index of the session file and closes the window """
+    if ctrl is not None:
+        ctrl.cancel()
+        ctrl.join(5)
+    vWPV.stop_workers()
+    session_file.close()
+    root.destroy()
+
+
 def click():
     """ Function called after DeltaX has been entered by the user.
 The function clik() in turn calls f_start(), both when the button is pressed and when the physical enter key is pressed.
@@ -290,8 +479,7 @@ if __name__=="__main__":
         and delta x (cuff-probe length) is asked.
     """
     
-    global flag_pause
-    flag_pause =False   
+    ctrl = None # measurement controller, created by "Start Chart"
     buttons=[]      
  
     root=tk.Tk()
@@ -0,0 +1,354 @@
+""" Acquisition engine: a dedicated process owns the SPI bus and writes the samples into a shared-memory ring buffer.
+
+The timing-critical sampling runs in its own process, so the slow stages of vWPV.py (breath detection, R-wave detection,
+Doppler analysis) and the GUI cannot delay or drop samples. Each sample in the ring carries:
+    - seq: conversion number (since the start of the engine, never reset). It advances by the conversions lost
+           (overwritten by the ADC before being read, see SequenceClock), so a jump in seq reveals a gap in the signal
+    - ch: ADC input channel (7 = breath, 4 = ECG, 2 = Doppler, see vWPV.ADC_SETTINGS)
+    - t: acquisition time, time.monotonic() [s] (see SequenceClock)
+    - value: sample [V]
+
+Consumers read zero-copy views of the ring through a RingReader (the GUI waveforms, see GUI_Rpi.WaveformPanel)
+or a SignalReader, which follows one signal (breath detection, R-wave detection and Doppler analysis, see vWPV.open_signal).
+vWPV.start_workers starts the engine when vWPV.ACQUISITION_PROCESS is True.
+
+Example:
+    engine = AcquisitionEngine()
+    engine.start()
+    reader = engine.open("E")        # starts streaming the ECG
+    ...
+    for block in reader.wait():      # structured views with fields seq, ch, t, value
+        process(block['value'])
+    seq, t, ecg = reader.read(5000)  # copies of the next 5000 samples
+    engine.close()
+"""
+
+import multiprocessing as mp
+import signal
+import time
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import ADS1256new
+import config
+from config import GPIO
+
+# Record of each sample in the ring buffer
+SAMPLE_DTYPE = np.dtype([('seq', '<i8'), ('ch', 'u1'), ('t', '<f8'), ('value', '<f4')])
+
+HEADER_BYTES = 64 # header[0] = number of samples written since the start
+BLOCK_TIME = 0.005 # samples are published every 5 ms (at least one sample per block)
+POLL_TIME = 0.001 # SignalReader.wait checks for new samples every 1 ms
+
+
+class RingBuffer:
+    def __init__(self, capacity=1 << 18, name=None):
+        """ Ring buffer of SAMPLE_DTYPE records in shared memory. Only one process writes, any process can read.
+
+        INPUT:
+        - capacity: number of samples kept (default 262144, i.e. ~17 s of Doppler at 15 kSPS)
+        - name: name of an existing ring buffer to attach to. None --> a new one is created (and owned)
+        """
+        self.owner = name is None
+        if self.owner:
+            size = HEADER_BYTES + capacity * SAMPLE_DTYPE.itemsize
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+            self.shm.buf[:HEADER_BYTES] = bytes(HEADER_BYTES)
+        else:
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, track=False)
+            except TypeError: # Python < 3.13
+                self.shm = shared_memory.SharedMemory(name=name)
+            capacity = (self.shm.size - HEADER_BYTES) // SAMPLE_DTYPE.itemsize
+
+        self.name = self.shm.name
+        self.capacity = capacity
+        self.header = np.ndarray((HEADER_BYTES // 8,), dtype='<i8', buffer=self.shm.buf)
+        self.data = np.ndarray((capacity,), dtype=SAMPLE_DTYPE, buffer=self.shm.buf, offset=HEADER_BYTES)
+
+    def count(self):
+        """ Number of samples written since the start (= ring position of the next sample) """
+        return int(self.header[0])
+
+    def write(self, ch, values, times, seq):
+        """ Appends the samples in values (conversions seq of channel ch, acquired at time.monotonic() times) to the ring.
+        Only the owner of the SPI bus calls it. Returns the position of the first sample in the ring """
+        n = len(values)
+        start = int(self.header[0])
+        if n > self.capacity:
+            start += n - self.capacity
+            values = values[-self.capacity:]
+            times = times[-self.capacity:]
+            seq = seq[-self.capacity:]
+            n = self.capacity
+
+        i = start % self.capacity
+        first = min(n, self.capacity - i)
+        for dest, a, b in ((self.data[i:i+first], 0, first),
+                           (self.data[:n-first], first, n)):
+            if len(dest):
+                dest['seq'] = seq[a:b]
+                dest['ch'] = ch
+                dest['t'] = times[a:b]
+                dest['value'] = values[a:b]
+
+        # the counter is published after the data
+        self.header[0] = start + n
+        return start
+
+    def views(self, start, stop):
+        """ Zero-copy views of the samples with ring position in [start, stop).
+        Samples already overwritten are skipped. The result is a list of 1 or 2 structured arrays (2 when the ring wraps)."""
+        start = max(start, stop - self.capacity, 0)
+        if stop <= start:
+            return []
+        i = start % self.capacity
+        j = i + (stop - start)
+        if j <= self.capacity:
+            return [self.data[i:j]]
+        return [self.data[i:], self.data[:j - self.capacity]]
+
+    def close(self):
+        """ Detaches from the shared memory (and frees it, if owned) """
+        self.header = None
+        self.data = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class RingReader:
+    def __init__(self, ring, start=None):
+        """ Cursor of one consumer on a RingBuffer.
+
+        INPUT:
+        - ring: RingBuffer
+        - start: ring position of the first sample to be read. None --> only samples written from now on
+        """
+        self.ring = ring
+        self.next = ring.count() if start is None else start
+        self.dropped = 0 # samples overwritten before being read
+
+    def poll(self):
+        """ Returns the zero-copy views (see RingBuffer.views) of the samples written since the last call.
+        The views are valid until the writer wraps around the ring: copy them if they must be kept. """
+        stop = self.ring.count()
+        lost = stop - self.ring.capacity - self.next
+        if lost > 0:
+            self.dropped += lost
+            self.next += lost
+        blocks = self.ring.views(self.next, stop)
+        self.next = stop
+        return blocks
+
+
+class SignalReader(RingReader):
+    def __init__(self, ring, info):
+        """ RingReader following one signal, from the first sample acquired after AcquisitionEngine.acquire.
+
+        INPUT:
+        - ring: RingBuffer
+        - info: dict returned by AcquisitionEngine.acquire (ch, fs, start)
+        """
+        RingReader.__init__(self, ring, info['start'])
+        self.ch = info['ch']
+        self.fs = info['fs']
+        self.pending = [] # copies of the samples polled but not returned by the last read()
+
+    def wait(self, timeout=None):
+        """ Like poll(), but it waits up to timeout [s] (None = forever) for new samples of the channel.
+        Samples of other channels (written after the next acquire) are skipped """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            blocks, self.pending = self.pending, []
+            for block in self.poll():
+                if not (block['ch'] == self.ch).all():
+                    block = block[block['ch'] == self.ch]
+                if len(block):
+                    blocks.append(block)
+            if blocks or (deadline is not None and time.monotonic() >= deadline):
+                return blocks
+            time.sleep(POLL_TIME)
+
+    def read(self, n, check=None):
+        """ It reads the next n samples of the signal (copies).
+
+        INPUT:
+        - n: number of samples
+        - check: optional function called while waiting (e.g. vWPV.check_interrupt, which can raise)
+
+        OUTPUT:
+        - seq, t, value: arrays of the conversion numbers, acquisition times [s] and samples [V]
+        """
+        blocks = []
+        count = 0
+        while count < n:
+            if check is not None:
+                check()
+            for block in self.wait(0.05):
+                if count == n:
+                    self.pending.append(block.copy())
+                    continue
+                if len(block) > n - count: # the rest is returned by the next read (or wait)
+                    self.pending.append(block[n - count:].copy())
+                    block = block[:n - count]
+                blocks.append(block.copy())
+                count += len(block)
+        data = np.concatenate(blocks) if blocks else np.zeros(0, dtype=SAMPLE_DTYPE)
+        return data['seq'], data['t'], data['value']
+
+
+class SequenceClock:
+    def __init__(self, fs, seq):
+        """ Conversion numbers and acquisition times of the samples of a stream read with ADS1256_ReadBlock.
+
+        As in ADS1256.ADS1256_MissedSamples, each block timestamp (time at which DRDY was seen LOW) can only be late 
+        with respect to its conversion: the offset timestamp - seq/fs is at least the one of the first conversion (base).
+        Late by one sampling period or more means that conversions were overwritten before being read:
+        the conversion number advances by the conversions lost.
+
+        INPUT:
+        - fs: sampling frequency [Hz]
+        - seq: conversion number of the first sample
+        """
+        self.fs = fs
+        self.seq = seq
+        self.base = None # lowest offset timestamp - seq/fs [s] seen so far
+
+    def block(self, n, timestamps):
+        """ INPUT:
+        - n: number of samples of the block
+        - timestamps: ADS1256.timestamps of the block ([sample index, time.monotonic()])
+
+        OUTPUT:
+        - seq: conversion number of each sample
+        - t: acquisition time of each sample [s]
+        - missed: conversions lost in the block
+        """
+        missed = np.zeros(n, dtype=np.int64)
+        lost = 0
+        for index, t in timestamps:
+            offset = t - (self.seq + index + lost) / self.fs
+            if self.base is None:
+                self.base = offset
+            k = int(np.floor((offset - self.base) * self.fs))
+            if k > 0:
+                lost += k
+                offset -= k / self.fs
+            self.base = min(self.base, offset)
+            missed[int(index):] = lost
+        seq = self.seq + np.arange(n) + missed
+        self.seq = int(seq[-1]) + 1 if n else self.seq
+        return seq, self.base + seq / self.fs, lost
+
+
+def _engine_main(ring, conn):
+    """ Main loop of the acquisition process. It receives from conn:
+        - ("acquire", signal_code): configures the ADC (vWPV.ADC_configuration) and streams the signal into the ring
+        - ("stop",): stops streaming
+        - ("close",): stops streaming and exits
+    and answers each command with ("ok", info) or ("error", message)."""
+
+    import vWPV
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl-C: the parent closes the engine
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # not the handler of the parent (e.g. headless.py)
+    vWPV.ADC = ADS1256new.ADS1256()
+    streaming = False
+    channel = 0
+    block = 1
+    seq = 0 # conversion number of the next sample
+    clock = None
+
+    while True:
+        if streaming and not conn.poll():
+            values = vWPV.ADC.ADS1256_ReadBlock(block)
+            seqs, times, lost = clock.block(block, vWPV.ADC.timestamps)
+            ring.write(channel, values, times, seqs)
+            continue
+
+        cmd = conn.recv()
+        try:
+            if streaming:
+                vWPV.stop_continuous_read()
+                streaming = False
+                seq = clock.seq + 1 # conversions of different signals are never consecutive
+
+            if cmd[0] == "acquire":
+                gain, drate, channel = vWPV.ADC_SETTINGS[cmd[1]]
+                fs = ADS1256new.ADS1256_DRATE_SPS[ADS1256new.ADS1256_DRATE_E[drate]]
+                block = max(1, int(fs * BLOCK_TIME))
+                vWPV.ADC_configuration(cmd[1])
+                clock = SequenceClock(fs, seq)
+                streaming = True
+                conn.send(("ok", {'signal' : cmd[1], 'ch' : channel, 'fs' : fs, 'start' : ring.count(), 'seq' : seq}))
+            elif cmd[0] == "stop":
+                conn.send(("ok", {'start' : ring.count(), 'seq' : seq}))
+            elif cmd[0] == "close":
+                conn.send(("ok", {'start' : ring.count(), 'seq' : seq}))
+                break
+            else:
+                conn.send(("error", "Unknown command: " + str(cmd[0])))
+        except Exception as e:
+            conn.send(("error", repr(e)))
+
+    conn.close() # the ring buffer is freed by the parent
+
+
+class AcquisitionEngine:
+    def __init__(self, capacity=1 << 18):
+        """ Acquisition process owning the SPI bus and feeding a shared-memory RingBuffer.
+
+        INPUT:
+        - capacity: number of samples kept in the ring buffer
+        """
+        self.ring = RingBuffer(capacity)
+        self.conn = None
+        self.process = None
+
+    def start(self):
+        """ Starts the acquisition process. Must be called before acquire()/stop() """
+        ctx = mp.get_context("fork") # the process inherits the hardware backend (and the ring) of the parent
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=_engine_main, args=(self.ring, child), daemon=True)
+        self.process.start()
+        child.close()
+        ADS1256new.ModeLocked = True # the process streams in single channel mode (see vWPV.set_scan_mode)
+
+    def command(self, *cmd):
+        if not self.process.is_alive(): # e.g. SIGTERM sent to the process group
+            raise RuntimeError("Acquisition engine: the process has ended")
+        self.conn.send(cmd)
+        status, info = self.conn.recv()
+        if status != "ok":
+            raise RuntimeError("Acquisition engine: " + info)
+        return info
+
+    def acquire(self, signal_code):
+        """ Starts streaming the signal "R", "E" or "D" (see vWPV.ADC_SETTINGS).
+        Returns a dict with channel, fs, the ring position (start) and the conversion number (seq) of the first sample 
+        of the new signal """
+        return self.command("acquire", signal_code)
+
+    def open(self, signal_code):
+        """ Starts streaming the signal and returns a SignalReader following it """
+        return SignalReader(self.ring, self.acquire(signal_code))
+
+    def stop(self):
+        """ Stops streaming. Returns a dict with the ring position of the next sample """
+        return self.command("stop")
+
+    def reader(self, start=None):
+        """ New RingReader on the ring buffer (see RingReader) """
+        return RingReader(self.ring, start)
+
+    def close(self):
+        """ Stops the acquisition process and frees the ring buffer """
+        if self.process is not None:
+            if self.process.is_alive():
+                self.command("close")
+            self.process.join()
+            self.process = None
+            ADS1256new.ModeLocked = False
+        self.ring.close()
@@ -0,0 +1,138 @@
+""" Offline batch re-analysis of recorded sessions.
+
+It recomputes the latency and the vPWV of every measurement with each latency engine (vWPV.LATENCY_ENGINES: vPWV_TD_percentage,
+vPWV_FD_percentage), using a process pool on all cores,
+for every combination of the given parameters (parameter sweep), and it writes the results to a table
+(CSV, or NumPy structured array if the output file ends with .npy).
+
+Inputs can be binary session files (session.py) or the old GUI_Rpi text dumps (doppler_<title>.txt, one str(list) per line).
+
+As in vWPV.measure_loop, the latency is referred to the valve trigger edge (vWPV.align_latency) when the session records
+the trigger and Doppler start times (session version 2), so that it can be compared with recorded_latency.
+Otherwise (text dumps, version 1 sessions) it is the latency from the first Doppler sample and latency_uncertainty is NaN.
+
+Usage:
+    python batch.py session_*.vpwv --span 0.05,0.1,0.2 --th 5 --out results.csv
+    python batch.py doppler_old.txt --fs 15000 --deltax 30 --smoothing lowess,moving_average
+    python batch.py session_*.vpwv --engine td,stft,stft_mean --out engines.csv
+"""
+
+import argparse
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# the analysis does not need the acquisition hardware
+os.environ.setdefault("VPWV_BACKEND", "sim")
+
+RESULT_DTYPE = np.dtype([('file', 'U256'), ('index', '<i4'), ('engine', 'U16'), ('smoothing', 'U16'),
+                         ('span', '<f8'), ('th', '<f8'), ('bs', '<f8'), ('mpw', '<f8'),
+                         ('latency_from_start', '<f8'), ('latency', '<f8'), ('latency_uncertainty', '<f8'),
+                         ('vpwv', '<f8'), ('recorded_latency', '<f8')])
+
+
+def sweep(x, fs, deltax, combos, timing=None):
+    """ Latency and vPWV of the Doppler trace x for each parameter combination (engine, smoothing, span, th, bs, mpw).
+    timing: (doppler_start, trigger_time) of the measurement (see session.SessionReader.timing), None if not recorded.
+    Returns (latency_from_start, latency, latency_uncertainty, vpwv) for each combination """
+    import vWPV
+    out = []
+    for engine, smoothing_method, span, th, bs, mpw in combos:
+        latency_from_start, envelope = vWPV.latency_engine(engine)(x, fs, smoothing_method, span=span, th=th, bs=bs, mpw=mpw)
+        if timing is None:
+            latency, uncertainty = latency_from_start, np.nan
+        else:
+            latency, uncertainty = vWPV.align_latency(latency_from_start, timing[0], timing[1], fs)
+        out.append((latency_from_start, latency, uncertainty, deltax/(latency*100) if latency > 0 else np.nan))
+    return out
+
+
+def session_task(args):
+    """ Worker: one measurement of a session file, read through np.memmap """
+    import session
+    path, index, deltax, combos = args
+    reader = session.SessionReader(path)
+    entry = reader.find(index, "D")
+    x = np.array(reader.signal(index, "D"), dtype=float)
+    if deltax is None:
+        deltax = reader.metadata.get('deltax', np.nan)
+    return sweep(x, float(entry['fs']), deltax, combos, reader.timing(index)), float(entry['latency'])
+
+
+def trace_task(args):
+    """ Worker: one Doppler trace already loaded (text dumps) """
+    x, fs, deltax, combos = args
+    return sweep(x, fs, deltax, combos), np.nan
+
+
+def tasks(files, fs, deltax, combos):
+    """ Yields (file, measurement index, worker, worker arguments) for every measurement of every file """
+    import session
+    import smoothing_accuracy
+    for path in files:
+        try:
+            reader = session.SessionReader(path)
+        except ValueError:
+            reader = None
+
+        if reader is not None:
+            for index in reader.index['index'][reader.index['signal'] == b'D']:
+                yield path, int(index), session_task, (path, int(index), deltax, combos)
+            reader.close()
+        else:
+            for index, x in enumerate(smoothing_accuracy.load_text_dump(path)):
+                yield path, index, trace_task, (x, fs, np.nan if deltax is None else deltax, combos)
+
+
+def run(files, combos, fs=15000, deltax=None, workers=None):
+    """ Re-analyses all the measurements of files for every parameter combination. Returns a RESULT_DTYPE array """
+    jobs = list(tasks(files, fs, deltax, combos))
+    rows = []
+    with ProcessPoolExecutor(workers) as pool:
+        futures = [pool.submit(worker, args) for path, index, worker, args in jobs]
+        for (path, index, worker, args), future in zip(jobs, futures):
+            results, recorded = future.result()
+            for combo, result in zip(combos, results):
+                rows.append((path, index) + tuple(combo) + tuple(result) + (recorded,))
+    return np.array(rows, dtype=RESULT_DTYPE)
+
+
+def floats(text):
+    return [float(v) for v in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='+', help='session files or Doppler text dumps')
+    parser.add_argument('--engine', default='td', help='comma separated latency engines: td, stft, stft_mean (see vWPV.LATENCY_ENGINES)')
+    parser.add_argument('--smoothing', default='lowess', help='comma separated smoothing engines (see smoothing.py)')
+    parser.add_argument('--span', type=floats, default=[0.1], help='comma separated values of span')
+    parser.add_argument('--th', type=floats, default=[5], help='comma separated values of th [%%]')
+    parser.add_argument('--bs', type=floats, default=[0.1], help='comma separated values of bs [s]')
+    parser.add_argument('--mpw', type=floats, default=[0.1], help='comma separated values of the min peak width [s]')
+    parser.add_argument('--fs', type=float, default=15000, help='sampling frequency of text dumps [Hz]')
+    parser.add_argument('--deltax', type=float, default=None, help='cuff-probe distance [cm] (default: from the session file)')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: all cores)')
+    parser.add_argument('--out', default='-', help='output table, .csv or .npy (default: CSV on stdout)')
+    args = parser.parse_args(argv)
+
+    combos = list(itertools.product(args.engine.split(','), args.smoothing.split(','), args.span, args.th, args.bs, args.mpw))
+    table = run(args.files, combos, args.fs, args.deltax, args.workers)
+
+    if args.out.endswith('.npy'):
+        np.save(args.out, table)
+        return
+
+    f = sys.stdout if args.out == '-' else open(args.out, 'w')
+    f.write(','.join(RESULT_DTYPE.names) + '\n')
+    for row in table:
+        f.write(','.join(str(v) for v in row.tolist()) + '\n')
+    if f is not sys.stdout:
+        f.close()
+
+
+if __name__ == "__main__":
+    main()
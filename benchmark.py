@@ -0,0 +1,256 @@
+""" Benchmark suite for the acquisition and processing hot paths.
+
+It runs on the simulated ADC backend (ADS1256sim.py) fed with synthetic signals, or with the Doppler traces of a recorded
+session, so it does not need the Raspberry Pi. For every stage it reports the run time percentiles, the throughput
+(samples/s) where it applies and the peak memory allocated (tracemalloc, measured on a separate run). The first call of
+every stage is not included in the percentiles: its cold cost (lazy imports, first allocations) is reported as first_ms.
+Results are saved as JSON, so that two versions can be compared.
+
+Stages:
+    - adc_reading       vWPV.ADC_reading, one call per sample (emulator not paced)
+    - read_block        ADS1256.ADS1256_ReadBlock of 1 s of Doppler (emulator not paced)
+    - switch_full       vWPV.ADC_configuration R --> E --> D with reset and full initialisation
+    - switch_fast       vWPV.ADC_configuration R --> E --> D writing only the changed registers (saved time per switch reported)
+    - doppler_realtime  ADS1256_ReadBlock of 1 s of Doppler with the emulator paced at 15 kSPS: achieved sample rate
+    - vpwv_<method>     vWPV.vPWV_TD_percentage with each smoothing engine
+    - stft, stft_mean   vWPV.vPWV_FD_percentage (frequency envelope engines, default smoothing)
+    - initialization    vWPV.initialization: 10 s ECG (emulator not paced) + threshold search
+    - measure_loop      vWPV.measure_loop end to end (emulator not paced, includes the 5.2 s trigger process)
+    - startup_<module>  "import <module>" in a fresh interpreter (python -X importtime), for vWPV and GUI_Rpi:
+                        wall time and the slowest imported modules (cumulative)
+
+Usage:
+    python benchmark.py --out bench.json
+    python benchmark.py --out new.json --compare bench.json
+    python benchmark.py --session session_x.vpwv --skip measure_loop
+"""
+
+import argparse
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+os.environ["VPWV_BACKEND"] = "sim"
+os.environ.setdefault("VPWV_SIM_REALTIME", "0")
+
+
+def synthetic_signals(rng, duration=20):
+    """ Breath (50 Hz), ECG (500 Hz) and Doppler (15 kHz) synthetic signals [V] """
+    import smoothing_accuracy
+    t = np.arange(int(duration * 50)) / 50
+    breath = np.sin(2*np.pi*t/4) + 0.05*rng.normal(size=len(t))
+    t = np.arange(int(duration * 500)) / 500
+    ecg = 0.1 + 0.9*np.exp(-((t % 0.9) / 0.01)**2) + 0.02*rng.normal(size=len(t))
+    doppler = smoothing_accuracy.synthetic_doppler(15000, 0.3, rng=rng)
+    return breath, ecg, doppler
+
+
+def stats(times, samples=None):
+    """ Percentiles [ms] of the run times and throughput [samples/s] """
+    t = np.array(times)
+    result = {'runs' : len(t),
+              'mean_ms' : t.mean()*1000,
+              'p50_ms' : np.percentile(t, 50)*1000,
+              'p90_ms' : np.percentile(t, 90)*1000,
+              'p99_ms' : np.percentile(t, 99)*1000,
+              'max_ms' : t.max()*1000,
+             }
+    if samples:
+        result['samples'] = samples
+        result['samples_per_s'] = samples / np.median(t)
+        result['us_per_sample'] = np.median(t) / samples * 1e6
+    return result
+
+
+def bench(fn, repeat, samples=None, memory=True):
+    """ Runs fn once untimed by stats() (lazy imports, first allocations, caches) then repeat times.
+    Returns stats() plus 'first_ms' (the cold first call) and peak memory [kB] of one more run under tracemalloc """
+    t = time.perf_counter()
+    fn()
+    first = time.perf_counter() - t
+    times = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t)
+    result = stats(times, samples)
+    result['first_ms'] = first*1000
+    if memory:
+        tracemalloc.start()
+        fn()
+        result['peak_kb'] = tracemalloc.get_traced_memory()[1] / 1024
+        tracemalloc.stop()
+    return result
+
+
+def import_time(module, repeat, top=10):
+    """ Startup cost of "import module" in a fresh interpreter (sim backend).
+
+    OUTPUT:
+    - stats() of the wall time of the interpreter + import, plus:
+      'import_ms' (python -X importtime total of the last run) and 'top_modules': [module, cumulative ms] of the slowest imports
+    """
+    env = dict(os.environ, VPWV_BACKEND="sim")
+    cwd = os.path.dirname(os.path.abspath(__file__)) # the modules are imported from the repository, wherever the benchmark is run from
+    times = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                              env=env, cwd=cwd, stderr=subprocess.PIPE, stdout=subprocess.DEVNULL, text=True, check=True)
+        times.append(time.perf_counter() - t)
+    # lines: "import time: self [us] | cumulative | imported package", nesting shown by the indentation of the name
+    cumulative = dict()
+    total = 0
+    for line in proc.stderr.splitlines():
+        fields = line[len("import time:"):].split("|") if line.startswith("import time:") else []
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue
+        name = fields[2].strip()
+        cumulative[name] = int(fields[1]) / 1000
+        if not fields[2][1:].startswith(" "):      # top level import
+            total += int(fields[1])
+    result = stats(times)
+    result['import_ms'] = total / 1000
+    result['top_modules'] = sorted(cumulative.items(), key=lambda item: -item[1])[:top]
+    return result
+
+
+def run(args):
+    import config
+    import ADS1256new
+    import session
+    import vWPV
+
+    rng = np.random.default_rng(0)
+    breath, ecg, doppler = synthetic_signals(rng)
+    traces = [doppler]
+    if args.session:
+        reader = session.SessionReader(args.session)
+        traces = [np.array(reader.signal(i, "D"), dtype=float) for i in reader.index['index'][reader.index['signal'] == b'D']]
+        doppler = traces[0]
+    config.chip.set_channel(7, breath)
+    config.chip.set_channel(4, ecg)
+    config.chip.set_channel(2, doppler)
+
+    vWPV.ADC = ADS1256new.ADS1256()
+    vWPV.fs_r, vWPV.fs_e, vWPV.fs_d = 50, 500, 15000
+    vWPV.ACQUISITION_PROCESS = False # the stages measure the processing of this process (see acquisition.py)
+    results = dict()
+
+    def skipped(name):
+        return any(name.startswith(skip) for skip in args.skip)
+
+    def stage(name, *a, **k):
+        if skipped(name):
+            return
+        print("-", name)
+        results[name] = bench(*a, **k)
+
+    for module in ('vWPV', 'GUI_Rpi'):
+        if not skipped('startup_' + module):
+            print("-", 'startup_' + module)
+            results['startup_' + module] = import_time(module, args.repeat)
+
+    config.chip.realtime = False
+    vWPV.ADC_configuration("D")
+    stage('adc_reading', lambda: [vWPV.ADC_reading() for i in range(15000)], args.repeat, 15000)
+    stage('read_block', lambda: vWPV.ADC.ADS1256_ReadBlock(15000), args.repeat, 15000)
+
+    def switch(fast):
+        for code in "RED":
+            vWPV.stop_continuous_read() # as ADC_switch: SDATAC in its own CS-low transaction
+            vWPV.ADC_configuration(code, fast)
+    stage('switch_full', lambda: switch(False), args.repeat)
+    stage('switch_fast', lambda: switch(True), args.repeat)
+    if 'switch_full' in results and 'switch_fast' in results:
+        results['switch_fast']['saved_ms_per_switch'] = (results['switch_full']['p50_ms'] - results['switch_fast']['p50_ms']) / 3
+        print("  saved per switch: %.3f ms" % results['switch_fast']['saved_ms_per_switch'])
+
+    def doppler_realtime():
+        config.chip.realtime = True
+        vWPV.ADC_configuration("D")
+        vWPV.ADC.ADS1256_ResetDRDYStats()
+        vWPV.ADC.ADS1256_ReadBlock(15000)
+        config.chip.realtime = False
+    stage('doppler_realtime', doppler_realtime, args.repeat, 15000, memory=False)
+    if 'doppler_realtime' in results:
+        drdy = vWPV.ADC.ADS1256_DRDYStats()
+        results['doppler_realtime']['drdy_timeouts'] = drdy['timeouts']
+        results['doppler_realtime']['drdy_mean_wait_us'] = drdy['mean_us']
+        quality = vWPV.ADC.ADS1256_BlockQuality()
+        results['doppler_realtime']['fs_measured'] = quality['fs_measured']
+        results['doppler_realtime']['missed'] = quality['missed']
+
+    for method in args.methods.split(','):
+        it = iter(range(10**9))
+        stage('vpwv_' + method, lambda: vWPV.vPWV_TD_percentage(traces[next(it) % len(traces)], 15000, method),
+              max(args.repeat, len(traces)), 15000)
+
+    for engine in ('stft', 'stft_mean'):
+        it = iter(range(10**9))
+        stage(engine, lambda: vWPV.latency_engine(engine)(traces[next(it) % len(traces)], 15000),
+              max(args.repeat, len(traces)), 15000)
+
+    stage('initialization', vWPV.initialization, args.repeat, 5000)
+    if not any('measure_loop'.startswith(skip) for skip in args.skip):
+        ecg_threshold = vWPV.ecg_threshold if 'initialization' in results else vWPV.initialization()[0]
+        stage('measure_loop', lambda: vWPV.measure_loop(0, ecg_threshold), args.cycles, memory=False)
+
+    return {'meta' : {'time' : time.time(),
+                      'python' : platform.python_version(),
+                      'numpy' : np.__version__,
+                      'machine' : platform.machine(),
+                      'processor' : platform.processor(),
+                      'max_rss_kb' : resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     },
+            'stages' : results}
+
+
+def report(results, baseline=None):
+    print("\n%-22s %10s %10s %10s %10s %12s %10s %8s" % ("stage", "first [ms]", "p50 [ms]", "p90 [ms]", "p99 [ms]", "samples/s", "peak [kB]", "vs base"))
+    for name, r in results['stages'].items():
+        ratio = ""
+        if baseline and name in baseline['stages']:
+            ratio = "%.2fx" % (r['p50_ms'] / baseline['stages'][name]['p50_ms'])
+        print("%-22s %10s %10.2f %10.2f %10.2f %12s %10s %8s" % (name, "%.2f" % r['first_ms'] if 'first_ms' in r else "-", r['p50_ms'], r['p90_ms'], r['p99_ms'],
+              "%.0f" % r['samples_per_s'] if 'samples_per_s' in r else "-",
+              "%.0f" % r['peak_kb'] if 'peak_kb' in r else "-", ratio))
+    print("max RSS: %d kB" % results['meta']['max_rss_kb'])
+    for name, r in results['stages'].items():
+        if 'top_modules' in r:
+            print("\n%s: import %.1f ms, slowest modules (cumulative):" % (name, r['import_ms']))
+            for module, ms in r['top_modules']:
+                print("    %-40s %8.1f ms" % (module, ms))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--out', default=None, help='JSON file for the results')
+    parser.add_argument('--compare', default=None, help='JSON results of a previous run')
+    parser.add_argument('--session', default=None, help='session file whose Doppler traces are used instead of the synthetic one')
+    parser.add_argument('--repeat', type=int, default=5, help='runs per stage (default 5)')
+    parser.add_argument('--cycles', type=int, default=1, help='measure_loop runs (default 1)')
+    parser.add_argument('--methods', default='lowess,lowess_fast,moving_average', help='smoothing engines for vpwv_<method>')
+    parser.add_argument('--skip', type=lambda s: s.split(','), default=[], help='comma separated stages to skip (prefixes: vpwv skips all vpwv_<method>, startup all startup_<module>)')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    report(results, baseline)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,8 +28,7 @@
 #
 
 
-import spidev
-import RPi.GPIO as GPIO
+import os
 import time
 
 # Pin definition
@@ -37,8 +36,25 @@ RST_PIN         = 18
 CS_PIN       = 22
 DRDY_PIN        = 17
 
-# SPI device, bus = 0, device = 0
-SPI = spidev.SpiDev(0, 0)
+# Hardware backend, selected with the environment variable VPWV_BACKEND:
+#   "rpi" (default) --> Raspberry Pi GPIO + spidev
+#   "sim"           --> software ADS1256 emulator (ADS1256sim.py), runs on any machine
+BACKEND = os.environ.get("VPWV_BACKEND", "rpi")
+
+if BACKEND == "sim":
+    import ADS1256sim
+    chip = ADS1256sim.ADS1256Emulator(realtime=os.environ.get("VPWV_SIM_REALTIME", "1") != "0")
+    GPIO = ADS1256sim.SimGPIO(chip)
+    # SPI device, bus = 0, device = 0
+    SPI = ADS1256sim.SimSpiDev(chip, 0, 0)
+elif BACKEND == "rpi":
+    import spidev
+    import RPi.GPIO as GPIO
+    chip = None
+    # SPI device, bus = 0, device = 0
+    SPI = spidev.SpiDev(0, 0)
+else:
+    raise ValueError("Unknown VPWV_BACKEND: " + BACKEND)
 
 def module_init():
     GPIO.setmode(GPIO.BCM)
@@ -69,5 +85,9 @@ def spi_writebyte(data):
 def spi_readbytes(reg):
     return SPI.readbytes(reg)
 
+def spi_xfer(data, delay_us=0):
+    # full duplex transfer, delay_us after the last byte
+    return SPI.xfer2(data, SPI.max_speed_hz, delay_us)
+
 ### END OF FILE ###
 
@@ -0,0 +1,148 @@
+""" Measurement controller: runs vWPV.initialization and the measurements (pipeline.MeasurementPipeline) in a background thread,
+so that the Tk main loop of GUI_Rpi is never blocked.
+
+The thread posts its events to a queue, which the GUI reads with poll() from a root.after callback:
+    ("state", text)                                     progress of the measurement
+    ("initialized", ecg_threshold, ECG)                 end of the initialisation (10 s ECG monitoring)
+    ("result", latency, breath, ECG, doppler, info)     one measurement (see vWPV.measure_loop)
+    ("paused",)                                         the thread is waiting for resume() or cancel()
+    ("error", exception, traceback text)                the thread stopped because of an error
+    ("stopped",)                                        the thread has ended (after cancel() or an error)
+
+pause() and cancel() take effect at once during the initial ECG monitoring, the trigger search (breath and ECG acquisition)
+and the cuff deflation, through vWPV.interrupt: the search in progress is abandoned, no pulse is delivered.
+An interrupted initialisation is repeated on resume().
+A pulse already delivered is completed (1 s Doppler acquisition) and its result is posted: the latency of each pulse
+is computed by the pipeline while the next one is searched, so the result of pulse N may be posted after pulse N+1.
+
+Example:
+    ctrl = MeasurementController(delay=0)
+    ctrl.start()
+    for event in ctrl.poll(): ...
+"""
+
+import queue
+import threading
+import traceback
+
+import pipeline
+import vWPV
+
+# keys of the pipeline results that are not in the info dict of the "result" event
+RESULT_KEYS = ('index', 'latency', 'breath', 'ECG', 'doppler')
+
+
+class MeasurementController:
+    def __init__(self, delay=0, phase=None, pulses=None, engine=None):
+        """ INPUT:
+        - delay: delay between R-wave detection and pressure pulse delivery [s] (see set_delay)
+        - phase: predictive trigger phase (see vWPV.measure_loop), None = pulse "delay" s after the R wave
+        - pulses: number of measurements after which the thread stops (None = until cancel())
+        - engine: latency engine (see vWPV.LATENCY_ENGINES, set_engine), None = vWPV.LATENCY_ENGINE
+        """
+        self.delay = delay
+        self.phase = phase
+        self.pulses = pulses
+        self.engine = engine
+        self.done = 0       # measurements posted
+        self.events = queue.Queue()
+        self.paused = threading.Event()
+        self.cancelled = threading.Event()
+        self.thread = None
+        self.pipeline = None
+
+    def start(self):
+        """ Starts the measurement thread: initialisation, then measurements until cancel() (or "pulses" measurements).
+        The trigger and acquisition processes and the latency workers of the pipeline are forked here, 
+        from the calling (main) thread, see vWPV.start_workers """
+        if vWPV.trigger_worker is None or not vWPV.trigger_worker.process.is_alive():
+            vWPV.start_workers()
+        self.pipeline = pipeline.MeasurementPipeline(None, self.delay, callback=self.deliver, phase=self.phase, engine=self.engine)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def post(self, kind, *data):
+        self.events.put((kind,) + data)
+
+    def deliver(self, result):
+        """ Pipeline callback: it posts the result as ("result", latency, breath, ECG, doppler, info) """
+        info = {k : v for k, v in result.items() if k not in RESULT_KEYS}
+        self.done += 1
+        if self.phase is not None and info['rr_stale']:
+            self.post("state", "RR interval estimate not available or stale: pulse %d delivered after the R wave (delay), not at phase %.2f."
+                      % (result['index'] + 1, self.phase))
+        self.post("result", result['latency'], result['breath'], result['ECG'], result['doppler'], info)
+
+    def poll(self):
+        """ Yields the events posted since the last call, without blocking """
+        while True:
+            try:
+                yield self.events.get_nowait()
+            except queue.Empty:
+                return
+
+    def set_delay(self, delay):
+        """ New delay [s], used from the next pulse """
+        self.delay = delay
+
+    def set_engine(self, engine):
+        """ New latency engine (see vWPV.LATENCY_ENGINES), used from the next pulse """
+        vWPV.latency_engine(engine)
+        self.engine = engine
+
+    def pause(self):
+        self.paused.set()
+
+    def resume(self):
+        self.paused.clear()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def interrupted(self):
+        return self.paused.is_set() or self.cancelled.is_set()
+
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run(self):
+        vWPV.interrupt = self.interrupted
+        try:
+            ecg_threshold = None
+            while not self.cancelled.is_set() and (self.pulses is None or self.pipeline.count < self.pulses):
+                if self.paused.is_set():
+                    self.post("paused")
+                    while self.paused.is_set() and not self.cancelled.is_set():
+                        self.cancelled.wait(0.05)
+                    continue
+
+                if ecg_threshold is None:
+                    self.post("state", "Initialization: ECG monitoring (10 s).")
+                    try:
+                        ecg_threshold, ECG = vWPV.initialization()
+                    except vWPV.MeasurementInterrupted:
+                        continue
+                    self.pipeline.ecg_threshold = ecg_threshold
+                    self.post("initialized", ecg_threshold, ECG)
+                    continue
+
+                # the search of the next pulse overlaps the cuff deflation of the previous one (see MeasurementPipeline.step)
+                self.post("state", "Pulse delivery and doppler acquisition.")
+                self.pipeline.delay = self.delay
+                self.pipeline.engine = self.engine
+                try:
+                    self.pipeline.step()
+                except vWPV.MeasurementInterrupted:
+                    continue
+            # results of the pulses already delivered
+            self.pipeline.deliver(wait=True)
+        except Exception as e:
+            self.post("error", e, traceback.format_exc())
+        finally:
+            vWPV.interrupt = None
+            self.pipeline.pool.shutdown()
+            self.post("stopped")
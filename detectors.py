@@ -0,0 +1,337 @@
+""" Streaming detectors used by vWPV.measure_loop and GUI_Rpi.
+
+Each detector receives one sample at a time through push(sample), with a constant cost per sample
+and a memory footprint that does not grow with the length of the session.
+"""
+
+import numpy as np
+
+
+class ExpirationDetector:
+    def __init__(self, fs, window=5, refresh=1, num_samples=5):
+        """ Detection of the expiratory phase on the respiratory signal.
+
+        The threshold is the mean of the last "window" seconds of signal, updated every "refresh" seconds.
+        The expiratory phase is detected when num_samples consecutive samples above the threshold are followed by
+        num_samples consecutive samples below the threshold. No detection is made during the first "window" seconds.
+
+        INPUT:
+        - fs: sampling frequency [Hz]
+        - window: length of the signal used for the threshold [s]
+        - refresh: threshold update period [s]
+        - num_samples: number of consecutive samples above/below threshold
+        """
+        self.size = int(window * fs)
+        self.refresh = max(1, int(refresh * fs))
+        self.num_samples = num_samples
+        self.buf = np.zeros(self.size) # circular buffer with the last "window" seconds
+        self.reset()
+
+    def reset(self):
+        """ Restarts the detection (a new "window" seconds warm-up is needed) """
+        self.buf[:] = 0
+        self.i = 0          # next write position in buf
+        self.n = 0          # samples pushed since reset
+        self.total = 0.0    # running sum of buf
+        self.threshold = None
+        self.below = 0      # consecutive samples (most recent ones) below threshold
+
+    def last(self, k):
+        """ Last k samples, in chronological order """
+        k = min(k, self.n, self.size)
+        return np.take(self.buf, range(self.i - k, self.i), mode='wrap')
+
+    def window(self):
+        """ Last "window" seconds of signal, in chronological order """
+        return self.last(self.size)
+
+    def push(self, sample):
+        """ Adds a sample. Returns True when the expiratory phase is detected """
+        self.total += sample - self.buf[self.i]
+        self.buf[self.i] = sample
+        self.i = (self.i + 1) % self.size
+        self.n += 1
+
+        if self.n < self.size:
+            return False
+
+        if self.n == self.size or self.n % self.refresh == 0: #threshold update (the first one at the end of the warm-up)
+            self.threshold = self.total / self.size
+            recent = self.last(self.num_samples)[::-1]
+            above = np.nonzero(recent > self.threshold)[0]
+            self.below = above[0] if above.size else self.num_samples
+            if self.n == self.size:
+                return False
+        elif sample <= self.threshold:
+            self.below += 1
+        else:
+            self.below = 0
+
+        if self.below < self.num_samples:
+            return False
+        pre = self.last(2 * self.num_samples)[:self.num_samples]
+        return len(pre) == self.num_samples and pre.min() >= self.threshold
+
+
+class OutlierFilter:
+    def __init__(self, w_size=20, n_std=3, min_samples=5, rebaseline=3):
+        """ Streaming version of vWPV.isoutlier, to be applied to the vPWV values as they are produced.
+
+        A value is an outlier if it differs by more than n_std standard deviations from the mean of the last
+        w_size values that were not outliers. Mean and standard deviation are updated with running sums.
+        After "rebaseline" consecutive outliers the level is considered changed (e.g. new posture or cuff position): 
+        the window restarts from those values, and the last one is not an outlier.
+
+        INPUT:
+        - w_size: number of previous values used for mean and standard deviation
+        - n_std: threshold, in standard deviations
+        - min_samples: no value is marked as outlier until min_samples values have been accepted
+        - rebaseline: number of consecutive outliers after which the window is restarted (0 = never)
+        """
+        self.w_size = w_size
+        self.n_std = n_std
+        self.min_samples = max(2, min_samples)
+        self.rebaseline = rebaseline
+        self.buf = np.zeros(w_size)
+        self.reset()
+
+    def reset(self):
+        self.i = 0
+        self.n = 0
+        self.total = 0.0
+        self.total2 = 0.0
+        self.outliers = [] # consecutive outliers
+
+    def push(self, value):
+        """ Adds a value. Returns True if it is an outlier (outliers are not added to the window, see rebaseline) """
+        count = min(self.n, self.w_size)
+        if count >= self.min_samples:
+            m = self.total / count
+            dev = np.sqrt(max(self.total2 / count - m*m, 0.0))
+            if dev > 0 and abs(value - m) > self.n_std * dev:
+                if self.rebaseline <= 0:
+                    return True
+                self.outliers.append(value)
+                if len(self.outliers) < self.rebaseline:
+                    return True
+                # level change: the window restarts from the consecutive outliers
+                outliers = self.outliers
+                self.reset()
+                for previous in outliers[:-1]:
+                    self.add(previous)
+        self.outliers = []
+        self.add(value)
+        return False
+
+    def add(self, value):
+        """ Adds a value to the window """
+        old = self.buf[self.i] if self.n >= self.w_size else 0.0
+        self.total += value - old
+        self.total2 += value*value - old*old
+        self.buf[self.i] = value
+        self.i = (self.i + 1) % self.w_size
+        self.n += 1
+
+
+class RWaveDetector:
+    def __init__(self, fs, low=5, high=15, window=0.03, refractory=0.2, learning=2):
+        """ Streaming R-wave detector (Pan-Tompkins style), O(1) per sample.
+
+        Feature: ECG band-pass filtered (biquad, low-high Hz), differentiated, squared and integrated over "window" seconds.
+        An R wave is detected when the feature crosses the adaptive threshold NPK + 0.25*(SPK - NPK), where SPK and NPK are
+        running estimates (1/8 update) of the feature peaks of the R waves and of the noise (peaks outside the QRS complexes).
+        Crossings within "refractory" seconds from the previous R wave are ignored; within 360 ms a crossing is a T wave
+        unless the feature exceeds half of the previous R wave peak. The detection is made on the rising edge of the
+        feature, so the delay from the R-wave upstroke is the filter delay plus a few samples.
+
+        INPUT:
+        - fs: sampling frequency [Hz]
+        - low, high: band of the QRS complex [Hz]
+        - window: moving window integration [s]
+        - refractory: minimum time between two R waves [s]
+        - learning: no detection during the first "learning" seconds after reset: SPK and NPK are initialised from the feature
+        """
+        self.fs = fs
+        w0 = 2 * np.pi * np.sqrt(low * high) / fs
+        alpha = np.sin(w0) / (2 * np.sqrt(low * high) / (high - low))
+        a0 = 1 + alpha
+        self.b = (alpha / a0, -alpha / a0)                          # b0 (b1 = 0), b2
+        self.a = (-2 * np.cos(w0) / a0, (1 - alpha) / a0)           # a1, a2
+        self.size = max(1, int(round(window * fs)))
+        self.buf = np.zeros(self.size)
+        self.refractory = int(refractory * fs)
+        self.t_wave = int(0.36 * fs)
+        self.learning = int(learning * fs)
+        self.reset()
+
+    def reset(self):
+        """ Restarts the detection, including the learning phase """
+        self.spk = None         # signal (R wave) peak level of the feature
+        self.npk = None         # noise peak level of the feature
+        self.n = 0              # samples pushed since reset
+        self.learn_max = 0.0
+        self.learn_sum = 0.0
+        self.last_beat = None   # sample number of the last R wave
+        self.qrs_peak = 0.0     # feature peak of the current/last QRS complex
+        self.restart()
+
+    def restart(self, sample=None):
+        """ Restarts the filters (new, not contiguous, signal segment) keeping the learnt levels """
+        self.x1 = self.x2 = sample # band-pass input history (initialised with the first sample: no step response)
+        self.y1 = self.y2 = 0.0
+        self.buf[:] = 0
+        self.i = 0
+        self.total = 0.0
+        self.f1 = self.f2 = 0.0 # last feature values, for the local maxima
+        self.holdoff = self.size
+        self.last_beat = None   # no refractory period across segments
+
+    def threshold(self):
+        if self.spk is None:
+            return np.inf
+        return self.npk + 0.25 * (self.spk - self.npk)
+
+    def push(self, sample):
+        """ Adds a sample. Returns True when an R wave is detected """
+        if self.x1 is None:
+            self.x1 = self.x2 = sample
+        b0, b2 = self.b
+        a1, a2 = self.a
+        y = b0 * sample + b2 * self.x2 - a1 * self.y1 - a2 * self.y2
+        d = y - self.y1
+        self.x2, self.x1 = self.x1, sample
+        self.y2, self.y1 = self.y1, y
+
+        self.total += d*d - self.buf[self.i]
+        self.buf[self.i] = d*d
+        self.i = (self.i + 1) % self.size
+        f = max(self.total, 0.0) / self.size
+        f1, f2 = self.f1, self.f2
+        self.f2, self.f1 = f1, f
+        self.n += 1
+
+        if self.n <= self.learning:
+            self.learn_max = max(self.learn_max, f)
+            self.learn_sum += f
+            if self.n == self.learning:
+                self.spk = self.learn_max / 3
+                self.npk = self.learn_sum / self.learning / 2
+            return False
+        if self.holdoff > 0:
+            self.holdoff -= 1
+            return False
+
+        since = self.n - self.last_beat if self.last_beat is not None else np.inf
+        if since <= self.refractory:
+            self.qrs_peak = max(self.qrs_peak, f)
+            if since == self.refractory:
+                self.spk = 0.125 * self.qrs_peak + 0.875 * self.spk
+            return False
+
+        threshold = self.threshold()
+        if f1 > threshold or f <= threshold:
+            if f1 >= f2 and f1 > f and f1 <= threshold: # noise peak
+                self.npk = 0.125 * f1 + 0.875 * self.npk
+            return False
+        if since <= self.t_wave and f <= 0.5 * self.qrs_peak:
+            return False # T wave (or not yet above half of the previous R wave peak)
+        self.last_beat = self.n
+        self.qrs_peak = f
+        return True
+
+
+class RRTracker:
+    def __init__(self, n=8, tolerance=0.3, min_rr=0.3, max_rr=2.0, min_intervals=3, max_age=60):
+        """ Running estimate of the RR interval from the R-wave times, used to predict the next R waves.
+
+        Only intervals between consecutive beats are used. The R waves may be observed with gaps (e.g. one beat per
+        trigger search): an interval spanning k > 1 beats (k = interval / RR rounded) only gives the time at which 
+        the R wave had been predicted (last_predicted), since dividing it by k would feed the estimate with itself.
+        Intervals differing by more than tolerance*RR from the estimate (missed or false detections) are rejected.
+        The estimate is the mean of the last n accepted intervals; it is stale if no interval has been accepted for 
+        max_age seconds (e.g. sequential trigger search, which sees one beat per pulse after the initialisation).
+
+        INPUT:
+        - n: number of intervals averaged
+        - tolerance: max relative difference of an interval from the estimate
+        - min_rr, max_rr: range of the first interval accepted [s]
+        - min_intervals: number of accepted intervals before the estimate is used (see ready)
+        - max_age: the estimate is stale after max_age s without accepted intervals [s]
+        """
+        self.n = n
+        self.tolerance = tolerance
+        self.min_rr = min_rr
+        self.max_rr = max_rr
+        self.min_intervals = min_intervals
+        self.max_age = max_age
+        self.buf = np.zeros(n)
+        self.reset()
+
+    def reset(self):
+        self.i = 0
+        self.count = 0
+        self.total = 0.0
+        self.total2 = 0.0
+        self.last_beat = None           # time of the last R wave [s]
+        self.last_predicted = np.nan    # time at which the last R wave had been predicted [s]
+        self.updated = np.nan           # time of the R wave closing the last accepted interval [s]
+
+    def age(self, t):
+        """ Time since the last accepted interval [s] (nan if none) """
+        return t - self.updated
+
+    def stale(self, t):
+        """ True if no interval has been accepted in the last max_age s before time t """
+        return not self.age(t) <= self.max_age
+
+    def ready(self, t=None):
+        """ True when the RR interval has been estimated from at least min_intervals intervals and, if t is given,
+        the estimate is not stale at time t """
+        if self.count < max(1, self.min_intervals) or self.last_beat is None:
+            return False
+        return t is None or not self.stale(t)
+
+    def rr(self):
+        """ RR interval estimate [s] (nan if not available) """
+        return self.total / min(self.count, self.n) if self.count else np.nan
+
+    def rr_std(self):
+        """ Standard deviation of the last accepted RR intervals [s] """
+        count = min(self.count, self.n)
+        if count < 2:
+            return np.nan
+        m = self.total / count
+        return np.sqrt(max(self.total2 / count - m*m, 0.0))
+
+    def predict(self, t):
+        """ Predicted time of the first R wave after time t [s] (nan if not ready or stale) """
+        if not self.ready(t):
+            return np.nan
+        rr = self.rr()
+        return self.last_beat + max(1, np.floor((t - self.last_beat) / rr) + 1) * rr
+
+    def push(self, t):
+        """ Adds the R wave detected at time t [s]. Returns True if the interval from the previous one was accepted 
+        (consecutive beats only) """
+        accepted = False
+        if self.last_beat is not None:
+            dt = t - self.last_beat
+            if self.count:
+                rr = self.rr()
+                k = max(1, int(round(dt / rr)))
+                self.last_predicted = self.last_beat + k * rr
+                interval = dt
+                accepted = k == 1 and abs(interval - rr) <= self.tolerance * rr
+            else:
+                k, interval = 1, dt
+                accepted = self.min_rr <= dt <= self.max_rr
+            if accepted:
+                old = self.buf[self.i] if self.count >= self.n else 0.0
+                self.total += interval - old
+                self.total2 += interval*interval - old*old
+                self.buf[self.i] = interval
+                self.i = (self.i + 1) % self.n
+                self.count += 1
+                self.updated = t
+        self.last_beat = t
+        return accepted
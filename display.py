@@ -0,0 +1,113 @@
+""" Live waveform display support for GUI_Rpi: buffers fed by the acquisition (see vWPV.monitor) and display decimation.
+
+A 15 kSPS Doppler capture or 10 s of ECG have far more samples than the pixels of a plot on the Raspberry Pi screen.
+Before plotting, the signals are decimated:
+    - minmax: minimum and maximum of the samples falling in each pixel column (the envelope is preserved exactly)
+    - lttb:   Largest-Triangle-Three-Buckets, keeps the visually most significant sample of each bucket
+"""
+
+import threading
+
+import numpy as np
+
+
+def minmax(y, n_px):
+    """ Per-pixel min/max decimation.
+
+    INPUT:
+    - y: samples
+    - n_px: number of pixel columns
+
+    OUTPUT:
+    - idx: indices of the samples kept (min and max of each column, in chronological order, at most 2*n_px + 1)
+    - y[idx]
+    """
+    y = np.asarray(y)
+    n = len(y)
+    n_px = max(1, int(n_px))
+    if n <= 2 * n_px:
+        idx = np.arange(n)
+        return idx, y
+    size = n // n_px
+    cols = y[:n_px * size].reshape(n_px, size)
+    imin = np.argmin(cols, axis=1)
+    imax = np.argmax(cols, axis=1)
+    start = np.arange(n_px) * size
+    idx = np.column_stack((start + np.minimum(imin, imax), start + np.maximum(imin, imax))).ravel()
+    if n_px * size < n:
+        idx = np.append(idx, n - 1)
+    return idx, y[idx]
+
+
+def lttb(y, n_out, x=None):
+    """ Largest-Triangle-Three-Buckets decimation.
+
+    INPUT:
+    - y: samples
+    - n_out: number of samples kept (first and last included)
+    - x: sample times (default: sample index)
+
+    OUTPUT:
+    - idx: indices of the samples kept
+    - y[idx]
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    n_out = max(3, int(n_out))
+    if n <= n_out:
+        idx = np.arange(n)
+        return idx, y
+    x = np.arange(n, dtype=float) if x is None else np.asarray(x, dtype=float)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int) # n_out - 2 buckets between the first and the last sample
+    idx = np.zeros(n_out, dtype=int)
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # average point of the next bucket (the last sample for the last bucket)
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        cx, cy = x[nlo:nhi].mean(), y[nlo:nhi].mean()
+        # area of the triangles (a, candidate, next average), *2
+        area = np.abs((x[a] - cx) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+    return idx, y[idx]
+
+
+DECIMATORS = {'minmax' : lambda y, n_px: minmax(y, n_px),
+              'lttb' : lambda y, n_px: lttb(y, 2 * n_px)}
+
+
+class LiveBuffer:
+    def __init__(self, fs, seconds):
+        """ Circular buffer with the last "seconds" of a signal, written by the acquisition thread and read by the GUI.
+
+        INPUT:
+        - fs: sampling frequency [Hz]
+        - seconds: length of the buffer [s]
+        """
+        self.fs = fs
+        self.buf = np.zeros(int(fs * seconds), dtype=np.float32)
+        self.lock = threading.Lock()
+        self.count = 0      # samples written since the creation (the GUI redraws only when it changes)
+
+    def push(self, samples):
+        """ Appends one sample or an array of samples """
+        samples = np.atleast_1d(np.asarray(samples, dtype=np.float32))
+        total, size = len(samples), len(self.buf)
+        samples = samples[-size:] # only the last "size" samples are kept
+        n = len(samples)
+        with self.lock:
+            i = (self.count + total - n) % size
+            first = min(n, size - i)
+            self.buf[i:i + first] = samples[:first]
+            self.buf[:n - first] = samples[first:]
+            self.count += total
+
+    def snapshot(self):
+        """ Samples in the buffer, in chronological order, and the sample count """
+        with self.lock:
+            n = min(self.count, len(self.buf))
+            i = self.count % len(self.buf)
+            return np.roll(self.buf, -i)[len(self.buf) - n:], self.count
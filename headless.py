@@ -0,0 +1,194 @@
+""" Headless measurement: the GUI_Rpi workflow (initialization, then repeated measurements) without X11 and Tk.
+
+The measurement runs in the background thread of controller.MeasurementController, exactly as in the GUI.
+Each result is written to a binary session file (session.py) and/or printed on stdout as one JSON line:
+    {"index": 0, "time": ..., "latency": ..., "vpwv": ..., "outlier": false, "delay": ..., "trigger_time": ..., "fs": ..., "missed": ..., "engine": "td"}
+Progress messages go to stderr, so that stdout can be piped.
+
+The settings are read from a JSON config file (keys as DEFAULTS) and/or from the command line, which takes precedence.
+SIGINT and SIGTERM stop the measurement at once (as the Stop button of the GUI); the session file is closed with its index.
+
+Usage:
+    python headless.py --deltax 30 --pulses 10 --out session_patient1.vpwv
+    python headless.py --config protocol.json --delay 200
+    VPWV_BACKEND=sim python headless.py --deltax 30 --pulses 2 --no-session
+
+With the simulated backend (VPWV_BACKEND=sim) the emulated ADS1256 plays synthetic breath, ECG and Doppler signals
+(see simulate), so that the whole measurement can be run without the hardware.
+"""
+
+import argparse
+import contextlib
+import json
+import math
+import signal
+import sys
+import time
+
+DEFAULTS = {'deltax' : None,    # cuff-probe distance [cm] (required)
+            'delay' : 0,        # delay between R wave and pulse delivery [ms], as in GUI_Rpi
+            'phase' : None,     # predictive trigger phase (see vWPV.measure_loop), None = pulse "delay" ms after the R wave
+            'engine' : None,    # latency engine (see vWPV.LATENCY_ENGINES), None = vWPV.LATENCY_ENGINE
+            'pulses' : 10,      # number of measurements, 0 = until SIGINT/SIGTERM
+            'scan' : False,     # scan mode: breath and ECG acquired together (see vWPV.set_scan_mode)
+            'out' : None,       # session file, None = "session_<title><time>.vpwv"
+            'title' : "",
+            'session' : True,   # write the session file
+            'stdout' : True,    # print the results as JSON lines
+           }
+
+
+def load_settings(argv=None):
+    """ DEFAULTS, updated with the config file and then with the command line flags """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default=None, help='JSON file with the settings (keys: %s)' % ", ".join(DEFAULTS))
+    parser.add_argument('--deltax', type=float, help='distance between the points of generation and detection of the pressure pulse [cm]')
+    parser.add_argument('--delay', type=float, help='delay between R-wave detection and pulse delivery [ms] (default 0)')
+    parser.add_argument('--phase', type=float, help='predictive trigger phase, fraction of the RR interval')
+    parser.add_argument('--engine', help='latency engine: td (time-domain envelope), stft, stft_mean (frequency envelope)')
+    parser.add_argument('--pulses', type=int, help='number of measurements, 0 = until stopped (default 10)')
+    parser.add_argument('--scan', action='store_true', default=None, help='scan mode: breath and ECG acquired together, one conversion at a time')
+    parser.add_argument('--out', help='session file')
+    parser.add_argument('--title', help='session title')
+    parser.add_argument('--no-session', dest='session', action='store_false', default=None, help='do not write the session file')
+    parser.add_argument('--quiet', dest='stdout', action='store_false', default=None, help='do not print the results on stdout')
+    args = parser.parse_args(argv)
+
+    settings = dict(DEFAULTS)
+    if args.config:
+        with open(args.config) as f:
+            config_file = json.load(f)
+        unknown = set(config_file) - set(DEFAULTS)
+        if unknown:
+            parser.error("unknown keys in %s: %s" % (args.config, ", ".join(sorted(unknown))))
+        settings.update(config_file)
+    settings.update({k : v for k, v in vars(args).items() if k in DEFAULTS and v is not None})
+
+    if settings['deltax'] is None:
+        parser.error("deltax is required (--deltax or config file)")
+    if not settings['session'] and not settings['stdout']:
+        parser.error("--no-session and --quiet: the results would not be saved")
+    if settings['out'] is None:
+        settings['out'] = "session_" + settings['title'] + time.ctime() + ".vpwv"
+    return settings
+
+
+def log(text):
+    print(text, file=sys.stderr, flush=True)
+
+
+def simulate():
+    """ Synthetic breath, ECG and Doppler (benchmark.synthetic_signals) on the inputs of the emulated ADS1256 that have
+    no signal yet. Called before the acquisition and trigger processes are forked, which inherit the emulator """
+    import numpy as np
+    import ADS1256new
+    import benchmark
+    import config
+    import vWPV
+
+    signals = dict(zip("RED", benchmark.synthetic_signals(np.random.default_rng(0))))
+    for code in "RED":
+        gain, drate, channel = vWPV.ADC_SETTINGS[code]
+        fs = ADS1256new.ADS1256_DRATE_SPS[ADS1256new.ADS1256_DRATE_E[drate]]
+        if channel not in config.chip.channels:
+            config.chip.set_channel(channel, signals[code], fs=fs)
+    log("Simulated ADS1256: synthetic breath, ECG and Doppler signals.")
+
+
+def run(settings):
+    """ Runs the measurement with the given settings (see DEFAULTS) until the requested pulses are done or it is stopped.
+    OUTPUT: number of measurements, error (None if the measurement thread did not fail) """
+    import config
+    import controller
+    import detectors
+    import session
+    import vWPV
+
+    if config.BACKEND == "sim":
+        simulate()
+
+    deltax = settings['deltax']
+    vpwv_filter = detectors.OutlierFilter(w_size=20)
+    session_file = None
+    if settings['session']:
+        session_file = session.SessionWriter(settings['out'], {'title' : settings['title'], 'deltax' : deltax,
+                                                               'delay' : settings['delay'], 'engine' : settings['engine'], 'scan' : settings['scan'],
+                                                               'headless' : True})
+        log("Session file: " + settings['out'])
+
+    vWPV.latency_engine(settings['engine'])   # unknown engine: error before the measurement
+    vWPV.set_scan_mode(1 if settings['scan'] else 0)
+    ctrl = controller.MeasurementController(settings['delay']/1000, settings['phase'], settings['pulses'] or None, settings['engine'])
+    vWPV.monitor = None
+
+    def stop(signum, frame):
+        log("Stopping.")
+        ctrl.cancel()
+
+    count = 0
+    error = None
+    results = sys.stdout
+    # the prints of vWPV and of the ADC driver (also from the measurement thread) go to stderr with the progress messages
+    with contextlib.redirect_stdout(sys.stderr):
+        ctrl.start()
+        # installed after the trigger and acquisition processes and the latency workers are forked (in ctrl.start)
+        signal.signal(signal.SIGINT, stop)
+        signal.signal(signal.SIGTERM, stop)
+        try:
+            while True:
+                for event in ctrl.poll():
+                    kind = event[0]
+
+                    if kind == "state":
+                        log(event[1])
+
+                    elif kind == "initialized" and session_file is not None:
+                        session_file.write_signal(-1, "E", event[2], vWPV.fs_e, vWPV.ADC_SETTINGS["E"][2])
+                        session_file.flush()
+
+                    elif kind == "result":
+                        latency, breath, ECG, doppler, info = event[1:]
+                        vpwv = deltax/(latency*100)
+                        outlier = bool(vpwv_filter.push(vpwv))
+
+                        if session_file is not None:
+                            for code, samples, fs, missed in (("D", doppler, info['fs'], info['missed']), ("R", breath, vWPV.fs_r, 0), ("E", ECG, vWPV.fs_e, 0)):
+                                session_file.write_signal(count, code, samples, fs, vWPV.ADC_SETTINGS[code][2],
+                                                          trigger_time=info['trigger_time'][1], delay=ctrl.delay, latency=latency, vpwv=vpwv, missed=missed,
+                                                          trigger_start=info['trigger_time'][0], doppler_start=info['doppler_start'])
+                            session_file.flush()
+
+                        if settings['stdout']:
+                            line = {'index' : count, 'time' : time.time(), 'latency' : latency, 'vpwv' : vpwv, 'outlier' : outlier,
+                                    'delay' : ctrl.delay, 'trigger_time' : float(info['trigger_time'][1]), 'fs' : float(info['fs']), 'missed' : int(info['missed']),
+                                    'engine' : info['engine']}
+                            # NaN is not valid JSON
+                            print(json.dumps({k : None if isinstance(v, float) and math.isnan(v) else v for k, v in line.items()}), file=results, flush=True)
+                        count += 1
+
+                    elif kind == "error":
+                        error = event[1]
+                        log(event[2])
+
+                    elif kind == "stopped":
+                        return count, error
+
+                time.sleep(0.05)
+        finally:
+            ctrl.cancel()
+            ctrl.join()
+            vWPV.stop_workers()     # waits for the cuff deflation of the last pulse
+            if session_file is not None:
+                session_file.close()
+            log("%d measurements." % count)
+
+
+def main(argv=None):
+    settings = load_settings(argv)
+    count, error = run(settings)
+    if error is not None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
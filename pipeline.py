@@ -0,0 +1,115 @@
+""" Pipelined measurement cycle.
+
+vWPV.measure_loop is strictly sequential: search (breath + R wave) --> pulse + Doppler --> latency --> wait for the cuff deflation.
+MeasurementPipeline overlaps the stages of consecutive pulses:
+    - the latency of pulse N is computed by a worker pool while pulse N+1 is being searched
+    - the expiratory phase of pulse N+1 is searched during the deflation (refractory period) of pulse N;
+      pulse N+1 is delivered only when the cuff of pulse N is deflated (vWPV.TriggerWorker)
+Results are delivered in order, to a callback and/or to a queue.
+
+controller.MeasurementController runs the pipeline for GUI_Rpi and headless.py.
+
+Example:
+    ecg_threshold, ECG = vWPV.initialization()
+    pipeline = MeasurementPipeline(ecg_threshold, delay=0, callback=print)
+    pipeline.run(10)
+    pipeline.close()
+"""
+
+import multiprocessing as mp
+import queue
+import signal
+from concurrent.futures import ProcessPoolExecutor
+
+import vWPV
+
+
+def init_worker():
+    """ Latency worker: the signal handlers of the parent (e.g. headless.py) are not inherited.
+    Ctrl-C reaches the whole process group: the parent shuts the pool down """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+class MeasurementPipeline:
+    def __init__(self, ecg_threshold, delay=0, workers=1, callback=None, smoothing_method='lowess', phase=None, engine=None):
+        """ INPUT:
+        - ecg_threshold: threshold for R-wave detection (see vWPV.initialization); it can be set later (before step)
+        - delay: delay between R-wave detection and pressure pulse delivery [s]
+        - workers: number of processes computing the latency
+        - callback: optional function called with each result dict (in the thread calling run/step/flush)
+        - smoothing_method: envelope smoothing engine (see smoothing.SMOOTHERS)
+        - phase: predictive trigger phase (see vWPV.measure_loop), None = pulse "delay" s after the R wave
+        - engine: latency engine (see vWPV.LATENCY_ENGINES), None = vWPV.LATENCY_ENGINE; it can be changed between pulses
+
+        Each result is a dict with keys: index, latency (from the trigger edge), breath, ECG, doppler,
+        and the keys of the Info output of vWPV.measure_loop (see vWPV.measurement_info).
+        Results are also put in self.results (queue.Queue).
+
+        The worker processes are forked here: create the pipeline from the main thread (see vWPV.start_workers).
+        """
+        self.ecg_threshold = ecg_threshold
+        self.delay = delay
+        self.callback = callback
+        self.smoothing_method = smoothing_method
+        self.phase = phase
+        self.engine = engine
+        self.results = queue.Queue()
+        self.pending = []   # [(index, future, breath, ECG, doppler, trigger_time, doppler_start, quality, timing, engine)] in delivery order
+        self.count = 0
+
+        # workers are forked now, so that no fork cost is paid during the cycle
+        self.pool = ProcessPoolExecutor(workers, mp_context=mp.get_context("fork"), initializer=init_worker)
+        for f in [self.pool.submit(int) for i in range(workers)]:
+            f.result()
+
+    def ready(self):
+        """ True when the cuff of the previous pulse is deflated """
+        return not vWPV.trigger_worker.busy()
+
+    def step(self):
+        """ Searches the next trigger point (overlapping the deflation of the previous pulse), delivers the pulse,
+        acquires the Doppler signal and submits the latency computation. Then it delivers the results already available.
+        vWPV.MeasurementInterrupted (see vWPV.interrupt) abandons the search: no pulse is delivered """
+        engine = vWPV.LATENCY_ENGINE if self.engine is None else self.engine
+        latency_function = vWPV.latency_engine(engine)
+        breath, ECG = vWPV.search_trigger_point(self.ecg_threshold, ready=self.ready, refresh_rr=self.phase is not None)
+        while vWPV.trigger_worker.busy():
+            vWPV.check_interrupt()
+            vWPV.trigger_worker.receive(0.05)
+
+        fire_at, timing = vWPV.pulse_timing(self.phase)
+        doppler, trigger_time, doppler_start, quality = vWPV.deliver_pulse(self.delay, fire_at)
+
+        future = self.pool.submit(latency_function, doppler, quality['fs'], self.smoothing_method)
+        self.pending.append((self.count, future, breath, ECG, doppler, trigger_time, doppler_start, quality, timing, engine))
+        self.count += 1
+        self.deliver(wait=False)
+
+    def deliver(self, wait):
+        """ Delivers the results in order. wait=False --> only those already computed """
+        while self.pending and (wait or self.pending[0][1].done()):
+            index, future, breath, ECG, doppler, trigger_time, doppler_start, quality, timing, engine = self.pending.pop(0)
+            latency_from_start, envelope = future.result()
+            latency, uncertainty = vWPV.align_latency(latency_from_start, doppler_start, trigger_time, quality['fs'])
+            print("Computed latency: ", latency, "+/-", uncertainty, "\n\n\n")
+            result = {'index' : index, 'latency' : latency, 'breath' : breath, 'ECG' : ECG, 'doppler' : doppler}
+            result.update(vWPV.measurement_info(trigger_time, doppler_start, latency_from_start, uncertainty, quality, timing, engine))
+            self.results.put(result)
+            if self.callback is not None:
+                self.callback(result)
+
+    def flush(self):
+        """ Waits for all the pending latencies and for the deflation of the last pulse """
+        self.deliver(wait=True)
+        vWPV.trigger_worker.wait_ready()
+
+    def run(self, n_pulses):
+        """ Delivers n_pulses pulses and returns when all their results have been delivered """
+        for i in range(n_pulses):
+            self.step()
+        self.flush()
+
+    def close(self):
+        self.flush()
+        self.pool.shutdown()
@@ -0,0 +1,235 @@
+""" Binary session format, replacing the str(list) text dumps of GUI_Rpi.
+
+Layout of a session file:
+    - file header: MAGIC, version, length of the metadata, metadata (JSON: title, delta x, start time, ...)
+    - chunks, one per acquired signal: CHUNK_DTYPE header followed by the samples
+        (float32 volts, or raw 24 bit codes, 3 bytes each, big endian as read from the ADS1256)
+    - index footer: one INDEX_DTYPE record per chunk (chunk header + offset of the samples), FOOTER_DTYPE trailer
+
+Each chunk header carries the measurement index, the signal ("R" = breath, "E" = ECG, "D" = Doppler), the ADC channel,
+fs (the effective one, see vWPV.check_block), the number of samples lost during the acquisition, the trigger timestamp, the delay, the latency and the vPWV of the measurement (NaN when not applicable).
+Since version 2 it also carries the start of the trigger time window and the time of the first Doppler sample, so that
+the latency recomputed offline from the first Doppler sample can be referred to the trigger edge (see SessionReader.timing
+and vWPV.align_latency). Version 1 files are still read: the new fields are NaN.
+The initial 10 s ECG monitoring is stored as measurement -1; when the measurement is started again in the same session
+(GUI_Rpi: Stop, then Start Chart) each new initialisation gets the next negative index: -2, -3, ...
+
+If the footer is missing (e.g. the program was stopped), SessionReader rebuilds the index scanning the chunk headers.
+The reader maps the file with np.memmap, so any signal can be read without loading the whole session.
+
+Usage:
+    python session.py <session file>      # prints the measurements table
+"""
+
+import json
+import sys
+import time
+
+import numpy as np
+
+MAGIC = b'VPWVSES1'
+VERSION = 2
+CHUNK_MAGIC = b'CHNK'
+FOOTER_MAGIC = b'VPWVIDX1'
+
+FORMATS = {'float32' : 0, 'int24' : 1}
+SCALE = 5.0 / 0x7fffff # volts per code, see vWPV.ADC_reading
+
+CHUNK_DTYPE_V1 = np.dtype([('magic', 'S4'),
+                        ('index', '<i4'),       # measurement index (-1, -2, ... = initial ECG monitoring)
+                        ('signal', 'S1'),       # "R", "E" or "D"
+                        ('channel', 'u1'),      # ADC input channel
+                        ('format', 'u1'),       # see FORMATS
+                        ('missed', '<u4'),      # samples lost during the acquisition (see vWPV.check_block)
+                        ('pad', 'S1'),          # 64 byte header: samples start on 8 byte boundaries
+                        ('fs', '<f8'),          # sampling frequency [Hz]
+                        ('n', '<i8'),           # number of samples
+                        ('trigger_time', '<f8'),# trigger timestamp, time.monotonic() [s]
+                        ('delay', '<f8'),       # delay between R wave and pulse [s]
+                        ('latency', '<f8'),     # [s]
+                        ('vpwv', '<f8'),        # [m/s]
+                       ])
+# 80 byte header, version 2
+CHUNK_DTYPE = np.dtype(CHUNK_DTYPE_V1.descr + [('trigger_start', '<f8'),   # start of the trigger time window (trigger_time = its end) [s]
+                                               ('doppler_start', '<f8'),   # time.monotonic() of the first Doppler sample [s]
+                                              ])
+CHUNK_DTYPES = {1 : CHUNK_DTYPE_V1, 2 : CHUNK_DTYPE}
+INDEX_DTYPE = np.dtype(CHUNK_DTYPE.descr + [('offset', '<i8')]) # offset of the samples in the file
+FOOTER_DTYPE = np.dtype([('index_offset', '<i8'), ('count', '<i8'), ('magic', 'S8')])
+
+
+def to_int24(samples):
+    """ Volts --> raw 24 bit two's complement codes, 3 bytes per sample (MSB first) """
+    codes = np.clip(np.round(np.asarray(samples, dtype=float) / SCALE), -0x800000, 0x7fffff).astype('>i4')
+    return codes.view(np.uint8).reshape(-1, 4)[:, 1:]
+
+
+def from_int24(raw):
+    """ Raw 24 bit codes (n x 3 bytes) --> volts (float32) """
+    b = raw.astype(np.int32)
+    codes = (b[:, 0] << 16) | (b[:, 1] << 8) | b[:, 2]
+    codes = (codes ^ 0x800000) - 0x800000
+    return (codes * SCALE).astype(np.float32)
+
+
+class SessionWriter:
+    def __init__(self, path, metadata=None, sample_format='float32'):
+        """ INPUT:
+        - path: session file, overwritten
+        - metadata: dict saved in the file header (JSON)
+        - sample_format: 'float32' (volts) or 'int24' (raw ADC codes, 25% smaller)
+        """
+        if sample_format not in FORMATS:
+            raise ValueError("Sample format must be one of " + str(list(FORMATS)))
+        self.format = sample_format
+        self.index = []
+        self.f = open(path, 'wb')
+
+        meta = dict(metadata or {})
+        meta.setdefault('created', time.time())
+        meta = json.dumps(meta).encode()
+        meta += b' ' * (-(len(meta) + 16) % 8) # chunks start on 8 byte boundaries
+        self.f.write(MAGIC + np.array([VERSION, len(meta)], dtype='<u4').tobytes() + meta)
+
+    def write_signal(self, index, signal, samples, fs, channel=0, trigger_time=np.nan, delay=np.nan, latency=np.nan, vpwv=np.nan, missed=0,
+                     trigger_start=np.nan, doppler_start=np.nan):
+        """ Appends one signal of measurement "index" as a chunk.
+        trigger_start, trigger_time: time window in which the valve pin was driven HIGH (vWPV.measure_loop, info['trigger_time']);
+        doppler_start: time of the first Doppler sample (info['doppler_start']) """
+        if self.format == 'int24':
+            data = to_int24(samples)
+        else:
+            data = np.asarray(samples, dtype='<f4')
+
+        header = np.zeros(1, dtype=CHUNK_DTYPE)
+        header[0] = (CHUNK_MAGIC, index, signal.encode(), channel, FORMATS[self.format], missed, b'',
+                     fs, len(samples), trigger_time, delay, latency, vpwv, trigger_start, doppler_start)
+        self.f.write(header.tobytes())
+        offset = self.f.tell()
+        self.f.write(data.tobytes())
+        self.f.write(b'\0' * (-data.nbytes % 8))
+
+        entry = np.zeros(1, dtype=INDEX_DTYPE)
+        for name in CHUNK_DTYPE.names:
+            entry[name] = header[name]
+        entry['offset'] = offset
+        self.index.append(entry)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        """ Writes the index footer and closes the file """
+        if self.f is None:
+            return
+        index_offset = self.f.tell()
+        if self.index:
+            self.f.write(np.concatenate(self.index).tobytes())
+        footer = np.array([(index_offset, len(self.index), FOOTER_MAGIC)], dtype=FOOTER_DTYPE)
+        self.f.write(footer.tobytes())
+        self.f.close()
+        self.f = None
+
+
+def upgrade(index):
+    """ Index records of an older version --> INDEX_DTYPE (new fields NaN) """
+    if index.dtype == INDEX_DTYPE:
+        return index
+    out = np.zeros(len(index), dtype=INDEX_DTYPE)
+    for name in INDEX_DTYPE.names:
+        out[name] = index[name] if name in index.dtype.names else np.nan
+    return out
+
+
+class SessionReader:
+    def __init__(self, path):
+        """ Opens a session file with np.memmap.
+        self.metadata: dict saved in the file header
+        self.index: INDEX_DTYPE array, one record per chunk """
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        if bytes(self.data[:8]) != MAGIC:
+            raise ValueError(path + " is not a vPWV session file")
+        version, meta_len = np.frombuffer(self.data[8:16], dtype='<u4')
+        if int(version) not in CHUNK_DTYPES:
+            raise ValueError("%s: unsupported session version %d" % (path, version))
+        self.version = int(version)
+        self.chunk_dtype = CHUNK_DTYPES[self.version]
+        index_dtype = np.dtype(self.chunk_dtype.descr + [('offset', '<i8')])
+        self.metadata = json.loads(bytes(self.data[16:16+meta_len]).decode())
+        self.start = 16 + int(meta_len)
+
+        footer = None
+        if len(self.data) >= self.start + FOOTER_DTYPE.itemsize:
+            footer = np.frombuffer(self.data[-FOOTER_DTYPE.itemsize:], dtype=FOOTER_DTYPE)[0]
+        if footer is not None and footer['magic'] == FOOTER_MAGIC:
+            i = int(footer['index_offset'])
+            index = np.frombuffer(self.data[i:i + int(footer['count'])*index_dtype.itemsize], dtype=index_dtype)
+            self.index = upgrade(index)
+        else:
+            self.index = self.scan()
+
+    def scan(self):
+        """ Rebuilds the index from the chunk headers (file without footer) """
+        entries = []
+        pos = self.start
+        size = self.chunk_dtype.itemsize
+        while pos + size <= len(self.data):
+            header = np.frombuffer(self.data[pos:pos + size], dtype=self.chunk_dtype)[0]
+            if header['magic'] != CHUNK_MAGIC:
+                break
+            nbytes = int(header['n']) * (3 if header['format'] == FORMATS['int24'] else 4)
+            offset = pos + size
+            if offset + nbytes > len(self.data):
+                break # truncated chunk
+            entry = np.zeros(1, dtype=INDEX_DTYPE)
+            for name in CHUNK_DTYPE.names:
+                entry[name] = header[name] if name in self.chunk_dtype.names else np.nan
+            entry['offset'] = offset
+            entries.append(entry)
+            pos = offset + nbytes + (-nbytes % 8)
+        return np.concatenate(entries) if entries else np.zeros(0, dtype=INDEX_DTYPE)
+
+    def measurements(self):
+        """ Measurement indices in the session (negative = initial ECG monitoring of each start, -1 first) """
+        return np.unique(self.index['index'])
+
+    def find(self, index, signal):
+        """ Index record of signal "signal" of measurement "index" """
+        match = np.nonzero((self.index['index'] == index) & (self.index['signal'] == signal.encode()))[0]
+        if match.size == 0:
+            raise KeyError("No signal %s in measurement %d" % (signal, index))
+        return self.index[match[0]]
+
+    def signal(self, index, signal):
+        """ Samples [V] of signal "signal" ("R", "E", "D") of measurement "index".
+        float32 chunks are returned as read-only views on the file, int24 chunks are decoded. """
+        entry = self.find(index, signal)
+        offset, n = int(entry['offset']), int(entry['n'])
+        if entry['format'] == FORMATS['int24']:
+            return from_int24(self.data[offset:offset + 3*n].reshape(n, 3))
+        return self.data[offset:offset + 4*n].view('<f4')
+
+    def timing(self, index):
+        """ Timing of measurement "index" for vWPV.align_latency: (doppler_start, (trigger_start, trigger_time)),
+        None if it was not recorded (version 1 files) """
+        entry = self.find(index, "D")
+        timing = (float(entry['doppler_start']), (float(entry['trigger_start']), float(entry['trigger_time'])))
+        if np.isnan([timing[0]] + list(timing[1])).any():
+            return None
+        return timing
+
+    def table(self):
+        """ One row per measurement (Doppler chunks): index, fs, missed, trigger_time, delay, latency, vpwv """
+        return self.index[self.index['signal'] == b'D'][['index', 'fs', 'missed', 'trigger_time', 'delay', 'latency', 'vpwv']]
+
+    def close(self):
+        self.index = None
+        self.data = None
+
+
+if __name__ == "__main__":
+    reader = SessionReader(sys.argv[1])
+    print(reader.metadata)
+    print("%6s %10s %7s %14s %8s %10s %10s" % ("index", "fs [Hz]", "missed", "trigger [s]", "delay", "latency", "vPWV"))
+    for row in reader.table():
+        print("%6d %10g %7d %14.6f %8.3f %10.5f %10.3f" % tuple(row))
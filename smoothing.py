@@ -0,0 +1,80 @@
+""" Smoothing engines for the Doppler envelope (see vWPV.vPWV_TD_percentage).
+
+All the engines take the signal v and span, the fraction of samples used by the reference LOWESS
+(statsmodels, frac=span, it=0). The fast engines are tuned so that their frequency response has the same -6 dB point
+as the tricube weights of LOWESS with half-width h = span*len(v)/2:
+    - 'lowess'         --> statsmodels LOWESS, reference, O(n*span*n)
+    - 'lowess_fast'    --> statsmodels LOWESS computed every LOWESS_DELTA*n samples and linearly interpolated in between
+    - 'moving_average' --> 3 cascaded moving averages (cumulative sums), O(n)
+    - 'iir'            --> zero-phase 4th order Bessel low-pass (sosfiltfilt), O(n)
+
+The footprint is searched on the flat envelope before the rise, so an engine whose step response rings, or which lets
+through more of the envelope noise, shows bumps there that find_peaks takes for the first peak (latency errors of
+hundreds of ms on some traces). For this reason there is no Savitzky-Golay engine: with any window its negative lobes read
+up to 350 ms early on synthetic traces, and 'iir' is a Bessel filter (a 2nd order Butterworth read 20 ms early on
+average, 215 ms at most).
+The accuracy of each engine with respect to 'lowess' can be checked with smoothing_accuracy.py
+"""
+
+import numpy as np
+
+LOWESS_DELTA = 0.005        # 'lowess_fast': distance between the points where LOWESS is computed, fraction of len(v)
+MOVING_AVERAGE_WIDTH = 0.76 # 'moving_average': each window = 0.76*h (3 cascaded windows have the variance of the tricube weights)
+IIR_ORDER = 4               # 'iir': order of the Bessel filter
+IIR_CUTOFF = 1.0            # 'iir': cutoff = 1.0/h (normalized to Nyquist frequency, -3 dB of each pass)
+
+
+def half_width(n, span):
+    """ Half-width [samples] of the LOWESS window """
+    return max(1.0, span * n / 2)
+
+
+def lowess(v, span):
+    import statsmodels.api as sm
+    points = np.arange(0, len(v), 1)
+    return sm.nonparametric.lowess(v, points, frac=span, it=0, is_sorted=True)[:, 1]
+
+
+def lowess_fast(v, span):
+    import statsmodels.api as sm
+    points = np.arange(0, len(v), 1)
+    return sm.nonparametric.lowess(v, points, frac=span, it=0, is_sorted=True, delta=LOWESS_DELTA*len(v))[:, 1]
+
+
+def moving_average(v, span, passes=3):
+    w = max(1, int(round(MOVING_AVERAGE_WIDTH * half_width(len(v), span))))
+    s = np.asarray(v, dtype=float)
+    for i in range(passes):
+        padded = np.pad(s, (w//2, w - 1 - w//2), mode='edge')
+        c = np.concatenate(([0.0], np.cumsum(padded)))
+        s = (c[w:] - c[:-w]) / w
+    return s
+
+
+def iir(v, span):
+    from scipy.signal import bessel, sosfiltfilt
+    sos = bessel(IIR_ORDER, min(0.99, IIR_CUTOFF / half_width(len(v), span)), output='sos', norm='mag')
+    return sosfiltfilt(sos, v)
+
+
+SMOOTHERS = {'lowess' : lowess,
+             'lowess_fast' : lowess_fast,
+             'moving_average' : moving_average,
+             'iir' : iir,
+            }
+
+
+def smooth(v, span, method='lowess'):
+    """ Smooths v with the engine "method" (see SMOOTHERS)
+
+    INPUT:
+    - v: signal
+    - span: fraction of samples of the LOWESS window. As this value increases, the smoothing increases.
+    - method: smoothing engine
+
+    OUTPUT:
+    - smoothed signal, same length as v
+    """
+    if method not in SMOOTHERS:
+        raise ValueError("Smoothing method must be one of " + str(list(SMOOTHERS)))
+    return SMOOTHERS[method](v, span)
@@ -0,0 +1,159 @@
+""" Accuracy harness for the smoothing engines of smoothing.py and the latency engines of vWPV.LATENCY_ENGINES.
+
+For each Doppler trace it computes the latency with every latency engine (vPWV_TD_percentage, vPWV_FD_percentage) and
+every smoothing engine, and it reports how far each latency is from the reference (time-domain envelope with full LOWESS),
+together with the run time. For synthetic traces the error from the true latency is reported as well:
+the wall-motion traces (wall_motion_doppler) show the engines' robustness to a large low-frequency vessel wall component.
+For session files recording the trigger and Doppler start times the latencies are referred to the valve trigger edge
+(vWPV.align_latency), as in vWPV.measure_loop; otherwise they are measured from the first Doppler sample.
+
+Inputs can be binary session files (session.py, the Doppler signal of every measurement) or the old GUI_Rpi text dumps,
+as for batch.py.
+
+Usage:
+    python smoothing_accuracy.py session_<title>.vpwv [...]     # recorded sessions
+    python smoothing_accuracy.py doppler_<title>.txt [...]      # recorded traces (one str(list) per line, as saved by GUI_Rpi)
+    python smoothing_accuracy.py --synthetic 50                 # synthetic traces
+    python smoothing_accuracy.py --wall 20 --engine td,stft,stft_mean --methods moving_average
+"""
+
+import argparse
+import os
+import time
+
+import numpy as np
+
+# the analysis does not need the acquisition hardware
+os.environ.setdefault("VPWV_BACKEND", "sim")
+
+
+def load_text_dump(path):
+    """ Reads a text dump written by GUI_Rpi (one str(list) per line) and returns the list of traces """
+    traces = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 2:
+                traces.append(np.array(line[1:-1].split(','), dtype=float))
+    return traces
+
+
+def load_session(path):
+    """ Reads the Doppler signals of a session file (session.SessionReader).
+    Returns a list of traces: dicts with x (samples), fs (the one recorded for the measurement) and timing
+    (see session.SessionReader.timing, None if not recorded) """
+    import session
+    reader = session.SessionReader(path)
+    traces = []
+    for index in reader.index['index'][reader.index['signal'] == b'D']:
+        entry = reader.find(int(index), "D")
+        traces.append({'x' : np.array(reader.signal(int(index), "D"), dtype=float), 'fs' : float(entry['fs']),
+                       'timing' : reader.timing(int(index))})
+    reader.close()
+    return traces
+
+
+def load_traces(path, fs):
+    """ Traces (see load_session) of a session file or of a text dump (sampled at fs [Hz]) """
+    try:
+        return load_session(path)
+    except ValueError: # not a session file
+        return [{'x' : x, 'fs' : fs} for x in load_text_dump(path)]
+
+
+def synthetic_doppler(fs=15000, latency=0.3, duration=1.0, noise=0.02, rng=None):
+    """ Synthetic Doppler shift signal: a sinusoid whose envelope rises at "latency" [s] and then decays, plus noise """
+    rng = np.random.default_rng() if rng is None else rng
+    t = np.arange(int(duration * fs)) / fs
+    envelope = np.clip((t - latency) / 0.1, 0, 1) * np.exp(-np.clip(t - latency - 0.1, 0, None) * 5)
+    return envelope * np.sin(2 * np.pi * 800 * t) + noise * rng.normal(size=len(t))
+
+
+def wall_motion_doppler(fs=15000, latency=0.3, duration=1.0, noise=0.05, wall=0.3, rng=None):
+    """ synthetic_doppler plus the vessel wall motion: a large 3 Hz component, amplitude modulated at 1.3 Hz (clutter that
+    the wall filter of vPWV_FD_percentage removes, but which dominates the time-domain envelope of vPWV_TD_percentage) """
+    rng = np.random.default_rng() if rng is None else rng
+    x = synthetic_doppler(fs, latency, duration, noise, rng)
+    t = np.arange(len(x)) / fs
+    return x + wall * np.sin(2 * np.pi * 3 * t + rng.uniform(0, 2 * np.pi)) * (1 + np.sin(2 * np.pi * 1.3 * t))
+
+
+def compare(traces, methods, engines=('td',)):
+    """ Latency error [s] with respect to the reference ('td' engine with 'lowess'), run time [s], latency [s]
+    and error from the true latency [s] of each latency engine and smoothing method.
+    traces: list of dicts with x (samples), fs and optionally timing (see load_traces) and latency (true latency
+    of synthetic traces [s]). The latencies are referred to the trigger edge when the timing is known (vWPV.align_latency).
+    Returns a dict: (engine, method) --> (errors, times, latencies, true_errors) """
+    import vWPV
+
+    results = dict(((e, m), ([], [], [], [])) for e in engines for m in methods)
+    for trace in traces:
+        x, fs, timing = trace['x'], trace['fs'], trace.get('timing')
+
+        def align(latency):
+            return latency if timing is None else vWPV.align_latency(latency, timing[0], timing[1], fs)[0]
+
+        t = time.perf_counter()
+        reference, _ = vWPV.vPWV_TD_percentage(x, fs, 'lowess')
+        reference_time = time.perf_counter() - t
+        reference = align(reference)
+        for e in engines:
+            latency_function = vWPV.latency_engine(e)
+            for m in methods:
+                if e == 'td' and m == 'lowess':
+                    latency, elapsed = reference, reference_time
+                else:
+                    t = time.perf_counter()
+                    latency, _ = latency_function(x, fs, m)
+                    elapsed = time.perf_counter() - t
+                    latency = align(latency)
+                errors, times, latencies, true_errors = results[(e, m)]
+                errors.append(latency - reference)
+                times.append(elapsed)
+                latencies.append(latency)
+                if 'latency' in trace:
+                    true_errors.append(latency - trace['latency'])
+    return results
+
+
+def main(argv=None):
+    import smoothing
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('files', nargs='*', help='session files or Doppler text dumps')
+    parser.add_argument('--fs', type=float, default=15000, help='sampling frequency of text dumps and synthetic traces [Hz] (default 15000)')
+    parser.add_argument('--synthetic', type=int, default=0, help='number of synthetic traces to add')
+    parser.add_argument('--wall', type=int, default=0, help='number of synthetic traces with vessel wall motion to add')
+    parser.add_argument('--methods', default=','.join(smoothing.SMOOTHERS), help='comma separated smoothing engines')
+    parser.add_argument('--engine', default='td', help='comma separated latency engines: td, stft, stft_mean (see vWPV.LATENCY_ENGINES)')
+    args = parser.parse_args(argv)
+
+    traces = []
+    for path in args.files:
+        traces.extend(load_traces(path, args.fs))
+    rng = np.random.default_rng(0)
+    for i in range(args.synthetic):
+        latency = rng.uniform(0.15, 0.5)
+        traces.append({'x' : synthetic_doppler(int(args.fs), latency=latency, rng=rng), 'fs' : args.fs, 'latency' : latency})
+    for i in range(args.wall):
+        latency = rng.uniform(0.2, 0.6)
+        traces.append({'x' : wall_motion_doppler(int(args.fs), latency=latency, rng=rng), 'fs' : args.fs, 'latency' : latency})
+    if not traces:
+        parser.error("no traces: give some files or --synthetic N or --wall N")
+
+    results = compare(traces, args.methods.split(','), args.engine.split(','))
+
+    print("%d traces. Latency error with respect to td + full LOWESS, and from the true latency of the synthetic traces [ms]:" % len(traces))
+    print("%-10s %-16s %9s %9s %9s %9s %12s %14s %10s %9s" % ("engine", "method", "mean", "mean|e|", "p95|e|", "max|e|", "time [ms]",
+                                                               "latency [ms]", "true mean", "true sd"))
+    for (engine, m), (errors, times, latencies, true_errors) in results.items():
+        e = np.array(errors) * 1000
+        a = np.abs(e)
+        true_e = np.array(true_errors) * 1000 if true_errors else np.full(1, np.nan)
+        print("%-10s %-16s %9.3f %9.3f %9.3f %9.3f %12.2f %14.1f %10.1f %9.1f" % (engine, m, e.mean(), a.mean(), np.percentile(a, 95), a.max(),
+                                                                              np.mean(times) * 1000, np.mean(latencies) * 1000,
+                                                                              true_e.mean(), true_e.std()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+""" ADS1256 driver (ADS1256new.py) on the simulated chip (ADS1256sim.py).
+
+Usage:
+    python -m pytest -q test_ADS1256new.py
+"""
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+# the tests run on the emulated ADS1256
+os.environ.setdefault("VPWV_BACKEND", "sim")
+
+import ADS1256new
+import config
+
+CH = 2
+GAIN = ADS1256new.ADS1256_GAIN_E['ADS1256_GAIN_1']
+DRATE = ADS1256new.ADS1256_DRATE_E['ADS1256_15000SPS']
+
+
+@pytest.fixture
+def adc():
+    """ Initialised ADS1256 on the emulated chip, conversions not paced (every read returns the next sample) """
+    if config.BACKEND != "sim":
+        pytest.skip("the tests drive the emulated chip")
+    realtime = config.chip.realtime
+    channels = dict(config.chip.channels)
+    config.chip.realtime = False
+    adc = ADS1256new.ADS1256()
+    assert adc.ADS1256_init(GAIN, DRATE, CH) == 0
+    yield adc
+    config.chip.realtime = realtime
+    config.chip.channels.clear()
+    config.chip.channels.update(channels)
+
+
+def start_rdatac(adc):
+    """ As vWPV.ADC_configuration: RDATAC with CS left LOW """
+    adc.ADS1256_WaitDRDY()
+    config.digital_write(config.CS_PIN, config.GPIO.LOW)
+    config.spi_writebyte([ADS1256new.CMD['CMD_RDATAC']])
+
+
+def stop_rdatac(adc):
+    adc.ADS1256_WaitDRDY()
+    adc.ADS1256_WriteCmd(ADS1256new.CMD['CMD_SDATAC'])
+
+
+def test_read_block_decodes_24_bit_codes(adc):
+    # full scale codes 0x800000 (-5 V * 0x800000/0x7fffff, clipped) and 0x7FFFFF (+5 V), around zero and one code
+    codes = np.array([-0x800000, 0x7fffff, 0, -1, 1, -0x7fffff, 0x123456, -0x123456])
+    config.chip.set_channel(CH, list(codes * 5.0 / 0x7fffff))
+    start_rdatac(adc)
+    n = 3 * len(codes) + 1 # not a multiple of the pattern, nor of TIMESTAMP_EVERY
+    raw = adc.ADS1256_ReadBlock(n, dtype=np.int32)
+    volts = adc.ADS1256_ReadBlock(n)
+    stop_rdatac(adc)
+
+    # the pattern is played back in a loop: align it on the first code read
+    first = int(np.nonzero(codes == raw[0])[0][0])
+    expected = np.resize(np.roll(codes, -first), n)
+    assert raw.dtype == np.int32
+    np.testing.assert_array_equal(raw, expected)
+    # the second block goes on where the first one ended
+    expected = np.resize(np.roll(codes, -(first + n)), n)
+    assert volts.dtype == np.float32
+    np.testing.assert_allclose(volts, expected * 5.0 / 0x7fffff, rtol=1e-7)
+
+
+def test_read_block_fills_out(adc):
+    config.chip.set_channel(CH, [1.0, -1.0])
+    start_rdatac(adc)
+    out = np.zeros(10, dtype=np.float64)
+    x = adc.ADS1256_ReadBlock(6, out=out)
+    stop_rdatac(adc)
+    assert np.shares_memory(x, out)
+    np.testing.assert_allclose(np.abs(out[:6]), round(0x7fffff / 5.0) * 5.0 / 0x7fffff)
+    np.testing.assert_array_equal(out[6:], 0)
+
+
+@pytest.mark.parametrize("mode", ADS1256new.DRDY_MODES)
+def test_wait_drdy_times_out_on_the_clock(adc, mode):
+    # the chip converts at 2.5 SPS (DRDY HIGH for 400 ms) while the driver expects 15 kSPS: 5 ms timeout
+    config.chip.realtime = True
+    adc.ADS1256_SetDRDYMode(mode)
+    adc.ADS1256_WriteRegs(ADS1256new.REG_E['REG_DRATE'], [ADS1256new.ADS1256_DRATE_E['ADS1256_2d5SPS']]) # restarts the conversions
+    adc.ADS1256_ResetDRDYStats()
+    t = time.perf_counter()
+    assert adc.ADS1256_WaitDRDY() == -1
+    elapsed = time.perf_counter() - t
+    assert ADS1256new.DRDY_TIMEOUT_MIN_US * 1e-6 <= elapsed < 0.2
+    stats = adc.ADS1256_DRDYStats()
+    assert stats['timeouts'] == 1 and stats['waits'] == 0
+
+
+@pytest.mark.parametrize("mode", ADS1256new.DRDY_MODES)
+def test_wait_drdy_waits_for_the_conversion(adc, mode):
+    config.chip.realtime = True
+    adc.ADS1256_SetDRDYMode(mode)
+    drate = ADS1256new.ADS1256_DRATE_E['ADS1256_2d5SPS']
+    adc.ADS1256_WriteRegs(ADS1256new.REG_E['REG_DRATE'], [drate])
+    adc.drate = drate # timeout: 4 conversion periods
+    adc.ADS1256_ResetDRDYStats()
+    assert adc.ADS1256_WaitDRDY() == 0
+    stats = adc.ADS1256_DRDYStats()
+    assert stats['timeouts'] == 0 and stats['waits'] == 1
+    assert 0.3e6 < stats['max_us'] < 0.6e6 # first conversion after 400 ms
+    assert stats['hist'][-1] == 1 # longer than the last edge (100 ms)
+
+
+def test_sample_times_account_for_lost_samples(adc):
+    # 15 kSPS block of 256 samples, one timestamp every 64; 5 conversions lost between the second and the third timestamp
+    fs = 15000.0
+    index = np.array([0, 64, 128, 192])
+    delay = np.array([0.0, 20e-6, 10e-6, 30e-6]) # scheduling: the timestamps are only late
+    adc.timestamps = np.column_stack([index, 10.0 + (index + [0, 0, 5, 5]) / fs + delay])
+    np.testing.assert_array_equal(adc.ADS1256_MissedSamples(), [0, 0, 5, 5])
+
+    times, t0 = adc.ADS1256_SampleTimes(256)
+    assert t0 == pytest.approx(10.0)
+    np.testing.assert_allclose(times[:128], 10.0 + np.arange(128) / fs)
+    np.testing.assert_allclose(times[128:], 10.0 + (np.arange(128, 256) + 5) / fs)
+    assert len(adc.ADS1256_SampleTimes()[0]) == 193 # up to the last timestamp
+
+    quality = adc.ADS1256_BlockQuality()
+    assert quality['fs_nominal'] == fs and quality['missed'] == 5 and quality['gaps'] == [(128, 5)]
+    assert quality['fs_measured'] < fs
+
+
+def test_sample_times_of_a_real_block(adc):
+    config.chip.set_channel(CH, [0.0])
+    start_rdatac(adc)
+    n = 3 * ADS1256new.TIMESTAMP_EVERY
+    adc.ADS1256_ReadBlock(n)
+    stop_rdatac(adc)
+    assert len(adc.timestamps) == n // ADS1256new.TIMESTAMP_EVERY
+    times, t0 = adc.ADS1256_SampleTimes(n)
+    assert times[0] == t0 <= adc.timestamps[0, 1]
+    assert np.all(np.diff(times) > 0)
+
+
+def test_write_regs_skips_the_registers_already_written(adc):
+    mux = ADS1256new.REG_E['REG_MUX']
+    config.chip.regs[mux] = 0x77 # changed behind the driver: the shadow copy still holds the value written by init
+    assert adc.ADS1256_WriteRegs(mux, [adc.regs[mux]]) == 0
+    assert config.chip.regs[mux] == 0x77 # nothing sent
+    assert adc.ADS1256_WriteRegs(mux, [adc.regs[mux]], force=True) == 0
+    assert config.chip.regs[mux] == adc.regs[mux]
+
+
+def test_write_regs_sends_the_changed_range(adc):
+    # STATUS, MUX, ADCON, DRATE with MUX and DRATE changed: MUX..DRATE are written, STATUS is not
+    status, mux, adcon = (ADS1256new.REG_E[r] for r in ('REG_STATUS', 'REG_MUX', 'REG_ADCON'))
+    values = adc.regs[status:adcon + 2]
+    values[mux] = (3 << 4) | 0x08
+    values[-1] = ADS1256new.ADS1256_DRATE_E['ADS1256_1000SPS']
+    config.chip.regs[status] = config.chip.regs[status] ^ 0x08 # BUFEN: not in the written range
+    config.chip.regs[adcon] = config.chip.regs[adcon] ^ 0x01   # PGA: unchanged, but between MUX and DRATE
+    assert adc.ADS1256_WriteRegs(status, values) == 0
+    assert config.chip.regs[status] == adc.regs[status] ^ 0x08
+    assert config.chip.regs[mux:adcon + 2] == values[mux:]
+    assert adc.regs[status:adcon + 2] == values
+
+
+def test_write_regs_verify_failure_forgets_the_shadow(adc):
+    # in RDATAC mode the chip ignores WREG and RREG: the readback does not match
+    mux = ADS1256new.REG_E['REG_MUX']
+    start_rdatac(adc)
+    assert adc.ADS1256_WriteRegs(mux, [(3 << 4) | 0x08]) == -1
+    stop_rdatac(adc)
+    assert adc.regs[mux] is None
+    # the unknown register is written again, and verified, on the next call
+    assert adc.ADS1256_WriteRegs(mux, [(3 << 4) | 0x08]) == 0
+    assert adc.regs[mux] == config.chip.regs[mux] == (3 << 4) | 0x08
@@ -0,0 +1,53 @@
+""" vPWV chart of the GUI (GUI_Rpi.Plot2D): incremental updates and blitting. It needs a display (skipped otherwise).
+
+Usage:
+    python -m pytest -q test_GUI_Rpi.py
+"""
+
+import os
+import tkinter as tk
+
+import pytest
+
+os.environ.setdefault("VPWV_BACKEND", "sim")
+
+pytest.importorskip("matplotlib")
+
+import GUI_Rpi
+
+
+@pytest.fixture
+def root():
+    try:
+        root = tk.Tk()
+    except tk.TclError:
+        pytest.skip("no display")
+    yield root
+    root.destroy()
+
+
+def test_plot_redraws_only_when_the_axis_moves(root):
+    plot = GUI_Rpi.Plot2D(root)
+    plot.pack()
+    root.update()
+
+    plot.trace([0, 1, 2], [5, 6, 7])
+    assert plot.dirty and plot.full
+    assert plot.a.get_xlim() == (-5, 12) # one window of margin on the right
+    plot.refresh()
+    assert not plot.dirty and not plot.full
+    assert plot.background is not None # saved by the full redraw
+
+    # a point inside the x axis: the line is blitted on the saved background
+    background = plot.background
+    plot.trace([0, 1, 2, 3], [5, 6, 7, 8])
+    assert plot.dirty and not plot.full
+    plot.refresh()
+    assert not plot.dirty and plot.background is background
+    assert list(plot.line1.get_xdata()) == [0, 1, 2, 3] and len(plot.a.lines) == 1
+
+    # a point out of the x axis: full redraw
+    plot.trace([0, 1, 2, 3, 20], [5, 6, 7, 8, 9])
+    assert plot.full and plot.a.get_xlim() == (-5, 45)
+    plot.refresh()
+    assert not plot.full and plot.background is not background
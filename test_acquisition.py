@@ -0,0 +1,104 @@
+""" Shared-memory ring buffer and readers of the acquisition engine (acquisition.py).
+
+Usage:
+    python -m pytest -q test_acquisition.py
+"""
+
+import os
+
+import numpy as np
+import pytest
+
+os.environ.setdefault("VPWV_BACKEND", "sim")
+
+import acquisition
+
+
+@pytest.fixture
+def ring():
+    ring = acquisition.RingBuffer(capacity=16)
+    yield ring
+    ring.close()
+
+
+def write(ring, ch, first, n):
+    """ Writes n samples with value = seq = first, first+1, ... """
+    seq = np.arange(first, first + n)
+    return ring.write(ch, seq.astype(float), seq / 1000, seq)
+
+
+def values(blocks):
+    return np.concatenate([b['value'] for b in blocks]) if blocks else np.zeros(0)
+
+
+def test_write_wraps_around(ring):
+    assert write(ring, 2, 0, 10) == 0
+    assert write(ring, 2, 10, 10) == 10 # positions 10..19: 6 at the end of the ring, 4 at the start
+    assert ring.count() == 20
+    blocks = ring.views(10, 20)
+    assert [len(b) for b in blocks] == [6, 4]
+    np.testing.assert_array_equal(values(blocks), np.arange(10, 20))
+    np.testing.assert_array_equal(np.concatenate([b['seq'] for b in blocks]), np.arange(10, 20))
+    # overwritten samples are skipped: only the last 16 are kept
+    np.testing.assert_array_equal(values(ring.views(0, 20)), np.arange(4, 20))
+
+
+def test_write_longer_than_the_ring(ring):
+    assert write(ring, 2, 0, 40) == 24 # only the last 16 samples are written
+    assert ring.count() == 40
+    np.testing.assert_array_equal(values(ring.views(0, 40)), np.arange(24, 40))
+
+
+def test_reader_counts_dropped_samples(ring):
+    reader = acquisition.RingReader(ring, start=0)
+    write(ring, 2, 0, 10)
+    np.testing.assert_array_equal(values(reader.poll()), np.arange(10))
+    assert reader.poll() == []
+    write(ring, 2, 10, 30) # 14 samples overwritten before being read
+    np.testing.assert_array_equal(values(reader.poll()), np.arange(24, 40))
+    assert reader.dropped == 14
+    # a reader created now only sees the new samples
+    late = acquisition.RingReader(ring)
+    write(ring, 2, 40, 3)
+    np.testing.assert_array_equal(values(late.poll()), [40, 41, 42])
+
+
+def test_signal_reader_follows_one_channel(ring):
+    write(ring, 7, 0, 5)
+    reader = acquisition.SignalReader(ring, {'ch' : 4, 'fs' : 500, 'start' : ring.count()})
+    write(ring, 7, 5, 3)  # samples of the previous signal, written after the acquire
+    write(ring, 4, 8, 12) # wraps around
+    seq, t, value = reader.read(10)
+    np.testing.assert_array_equal(seq, np.arange(8, 18))
+    np.testing.assert_array_equal(value, np.arange(8, 18))
+    np.testing.assert_allclose(t, np.arange(8, 18) / 1000)
+    # the samples after the first n are not lost
+    seq, t, value = reader.read(2)
+    np.testing.assert_array_equal(seq, [18, 19])
+    write(ring, 4, 20, 1)
+    np.testing.assert_array_equal(values(reader.wait(0)), [20])
+    assert reader.wait(0.01) == []
+
+
+def test_attached_ring_shares_the_samples(ring):
+    other = acquisition.RingBuffer(name=ring.name)
+    try:
+        assert other.capacity == ring.capacity
+        write(ring, 2, 0, 20)
+        assert other.count() == 20
+        np.testing.assert_array_equal(values(other.views(4, 20)), np.arange(4, 20))
+    finally:
+        other.close()
+
+
+def test_sequence_clock_counts_lost_conversions():
+    fs = 1000.0
+    clock = acquisition.SequenceClock(fs, seq=100)
+    # one timestamp every 64 samples; 3 conversions lost before the third one, the timestamps late by less than a period
+    timestamps = np.array([[0, 10.0 + 0.0002], [64, 10.064 + 0.0004], [128, 10.131 + 0.0003], [192, 10.195]])
+    seq, t, lost = clock.block(256, timestamps)
+    assert lost == 3
+    np.testing.assert_array_equal(seq[:128], 100 + np.arange(128))
+    np.testing.assert_array_equal(seq[128:], 103 + np.arange(128, 256))
+    np.testing.assert_allclose(np.diff(t[128:]), 1 / fs)
+    assert clock.seq == seq[-1] + 1 # the next block goes on from here
@@ -0,0 +1,63 @@
+""" Measurement controller (controller.py) on the simulated hardware: events posted by the measurement thread.
+
+Usage:
+    python -m pytest -q test_controller.py
+"""
+
+import os
+import time
+
+import pytest
+
+os.environ.setdefault("VPWV_BACKEND", "sim")
+
+import config
+import controller
+import vWPV
+
+
+def wait_event(ctrl, kind, timeout=10):
+    """ Polls the controller until an event of the given kind is posted. Returns the events polled """
+    events = []
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        events += list(ctrl.poll())
+        if any(event[0] == kind for event in events):
+            return events
+        time.sleep(0.01)
+    raise AssertionError("no %r event in %s" % (kind, [event[0] for event in events]))
+
+
+@pytest.fixture
+def ctrl():
+    if config.BACKEND != "sim":
+        pytest.skip("the test forks the trigger and acquisition processes on the simulated hardware")
+    ctrl = controller.MeasurementController(delay=0)
+    yield ctrl
+    ctrl.cancel()
+    ctrl.join(5)
+    vWPV.stop_workers()
+
+
+def test_cancel_during_the_initialisation(ctrl):
+    ctrl.start()
+    events = wait_event(ctrl, "state")
+    assert events[0] == ("state", "Initialization: ECG monitoring (10 s).")
+    ctrl.cancel() # the 10 s ECG monitoring is abandoned at once
+    events = wait_event(ctrl, "stopped", timeout=5)
+    ctrl.join(1)
+    assert not ctrl.alive()
+    assert [event[0] for event in events] == ["stopped"]
+    assert ctrl.done == 0 and vWPV.interrupt is None
+
+
+def test_pause_during_the_initialisation(ctrl):
+    ctrl.start()
+    wait_event(ctrl, "state")
+    ctrl.pause()
+    wait_event(ctrl, "paused", timeout=5)
+    assert ctrl.alive()
+    # the interrupted initialisation is repeated on resume
+    ctrl.resume()
+    events = wait_event(ctrl, "state", timeout=5)
+    assert ("state", "Initialization: ECG monitoring (10 s).") in events
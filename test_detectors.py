@@ -0,0 +1,185 @@
+""" Streaming detectors (detectors.py): equivalence with the code they replaced (baseline vWPV.py) and synthetic signals.
+
+Usage:
+    python -m pytest -q test_detectors.py
+"""
+
+import numpy as np
+import pytest
+
+import detectors
+
+
+def baseline_expiration(samples, fs_r):
+    """ Expiratory phase detection of the baseline search_trigger_point (list-based), on a recorded breath signal.
+    Returns the index of the sample at which the expiratory phase is detected (None if it is not) """
+    num_samples = 5
+    refresh_time = 1 * fs_r
+    breath = list(samples[:fs_r*5])
+    breath_threshold = np.mean(breath)
+
+    for i in range(fs_r*5, len(samples)):
+        breath.append(samples[i])
+
+        if (len(breath) % refresh_time == 0): #threshold update
+            breath5s = breath[-5*fs_r:] #consider the last 5 seconds
+            breath_threshold = np.mean(breath5s)
+
+        pre = breath[len(breath)-num_samples*2:len(breath)-num_samples]
+        post = breath[len(breath)-num_samples:len(breath)]
+
+        if np.amin(pre) >= breath_threshold and np.amax(post) <= breath_threshold:
+            return i
+    return None
+
+
+def streaming_expiration(samples, fs_r):
+    expiration = detectors.ExpirationDetector(fs_r, window=5, refresh=1, num_samples=5)
+    for i, sample in enumerate(samples):
+        if expiration.push(sample):
+            return i
+    return None
+
+
+def breath_signal(rng, fs_r=50, duration=30):
+    """ Breathing (3-6 s period, random phase) plus noise """
+    t = np.arange(duration * fs_r) / fs_r
+    period = rng.uniform(3, 6)
+    return np.sin(2*np.pi*t/period + rng.uniform(0, 2*np.pi)) + rng.uniform(0, 0.3)*rng.normal(size=len(t))
+
+
+def test_expiration_detector_matches_baseline():
+    rng = np.random.default_rng(0)
+    detected = 0
+    for trial in range(200):
+        x = breath_signal(rng)
+        expected = baseline_expiration(x, 50)
+        assert streaming_expiration(x, 50) == expected, "trial %d" % trial
+        detected += expected is not None
+    assert detected > 100
+
+
+def test_expiration_detector_matches_baseline_on_restarted_search():
+    # each search starts with a fresh detector (the baseline started from 5 s of new breath as well)
+    rng = np.random.default_rng(1)
+    x = breath_signal(rng, duration=120)
+    start = 0
+    while start < len(x):
+        expected = baseline_expiration(x[start:], 50)
+        assert streaming_expiration(x[start:], 50) == expected
+        if expected is None:
+            break
+        start += expected + 1
+
+
+def test_expiration_window_is_last_five_seconds():
+    rng = np.random.default_rng(2)
+    x = breath_signal(rng)
+    expiration = detectors.ExpirationDetector(50)
+    for i, sample in enumerate(x):
+        if expiration.push(sample):
+            break
+    np.testing.assert_array_equal(expiration.window(), x[i+1-250:i+1])
+
+
+
+def test_outlier_filter_flags_spikes():
+    values = 5 + 0.1*np.sin(np.arange(40))
+    values[[15, 30]] = 9
+    f = detectors.OutlierFilter(w_size=20)
+    flags = np.array([f.push(v) for v in values])
+    np.testing.assert_array_equal(np.nonzero(flags)[0], [15, 30])
+
+
+def test_outlier_filter_rebaselines_after_level_change():
+    values = np.concatenate([5 + 0.1*np.sin(np.arange(20)), 8 + 0.1*np.sin(np.arange(20))])
+    f = detectors.OutlierFilter(w_size=20, rebaseline=3)
+    flags = np.array([f.push(v) for v in values])
+    np.testing.assert_array_equal(flags, [False]*20 + [True, True] + [False]*18)
+    # rebaseline=0: the filter keeps the previous level
+    f = detectors.OutlierFilter(w_size=20, rebaseline=0)
+    flags = np.array([f.push(v) for v in values])
+    np.testing.assert_array_equal(flags, [False]*20 + [True]*20)
+
+
+def ecg_signal(rng, fs=500, duration=20, rr=0.8):
+    """ R waves (10 ms gaussians, RR +-5 %) and T waves 250 ms later, baseline wander and noise. Returns the signal and the R wave times """
+    t = np.arange(int(duration * fs)) / fs
+    beats = np.cumsum(rr * (1 + 0.05 * rng.uniform(-1, 1, int(duration / rr) + 2)))
+    beats = beats[beats < duration - 0.5]
+    x = 0.1 * np.sin(2*np.pi*0.25*t) + 0.02 * rng.normal(size=len(t))
+    for beat in beats:
+        x += np.exp(-0.5 * ((t - beat) / 0.01)**2) + 0.3 * np.exp(-0.5 * ((t - beat - 0.25) / 0.04)**2)
+    return x, beats
+
+
+def test_r_wave_detector_finds_every_beat():
+    rng = np.random.default_rng(4)
+    fs = 500
+    for trial in range(5):
+        x, beats = ecg_signal(rng, fs)
+        detector = detectors.RWaveDetector(fs)
+        detected = np.array([i / fs for i, sample in enumerate(x) if detector.push(sample)])
+        beats = beats[beats > 2 + 0.1] # learning phase, then the filter holdoff
+        assert len(detected) == len(beats), "trial %d" % trial # no T wave, no missed beat
+        # detection on the upstroke of the R wave
+        assert np.all(np.abs(detected - beats) < 0.02)
+
+
+def test_r_wave_detector_restart_keeps_the_levels():
+    rng = np.random.default_rng(5)
+    fs = 500
+    x, beats = ecg_signal(rng, fs)
+    detector = detectors.RWaveDetector(fs)
+    for sample in x[:5*fs]:
+        detector.push(sample)
+    # a later segment: detections start after the filter holdoff, with no new learning phase
+    start = 10 * fs + 123
+    detector.restart(x[start])
+    detected = np.array([(start + i) / fs for i, sample in enumerate(x[start:]) if detector.push(sample)])
+    beats = beats[beats > start / fs + 0.05] # integration window holdoff (30 ms), band-pass settling
+    assert len(detected) == len(beats)
+    assert np.all(np.abs(detected - beats) < 0.02)
+
+
+def test_rr_tracker_uses_consecutive_beats_only():
+    tracker = detectors.RRTracker(min_intervals=3, max_age=60)
+    assert not tracker.push(10.0) # first beat: no interval
+    assert tracker.push(10.8) and tracker.push(11.6)
+    assert not tracker.ready(11.6) # 2 intervals
+    assert tracker.push(12.4)
+    assert tracker.ready(12.4) and tracker.rr() == pytest.approx(0.8) and tracker.rr_std() == pytest.approx(0)
+    assert tracker.predict(12.5) == pytest.approx(13.2)
+    assert tracker.predict(13.3) == pytest.approx(14.0) # the first R wave after t
+
+    # one beat per trigger search: 3 RR intervals (k = 3) are not averaged, the prediction error is recorded
+    assert not tracker.push(14.85)
+    assert tracker.last_predicted == pytest.approx(14.8)
+    assert tracker.rr() == pytest.approx(0.8) and tracker.updated == 12.4
+    # the next consecutive interval is accepted, an interval too far from the estimate is not
+    assert tracker.push(15.7) and tracker.rr() == pytest.approx((3 * 0.8 + 0.85) / 4)
+    assert not tracker.push(15.7 + 0.5)
+
+
+def test_rr_tracker_first_interval_in_range():
+    tracker = detectors.RRTracker(min_rr=0.3, max_rr=2.0)
+    tracker.push(0.0)
+    assert not tracker.push(2.5) # a missed beat, or no beat: not a first estimate
+    assert not tracker.push(2.6) # a false detection
+    assert tracker.push(3.4)
+    assert tracker.rr() == pytest.approx(0.8)
+
+
+def test_rr_tracker_estimate_goes_stale():
+    tracker = detectors.RRTracker(min_intervals=3, max_age=60)
+    for beat in range(4):
+        tracker.push(beat * 1.0)
+    assert tracker.ready(3.0 + 60) and not tracker.stale(3.0 + 60)
+    assert tracker.stale(3.0 + 61) and not tracker.ready(3.0 + 61)
+    assert np.isnan(tracker.predict(3.0 + 61))
+    assert tracker.ready() # no time given: age not checked
+    # beats seen one per search keep it stale, a consecutive pair refreshes it
+    tracker.push(70.0)
+    assert tracker.stale(70.0)
+    tracker.push(71.0)
+    assert tracker.ready(71.0) and tracker.age(71.0) == 0
@@ -0,0 +1,72 @@
+""" Display decimation and live buffers (display.py).
+
+Usage:
+    python -m pytest -q test_display.py
+"""
+
+import numpy as np
+import pytest
+
+import display
+
+
+def test_minmax_keeps_the_envelope():
+    rng = np.random.default_rng(6)
+    y = rng.normal(size=15007)
+    y[[100, 9000]] = [8.0, -7.0] # spikes narrower than a pixel column
+    idx, yd = display.minmax(y, 300)
+    assert len(idx) == 2 * 300 + 1 and idx[-1] == len(y) - 1
+    assert np.all(np.diff(idx) > 0) # chronological order
+    np.testing.assert_array_equal(yd, y[idx])
+    size = len(y) // 300
+    cols = y[:300 * size].reshape(300, size)
+    np.testing.assert_array_equal(np.sort(yd[:-1].reshape(300, 2), axis=1), np.column_stack((cols.min(1), cols.max(1))))
+    assert yd.max() == 8.0 and yd.min() == -7.0
+
+
+def test_minmax_short_signal_is_not_decimated():
+    y = np.arange(10.0)
+    idx, yd = display.minmax(y, 5)
+    np.testing.assert_array_equal(idx, np.arange(10))
+    np.testing.assert_array_equal(yd, y)
+
+
+@pytest.mark.parametrize("n, n_out", [(15000, 600), (1001, 3), (101, 100)])
+def test_lttb_keeps_the_endpoints(n, n_out):
+    rng = np.random.default_rng(7)
+    y = np.cumsum(rng.normal(size=n))
+    idx, yd = display.lttb(y, n_out)
+    assert len(idx) == n_out
+    assert idx[0] == 0 and idx[-1] == n - 1
+    assert np.all(np.diff(idx) > 0)
+    np.testing.assert_array_equal(yd, y[idx])
+
+
+def test_lttb_keeps_a_spike():
+    y = np.zeros(1000)
+    y[537] = 5.0
+    idx, yd = display.lttb(y, 50)
+    assert 537 in idx and yd.max() == 5.0
+
+
+def test_live_buffer_wraps_around():
+    buffer = display.LiveBuffer(fs=10, seconds=1)
+    y, count = buffer.snapshot()
+    assert len(y) == 0 and count == 0
+    buffer.push(np.arange(6))
+    buffer.push(np.arange(6, 13)) # wraps around
+    buffer.push(13)
+    y, count = buffer.snapshot()
+    assert count == 14
+    np.testing.assert_array_equal(y, np.arange(4, 14))
+
+
+def test_live_buffer_push_longer_than_the_buffer():
+    buffer = display.LiveBuffer(fs=10, seconds=1)
+    buffer.push(np.arange(3))
+    buffer.push(np.arange(3, 28))
+    y, count = buffer.snapshot()
+    assert count == 28 # every sample pushed is counted
+    np.testing.assert_array_equal(y, np.arange(18, 28))
+    buffer.push(np.arange(28, 31))
+    np.testing.assert_array_equal(buffer.snapshot()[0], np.arange(21, 31))
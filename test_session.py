@@ -0,0 +1,107 @@
+""" Round trip of the binary session format (session.py).
+
+Usage:
+    python -m pytest -q test_session.py
+"""
+
+import numpy as np
+import pytest
+
+import session
+
+
+def write_session(path, sample_format, close=True):
+    """ Initial ECG monitoring and two measurements (Doppler, breath, ECG). Returns the signals written """
+    rng = np.random.default_rng(0)
+    signals = {(-1, "E") : rng.uniform(-1, 1, 5000)}
+    for index in range(2):
+        signals[(index, "D")] = rng.uniform(-4.9, 4.9, 15000 + index) # odd length: the chunk is padded
+        signals[(index, "R")] = rng.uniform(-1, 1, 250)
+        signals[(index, "E")] = rng.uniform(-1, 1, 480)
+
+    writer = session.SessionWriter(path, {'title' : "test", 'deltax' : 30.0}, sample_format)
+    for (index, code), samples in signals.items():
+        timing = dict(trigger_time=10.0 + index, trigger_start=9.9995 + index, doppler_start=10.0005 + index) if index >= 0 else {}
+        writer.write_signal(index, code, samples, {"D" : 15000.0, "R" : 50.0, "E" : 500.0}[code], {"D" : 2, "R" : 7, "E" : 4}[code],
+                            delay=0.1, latency=0.25 + index, vpwv=1.2, missed=max(index, 0), **timing)
+    writer.flush()
+    if close:
+        writer.close()
+    else:
+        writer.f.close() # stopped without the index footer
+    return signals
+
+
+# int24: half a code of quantisation, plus the float32 rounding of the decoded volts
+@pytest.mark.parametrize("sample_format, atol", [('float32', 0), ('int24', session.SCALE / 2 + np.spacing(np.float32(5)))])
+@pytest.mark.parametrize("close", [True, False])
+def test_round_trip(tmp_path, sample_format, atol, close):
+    path = str(tmp_path / "test.vpwv")
+    signals = write_session(path, sample_format, close)
+
+    reader = session.SessionReader(path)
+    assert reader.version == session.VERSION
+    assert reader.metadata['title'] == "test" and reader.metadata['deltax'] == 30.0
+    np.testing.assert_array_equal(reader.measurements(), [-1, 0, 1])
+    assert len(reader.index) == len(signals)
+
+    for (index, code), samples in signals.items():
+        x = reader.signal(index, code)
+        assert x.dtype == np.float32 and len(x) == len(samples)
+        expected = samples.astype(np.float32) if sample_format == 'float32' else samples
+        np.testing.assert_allclose(x, expected, rtol=0, atol=atol)
+
+    entry = reader.find(1, "D")
+    assert entry['channel'] == 2 and entry['fs'] == 15000.0 and entry['missed'] == 1
+    assert entry['latency'] == 1.25 and entry['delay'] == 0.1 and entry['vpwv'] == 1.2
+    doppler_start, (trigger_start, trigger_time) = reader.timing(1)
+    assert (doppler_start, trigger_start, trigger_time) == (10.0005 + 1, 9.9995 + 1, 11.0)
+    with pytest.raises(KeyError):
+        reader.find(2, "D")
+    reader.close()
+
+
+def test_int24_codes():
+    codes = np.array([-0x800000, -1, 0, 1, 0x7fffff])
+    volts = codes * session.SCALE
+    raw = session.to_int24(volts)
+    assert raw.shape == (5, 3)
+    np.testing.assert_array_equal(np.round(session.from_int24(raw) / session.SCALE), codes)
+    # out of range values are clipped to the 24 bit range
+    np.testing.assert_array_equal(np.round(session.from_int24(session.to_int24([10.0, -10.0])) / session.SCALE), [0x7fffff, -0x800000])
+
+
+def test_version_1_files_are_read(tmp_path):
+    # version 1 chunk headers have no trigger_start/doppler_start: they are read as NaN
+    path = str(tmp_path / "v1.vpwv")
+    meta = b'{"title": "v1"}'
+    meta += b' ' * (-(len(meta) + 16) % 8)
+    samples = np.arange(10, dtype='<f4')
+    header = np.zeros(1, dtype=session.CHUNK_DTYPE_V1)
+    header[0] = (session.CHUNK_MAGIC, 0, b"D", 2, session.FORMATS['float32'], 0, b'', 15000.0, len(samples), 5.0, 0.0, 0.3, 1.0)
+    with open(path, 'wb') as f:
+        f.write(session.MAGIC + np.array([1, len(meta)], dtype='<u4').tobytes() + meta)
+        f.write(header.tobytes() + samples.tobytes())
+
+    reader = session.SessionReader(path)
+    assert reader.version == 1
+    np.testing.assert_array_equal(reader.signal(0, "D"), samples)
+    assert reader.find(0, "D")['trigger_time'] == 5.0 and np.isnan(reader.find(0, "D")['doppler_start'])
+    assert reader.timing(0) is None
+
+
+def test_restarted_initialisations_are_kept(tmp_path):
+    # GUI_Rpi: Stop, then Start Chart in the same session --> a second initial ECG monitoring (-2)
+    path = str(tmp_path / "restart.vpwv")
+    writer = session.SessionWriter(path, {'title' : "restart"})
+    first, second = np.arange(10, dtype=np.float32), np.arange(10, 20, dtype=np.float32)
+    writer.write_signal(-1, "E", first, 500.0, 4)
+    writer.write_signal(0, "D", np.zeros(4), 15000.0, 2)
+    writer.write_signal(-2, "E", second, 500.0, 4)
+    writer.close()
+
+    reader = session.SessionReader(path)
+    np.testing.assert_array_equal(reader.measurements(), [-2, -1, 0])
+    np.testing.assert_array_equal(reader.signal(-1, "E"), first)
+    np.testing.assert_array_equal(reader.signal(-2, "E"), second)
+    reader.close()
@@ -0,0 +1,122 @@
+""" Equivalence of the vectorised signal functions of vWPV.py with the code they replaced (baseline vWPV.py).
+
+Usage:
+    python -m pytest -q test_vWPV.py
+"""
+
+import os
+import time
+
+import numpy as np
+import pytest
+
+# the tests do not need the acquisition hardware
+os.environ.setdefault("VPWV_BACKEND", "sim")
+
+import vWPV
+
+
+def baseline_isoutlier(x, w_size):
+    outlier = []
+
+    for i in range(0, int(len(x)/w_size)+1):
+        window = x[(i*w_size):((i+1)*w_size)]
+        m = np.mean(window)
+        dev = np.std(window)
+
+        for j in window:
+            if j>=m+3*dev or j<=m-3*dev:
+                outlier.append(True)
+            else:
+                outlier.append(False)
+
+    return outlier
+
+
+def baseline_window_rms(a, window_size):
+    a2 = [pow(aa,2) for aa in a]
+    window = np.ones(int(window_size)) / float(window_size)
+    rms = (np.sqrt(np.convolve(a2, window,'same')))
+    return rms
+
+
+def test_window_rms_matches_baseline():
+    rng = np.random.default_rng(0)
+    for n, window_size in [(15000, 150), (15000, 151), (1000, 1), (1000, 2), (100, 100), (50, 99), (3000, 15000/100)]:
+        a = rng.normal(size=n) * rng.uniform(0.01, 5)
+        expected = baseline_window_rms(a, window_size)
+        rms = vWPV.window_rms(a, window_size)
+        assert rms.shape == expected.shape
+        np.testing.assert_allclose(rms, expected, rtol=0, atol=1e-13)
+
+
+@pytest.mark.filterwarnings("ignore::RuntimeWarning") # the baseline takes the mean of an empty last window
+def test_isoutlier_matches_baseline():
+    rng = np.random.default_rng(1)
+    for n, w_size in [(100, 20), (105, 20), (19, 20), (20, 20), (1000, 7), (500, 1)]:
+        x = rng.normal(size=n)
+        x[rng.integers(0, n, size=max(1, n//50))] += 10   # outliers
+        expected = np.array(baseline_isoutlier(x, w_size), dtype=bool)
+        np.testing.assert_array_equal(vWPV.isoutlier(x, w_size), expected)
+
+
+@pytest.mark.parametrize("wall, tolerance", [(0, 3e-3), (0.3, 8e-3)])
+@pytest.mark.parametrize("engine", ["stft", "stft_mean"])
+def test_fd_latency_is_not_biased(engine, wall, tolerance):
+    # mean error against the true footprint of the synthetic traces (the frame envelope is not smoothed before the
+    # interpolation: smoothing it over span*len(x) samples read about 25 ms early)
+    import smoothing_accuracy
+    rng = np.random.default_rng(3)
+    fs = 15000
+    errors = []
+    for trial in range(20):
+        latency = rng.uniform(0.2, 0.6)
+        if wall:
+            x = smoothing_accuracy.wall_motion_doppler(fs, latency, wall=wall, rng=rng)
+        else:
+            x = smoothing_accuracy.synthetic_doppler(fs, latency, rng=rng)
+        errors.append(vWPV.latency_engine(engine)(x, fs, 'lowess')[0] - latency)
+    assert abs(np.mean(errors)) < tolerance
+    assert np.max(np.abs(errors)) < 3 * tolerance
+
+
+def test_trigger_worker_fires_at_the_scheduled_time():
+    worker = vWPV.TriggerWorker(16, inflation=0.01, refractory=0.1)
+    try:
+        assert not worker.busy()
+        for pulse in range(2): # the same process serves every pulse
+            at = time.monotonic() + 0.05
+            worker.fire(at)
+            t0, t1 = worker.wait_fired()
+            assert at <= t0 <= t1 < at + 0.02
+            assert worker.busy() # inflation + deflation
+            with pytest.raises(RuntimeError):
+                worker.fire()
+            worker.wait_ready()
+            assert time.monotonic() >= t1 + 0.11
+            assert not worker.busy()
+    finally:
+        worker.close()
+    assert not worker.process.is_alive()
+
+
+def test_trigger_worker_ended_by_sigterm():
+    worker = vWPV.TriggerWorker(16, inflation=0.01, refractory=0.1)
+    worker.process.terminate() # SIGTERM: the valve is closed and the process ends
+    worker.process.join(5)
+    worker.receive(1)
+    assert worker.closed and not worker.busy()
+    with pytest.raises(RuntimeError):
+        worker.fire()
+    worker.close()
+
+
+def test_align_latency_refers_to_the_trigger_edge():
+    # valve pin driven HIGH between t0 = 100.000 and t1 = 100.002 s, first Doppler sample at 99.98 s (DOPPLER_LEAD)
+    latency, uncertainty = vWPV.align_latency(0.3, 99.98, (100.0, 100.002), 15000)
+    assert latency == pytest.approx(0.3 - 0.021)
+    assert uncertainty == pytest.approx(0.001 + 1 / 15000)
+    # a Doppler acquisition started after the edge adds to the latency; the window width only changes the uncertainty
+    latency, uncertainty = vWPV.align_latency(0.3, 100.01, (100.0, 100.0), 500)
+    assert latency == pytest.approx(0.31)
+    assert uncertainty == pytest.approx(1 / 500)
@@ -24,22 +24,22 @@
 
 """
 
-from turtle import delay
+# Only NumPy and the hardware backend are loaded with the acquisition core:
+# scipy (find_peaks) and the smoothing engines (scipy, statsmodels) are imported the first time they are used
 import numpy as np
-import matplotlib.pyplot as plt
+import functools
 import time
 import os
+import signal
 
-from numpy.core.function_base import linspace
 import ADS1256new
-import RPi.GPIO as GPIO
 import config
-from multiprocessing import Process
+import detectors
+import smoothing
+from config import GPIO
+import multiprocessing as mp
 
 import math 
-import statsmodels.api as sm 
-from scipy.signal import find_peaks 
-from scipy import convolve 
 
 
 def ADC_reading():
@@ -58,52 +58,356 @@ def ADC_reading():
 
     return (read * 5.0 / 0x7fffff)
 
-def ADC_configuration(codice_segnale):
+# ADC settings of each signal: gain, data rate, input channel
+ADC_SETTINGS = {"R" : ('ADS1256_GAIN_1', 'ADS1256_50SPS', 7),     #RESPIRATORY SIGNAL
+                "E" : ('ADS1256_GAIN_1', 'ADS1256_500SPS', 4),    #ECG 
+                "D" : ('ADS1256_GAIN_1', 'ADS1256_15000SPS', 2),  #DOPPLER
+               }
+
+# Scan mode (ADS1256new.ScanMode = 1): breath and ECG are acquired together, one conversion at a time.
+# Data rate of the conversions (each one takes about 0.7 ms with the settling after the channel switch) 
+# and signals scanned: ECG at every 1/fs_e slot, breath every fs_e/fs_r slots
+SCAN_SETTINGS = ('ADS1256_GAIN_1', 'ADS1256_2000SPS', ("E", "R"))
+
+# Streaming R-wave detector (detectors.RWaveDetector), trained on the ECG monitoring by initialization.
+# None --> R wave when ECG >= ecg_threshold
+r_wave = None
+# Running estimate of the RR interval (detectors.RRTracker) fed by the R-wave detections, for the predictive trigger
+rr_tracker = None
+
+# Predictive trigger (see measure_loop, phase): the main process wakes up DOPPLER_LEAD s before the scheduled pulse
+# to start the Doppler acquisition; sleep_until busy-waits the last FIRE_SPIN s
+DOPPLER_LEAD = 0.02
+FIRE_SPIN = 0.002
+
+# Function returning True to interrupt the measurement in progress as soon as possible (None --> never).
+# The acquisition loops then raise MeasurementInterrupted (see check_interrupt and controller.py)
+interrupt = None
+
+# Function receiving the acquired samples for the live display: monitor(signal_code, samples), 
+# signal_code "R", "E" or "D", samples one value or an array (None --> no live display, see display.py and GUI_Rpi)
+monitor = None
+
+# Doppler samples lost during the acquisition (see check_block) are replaced by linear interpolation.
+# False --> the latency is computed with the effective sampling frequency instead
+RESAMPLE_GAPS = True
+
+# Switch between signals writing only the changed registers (see ADC_configuration).
+# The chip is reset and fully initialised only the first time
+FAST_SWITCH = True
+
+# Long acquisitions (the 10 s ECG monitoring) are read in chunks of READ_CHUNK s, checking interrupt() between them
+READ_CHUNK = 0.2
+
+# Trigger process (TriggerWorker), see start_workers
+trigger_worker = None
+
+# Acquisition process (acquisition.AcquisitionEngine) owning the SPI bus, started by start_workers if ACQUISITION_PROCESS:
+# breath, ECG and Doppler are then read from its shared-memory ring buffer (see open_signal), so that the processing
+# in this process cannot delay or drop samples. Scan mode (ADS1256new.ScanMode = 1) drives the ADC from this process.
+ACQUISITION_PROCESS = True
+acquisition_engine = None
+
+# Latency engine used by measure_loop (see LATENCY_ENGINES): 'td' = time-domain envelope (vPWV_TD_percentage),
+# 'stft' / 'stft_mean' = maximum / mean Doppler frequency envelope (vPWV_FD_percentage)
+LATENCY_ENGINE = 'td'
+
+# vPWV_FD_percentage: STFT frame length and step [samples] (17 ms frames every 4.3 ms at 15 kSPS),
+# wall filter cut-off [Hz], noise floor subtracted (times the mean baseline spectrum), minimum power of a frame with flow (times the noise power),
+# fraction of the frame power below the maximum frequency
+STFT_NFFT = 256
+STFT_HOP = 64
+STFT_WALL_HZ = 100
+STFT_NOISE_FACTOR = 3
+STFT_FLOW_SNR = 1
+STFT_MAX_PERCENTILE = 0.9
+# vPWV_FD_percentage: smoothing window of the frequency envelope [frames], 0 = not smoothed (the frames already average
+# nfft samples). The envelope rises in steps at the frame rate: a window of span*len(x) samples (100 ms with the 
+# vPWV_TD_percentage span) moves its 5% crossing about 25 ms before the true footprint (see smoothing_accuracy.py --wall)
+STFT_SPAN_FRAMES = 0
+STFT_WINDOWS = dict()   # Hann windows by frame length, see stft_window
+
+def ADC_reset(gain, drate, channel):
+    """ It resets and fully initialises ADS1256 (ADS1256_init) and restarts the conversions.
+    Raises RuntimeError if the initialisation fails (chip ID or register readback) """
+    ADC.ADS1256_reset()
+    if ADC.ADS1256_init(gain,drate,channel) != 0:
+        raise RuntimeError("ADS1256 initialisation failed (chip ID or register readback)")
+    ADC.ADS1256_WriteCmd(ADS1256new.CMD['CMD_SYNC']) 
+    ADC.ADS1256_WriteCmd(ADS1256new.CMD['CMD_WAKEUP'])
+
+def ADC_switch(gain, drate, channel, fast):
+    """ It switches ADS1256 to the given gain, data rate and channel: with ADS1256_SwitchChannel if fast, 
+    falling back to reset and full initialisation (ADC_reset) if it fails """
+    if fast:
+        if ADC.ADS1256_SwitchChannel(gain, drate, channel) == 0:
+            return
+        print("WARNING: fast ADC reconfiguration failed (register readback), resetting the ADC")
+    ADC_reset(gain, drate, channel)
+
+def ADC_configuration(codice_segnale, fast=None):
     """ This function configures and initialises ADS1256 for acquisition of desired signal (breath, ecg, doppler)
     
     INPUT: 
-    - signal_code: "R" = Respiratory Signal, "E" = ECG, "D" = Doppler"""
-    ADC.ADS1256_reset()
+    - signal_code: "R" = Respiratory Signal, "E" = ECG, "D" = Doppler
+    - fast: True --> only the changed registers are written (ADS1256_SwitchChannel), False --> reset and full initialisation.
+            Default: FAST_SWITCH. If the fast switch fails the ADC is reset and fully initialised;
+            RuntimeError is raised if that fails too"""
+    if fast is None:
+        fast = FAST_SWITCH
 
-    if codice_segnale=="R": #RESPIRATORY SIGNAL
-        gain = ADS1256new.ADS1256_GAIN_E['ADS1256_GAIN_1']
-        drate = ADS1256new.ADS1256_DRATE_E['ADS1256_50SPS']
-        channel = 7
-    elif codice_segnale=="E": #ECG 
-        gain = ADS1256new.ADS1256_GAIN_E['ADS1256_GAIN_1']
-        drate = ADS1256new.ADS1256_DRATE_E['ADS1256_500SPS']
-        channel = 4
-    elif codice_segnale=="D": #DOPPLER
-        gain = ADS1256new.ADS1256_GAIN_E['ADS1256_GAIN_1']
-        drate = ADS1256new.ADS1256_DRATE_E['ADS1256_15000SPS']
-        channel = 2
-
-    ADC.ADS1256_init(gain,drate,channel) 
-    ADC.ADS1256_WriteCmd(ADS1256new.CMD['CMD_SYNC']) 
-    ADC.ADS1256_WriteCmd(ADS1256new.CMD['CMD_WAKEUP'])
+    gain, drate, channel = ADC_SETTINGS[codice_segnale]
+    gain = ADS1256new.ADS1256_GAIN_E[gain]
+    drate = ADS1256new.ADS1256_DRATE_E[drate]
+
+    ADC_switch(gain, drate, channel, fast)
     ADC.ADS1256_WaitDRDY()
     
     config.digital_write(config.CS_PIN, GPIO.LOW) 
     config.spi_writebyte([ADS1256new.CMD['CMD_RDATAC']]) 
     return 0
 
-def trigger():
-    """Function that triggers the cuff inflation process.
+def ADC_scan_configuration():
+    """ This function configures ADS1256 for the scan mode (see SCAN_SETTINGS and ADS1256.ADS1256_ScanRead): 
+    gain and data rate are set, the ADC is left in SDATAC mode. As ADC_configuration, RuntimeError is raised if the ADC
+    cannot be configured """
+    gain, drate, signals = SCAN_SETTINGS
+    gain = ADS1256new.ADS1256_GAIN_E[gain]
+    drate = ADS1256new.ADS1256_DRATE_E[drate]
+    ADC_switch(gain, drate, ADC_SETTINGS[signals[0]][2], True)
+    return 0
+
+class MeasurementInterrupted(Exception):
+    """ Raised by the acquisition loops when interrupt() returns True """
+
+def show(codice_segnale, samples):
+    """ It passes the acquired samples to the live display, if any (see monitor) """
+    if monitor is not None:
+        monitor(codice_segnale, samples)
+
+def stop_continuous_read():
+    """ It stops the continuous read (RDATAC) of the ADC: SDATAC is sent when DRDY is LOW, 
+    with its own CS-low transaction (the chip ignores commands sent with CS HIGH) """
+    ADC.ADS1256_WaitDRDY()
+    ADC.ADS1256_WriteCmd(ADS1256new.CMD['CMD_SDATAC'])
+
+def check_interrupt():
+    """ It raises MeasurementInterrupted if interrupt() returns True. The continuous read of the ADC 
+    (or the streaming of the acquisition process) is stopped first """
+    if interrupt is not None and interrupt():
+        if acquisition_engine is None:
+            stop_continuous_read()
+        else:
+            acquisition_engine.stop()
+        raise MeasurementInterrupted()
+
+def open_signal(codice_segnale):
+    """ It starts the acquisition of a signal: the acquisition process streams it into the ring buffer or,
+    without acquisition process, the ADC is configured (ADC_configuration) and read by this process.
+
+    INPUT:
+    - signal_code: "R", "E" or "D"
+
+    OUTPUT:
+    - reader: acquisition.SignalReader following the signal, None without acquisition process
+      (see samples, read_signal and close_signal)
+    """
+    if acquisition_engine is None:
+        ADC_configuration(codice_segnale)
+        return None
+    return acquisition_engine.open(codice_segnale)
+
+def close_signal(reader):
+    """ It stops the acquisition started by open_signal """
+    if reader is None:
+        stop_continuous_read()
+    else:
+        acquisition_engine.stop()
+
+def samples(reader):
+    """ Generator of the samples of the signal opened with open_signal: (value [V], time.monotonic() [s] of acquisition) """
+    if reader is None:
+        while True:
+            yield ADC_reading(), time.monotonic()
+    while True:
+        blocks = reader.wait(0.1)
+        if not blocks: # no samples (e.g. the acquisition process has ended): cancel() still stops the search
+            check_interrupt()
+        for block in blocks:
+            yield from zip(block['value'].tolist(), block['t'].tolist())
+
+def read_signal(reader, n, fs, name, resample=True, interruptible=True):
+    """ It reads n samples of the signal opened with open_signal (read_block, or SignalReader.read) and checks them
+    (check_block, or check_sequence).
+
+    INPUT:
+    - reader: see open_signal
+    - n = number of samples
+    - fs = sampling frequency [Hz]
+    - name, resample = see check_block
+    - interruptible = check interrupt() during the acquisition
+
+    OUTPUT:
+    - x, quality = see check_block
+    - t0 = time.monotonic() of the first sample [s]
+    """
+    if reader is None:
+        x = read_block(n, fs) if interruptible else ADC.ADS1256_ReadBlock(n)
+        t0 = ADC.ADS1256_SampleTimes(0)[1]
+        x, quality = check_block(x, name, resample)
+        return x, quality, t0
+    seq, t, x = reader.read(n, check_interrupt if interruptible else None)
+    x, quality = check_sequence(x, seq, reader.fs, name, resample)
+    return x, quality, t[0]
+
+def read_block(n, fs):
+    """ It reads n samples with ADS1256_ReadBlock in chunks of READ_CHUNK s, checking interrupt() between them.
+    The timestamps of the chunks are merged, so that ADS1256_BlockQuality, ADS1256_SampleTimes and check_block 
+    refer to the whole block.
+
+    INPUT:
+    - n = number of samples
+    - fs = sampling frequency [Hz]
+
+    OUTPUT:
+    - x = samples [V]
+    """
+    chunk = max(1, int(READ_CHUNK * fs))
+    x = np.empty(n, dtype=np.float32)
+    stamps = []
+    timeouts = 0
+    for start in range(0, n, chunk):
+        check_interrupt()
+        ADC.ADS1256_ReadBlock(min(chunk, n - start), out=x[start:])
+        stamps.append(ADC.timestamps + [start, 0])
+        timeouts += ADC.block_timeouts
+    ADC.timestamps = np.concatenate(stamps)
+    ADC.block_timeouts = timeouts
+    return x
+
+def sleep_until(t, spin=FIRE_SPIN):
+    """ It waits until time.monotonic() = t [s]: sleep, then busy wait for the last "spin" seconds (high resolution) """
+    wait = t - spin - time.monotonic()
+    if wait > 0:
+        time.sleep(wait)
+    while time.monotonic() < t:
+        pass
+
+def trigger(conn, pin=16, inflation=0.2, refractory=5):
+    """Function that triggers the cuff inflation process, run by TriggerWorker in its own process.
     The output pin on Raspberry Pi drives a relay which powers the valve.
-    The energized valve opens the compressor-cuff way, this allows inflation."""
-    
-    print('trigger')
-    #inflation
-    GPIO.output(16,True) 
-    time.sleep(0.2)
-    #deflation
-    GPIO.output(16, False) 
+    The energized valve opens the compressor-cuff way, this allows inflation.
+
+    For each ("fire", at) command received from conn (at = monotonic time [s] of the pulse, None = at once) it sends back:
+    - ("fired", t0, t1): monotonic time before and after the pin was driven HIGH
+    - ("ready", t): monotonic time at the end of inflation + deflation (a new pulse can be delivered)
+    The command ("close",) ends the process."""
 
-    time.sleep(5) 
+    # Ctrl-C reaches the whole process group: the parent stops the process with ("close",), after the deflation.
+    # SIGTERM (e.g. sent to the process group by systemd): the valve is closed and the process ends
+    def terminate(signum, frame):
+        GPIO.output(pin, False)
+        os._exit(0)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, terminate)
+
+    try: # real-time priority, if allowed, to reduce the trigger jitter
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(50))
+    except (AttributeError, OSError):
+        pass
+
+    conn.send(("ready", time.monotonic()))
+    msg = conn.recv()
+    while msg[0] == "fire":
+        if len(msg) > 1 and msg[1] is not None:
+            sleep_until(msg[1])
+        #inflation
+        t0 = time.monotonic()
+        GPIO.output(pin,True) 
+        t1 = time.monotonic()
+        conn.send(("fired", t0, t1))
+        print('trigger')
+        time.sleep(inflation)
+        #deflation
+        GPIO.output(pin, False) 
+
+        time.sleep(refractory) 
+        conn.send(("ready", time.monotonic()))
+        msg = conn.recv()
+    conn.close()
+
+class TriggerWorker:
+    def __init__(self, pin=16, inflation=0.2, refractory=5):
+        """ Long-lived trigger process, started once (see initialization()), so that no process is created for each pulse.
+        Fire commands are sent through a pipe and the time the valve pin was driven HIGH is sent back.
+
+        INPUT:
+        - pin: output pin driving the valve relay
+        - inflation: valve opening time [s]
+        - refractory: time for the cuff deflation, after closing the valve [s]
+        """
+        ctx = mp.get_context("fork") # the process inherits the GPIO configuration
+        self.conn, child = ctx.Pipe()
+        self.process = ctx.Process(target=trigger, args=(child, pin, inflation, refractory), daemon=True)
+        self.process.start()
+        child.close()
+        self.fired = None    # (t0, t1) of the last pulse
+        self.closed = False  # True if the process has ended
+        self.is_ready = self.conn.recv()[0] == "ready" # waits for the process to be running
+
+    def receive(self, timeout=0):
+        """ Reads the messages of the trigger process, waiting up to timeout [s] (None = forever) for the first one """
+        while self.conn.poll(timeout):
+            try:
+                msg = self.conn.recv()
+            except EOFError: # the process has ended (SIGTERM): the valve is closed
+                self.closed = True
+                self.is_ready = True
+                return
+            if msg[0] == "fired":
+                self.fired = msg[1:]
+            elif msg[0] == "ready":
+                self.is_ready = True
+            timeout = 0
+
+    def busy(self):
+        """ True from the pulse delivery to the end of the cuff deflation """
+        self.receive()
+        return not self.is_ready
+
+    def fire(self, at=None):
+        """ Sends the inflation trigger. It does not wait for the pin to be driven.
+        at: monotonic time [s] at which the pin is driven HIGH (None = at once) """
+        if self.busy():
+            raise RuntimeError("Trigger fired during cuff deflation")
+        if self.closed:
+            raise RuntimeError("Trigger process ended")
+        self.is_ready = False
+        self.fired = None
+        self.conn.send(("fire", at))
+
+    def wait_fired(self):
+        """ Returns (t0, t1): monotonic time [s] before and after the valve pin of the last pulse was driven HIGH """
+        while self.fired is None:
+            if self.closed:
+                raise RuntimeError("Trigger process ended before the pulse")
+            self.receive(None)
+        return self.fired
+
+    def wait_ready(self):
+        """ Waits for the end of the cuff deflation """
+        while not self.is_ready:
+            self.receive(None)
+
+    def close(self):
+        if self.process.is_alive():
+            self.wait_ready()
+            self.conn.send(("close",))
+        self.process.join()
 
 def isoutlier(x,w_size):
     """It identifies as outliers values that differ by more than 3*standard dev from the mean.
-    Mean and standard dev are calculated locally on a moving window of size w_size
+    Mean and standard dev are calculated locally on consecutive windows of size w_size
     
     INPUT: 
         - x: Signal in which outliers are to be identified
@@ -113,18 +417,23 @@ def isoutlier(x,w_size):
         - outlier: Boolean vector of the same size as x. Where 1 = outlier
     """
 
-    outlier = []
-    
-    for i in range(0, int(len(x)/w_size)+1):
-        window = x[(i*w_size):((i+1)*w_size)]
-        m = np.mean(window)
-        dev = np.std(window)
-
-        for j in window:
-            if j>=m+3*dev or j<=m-3*dev:
-                outlier.append(True)
-            else: 
-                outlier.append(False)
+    x = np.asarray(x, dtype=float)
+    outlier = np.zeros(len(x), dtype=bool)
+    full = (len(x) // w_size) * w_size
+
+    # complete windows: one row each
+    if full:
+        windows = x[:full].reshape(-1, w_size)
+        m = windows.mean(axis=1, keepdims=True)
+        dev = windows.std(axis=1, keepdims=True)
+        outlier[:full] = ((windows >= m+3*dev) | (windows <= m-3*dev)).ravel()
+
+    # last, shorter window
+    if full < len(x):
+        window = x[full:]
+        m = window.mean()
+        dev = window.std()
+        outlier[full:] = (window >= m+3*dev) | (window <= m-3*dev)
     
     return outlier
 
@@ -140,30 +449,31 @@ def window_rms(a, window_size):
     - rms: vector of the same size as a, where each element is calculated as the rms value of the windowed signal, with window centred on the sample of interest
     """
     
-    a2 = [pow(aa,2) for aa in a]
-    window = np.ones(int(window_size)) / float(window_size)  # creo array di lunghezza pari
-    rms = (np.sqrt(np.convolve(a2, window,'same')))
+    # the squares are computed with NumPy instead of a list; the moving mean is a direct convolution, which keeps the
+    # relative precision of small values (a cumulative sum loses it where the signal is small compared to the rest of it)
+    a = np.asarray(a, dtype=float)
+    window = np.ones(int(window_size)) / float(window_size)
+    rms = np.sqrt(np.convolve(a*a, window, 'same'))
     return rms 
 
 
-def vPWV_TD_percentage( x, fs ):
+def vPWV_TD_percentage( x, fs, smoothing_method='lowess', span=0.1, th=5, bs=0.1, mpw=0.1 ):
     """This function computes the time-domain envelope of the Doppler-shift signal and it identifies the footprint of the profile as the 5% of the peak amplitude.
     
     INPUT: 
     - x = vector of length 1 sec
     - fs = sampling frequency [Hz]
+    - smoothing_method = envelope smoothing engine, see smoothing.SMOOTHERS ('lowess' = reference, slowest)
+    - span = length of window for signal smoothing, fraction of the signal. As this value increases, the smoothing increases.
+    - th = footprint level, percentage of peak amplitude
+    - bs = initial time when no spike should appear [s]
+    - mpw = min peak width [s]
 
     OUTPUT:
     - latency = scalar [sec]
     - v = velocitogram profile [normalized units]
     """
 
-    #PARAMETRI 
-    span = 0.1 #Length of window for signal smoothing. As this value increases, the smoothing increases.
-    bs = 0.1 * fs;  # initial time when no spike should appear (100 ms)
-    MPW = 0.1 * fs; # min peak witdh 
-    th = 5; # percentage of peak amplitude
-
     #ESTRAZIONE DELL'INVILUPPO 
     dx = np.diff(x)
     v = window_rms( dx, fs/100); 
@@ -174,13 +484,35 @@ def vPWV_TD_percentage( x, fs ):
     v = v1
 
     #SMOOTHING AND NORMALIZATION
-    points = np.arange(0, len(v), 1)
-    smooth = sm.nonparametric.lowess(v, points, frac=span, it=0, is_sorted=True)
-    v = smooth[:, 1]
+    v = smoothing.smooth(v, span, smoothing_method)
     v = v - np.amin(v)
     v = v / np.amax(v)
 
+    latency = footprint_percentage(v, fs, th, bs, mpw)
+
+    return latency,v
+
+def footprint_percentage(v, fs, th=5, bs=0.1, mpw=0.1):
+    """ Footprint of a normalized envelope: the first peak after bs, the valley before it and the sample where the
+    envelope crosses th % of the valley-to-peak amplitude (shared by the latency engines, see LATENCY_ENGINES).
+
+    INPUT:
+    - v = envelope [normalized units], one value per Doppler sample
+    - fs = sampling frequency [Hz]
+    - th = footprint level, percentage of peak amplitude
+    - bs = initial time when no spike should appear [s]
+    - mpw = min peak width [s]
+
+    OUTPUT:
+    - latency = scalar [sec]
+    """
+
+    #PARAMETRI 
+    bs = bs * fs;  # initial time when no spike should appear [samples]
+    MPW = mpw * fs; # min peak witdh [samples]
+
     # PEAK FINDING 
+    from scipy.signal import find_peaks
     [peaks, property] = find_peaks(v[int(bs):], width=math.floor(MPW))
 
     if peaks.size == 0:
@@ -202,153 +534,591 @@ def vPWV_TD_percentage( x, fs ):
     # transform in seconds
     latency = percentage / fs
 
+    return latency
+
+def stft_window(nfft):
+    """ Hann window of nfft samples, computed once for each frame length """
+    if nfft not in STFT_WINDOWS:
+        STFT_WINDOWS[nfft] = np.hanning(nfft)
+    return STFT_WINDOWS[nfft]
+
+def vPWV_FD_percentage( x, fs, smoothing_method='lowess', span=0.1, th=5, bs=0.1, mpw=0.1, envelope='max', nfft=None, hop=None, span_frames=None ):
+    """Frequency-domain alternative to vPWV_TD_percentage: the envelope is the maximum (or mean) Doppler frequency
+    computed from the short-time Fourier transform of the signal. The footprint is found with the same 5% rule.
+
+    - STFT: Hann frames of nfft samples every hop samples, real FFT of all the frames at once;
+      the components below STFT_WALL_HZ (wall motion) are discarded
+    - noise floor: STFT_NOISE_FACTOR times the mean spectrum of the frames in the first bs s is subtracted;
+      frames whose remaining power is below STFT_FLOW_SNR times the noise power have no flow (frequency 0)
+    - max frequency: frequency below which STFT_MAX_PERCENTILE of the frame power lies;
+      mean frequency: power weighted mean frequency
+    - the envelope (one value per frame) is smoothed over span_frames frames, interpolated at the Doppler samples and normalized
+
+    INPUT: 
+    - x = vector of length 1 sec
+    - fs = sampling frequency [Hz]
+    - smoothing_method, th, bs, mpw = as in vPWV_TD_percentage
+    - span = not used: accepted for the common interface of LATENCY_ENGINES (see span_frames)
+    - envelope = 'max' or 'mean' frequency
+    - nfft = frame length [samples] (default STFT_NFFT)
+    - hop = frame step [samples] (default STFT_HOP)
+    - span_frames = smoothing window of the envelope [frames] (default STFT_SPAN_FRAMES, 0 = not smoothed)
+
+    OUTPUT:
+    - latency = scalar [sec]
+    - v = frequency envelope [normalized units], one value per sample of x
+    """
+    nfft = STFT_NFFT if nfft is None else int(nfft)
+    hop = STFT_HOP if hop is None else int(hop)
+    span_frames = STFT_SPAN_FRAMES if span_frames is None else span_frames
+    x = np.asarray(x, dtype=float)
+    x = x - np.mean(x)
+
+    #STFT
+    frames = np.lib.stride_tricks.sliding_window_view(x, nfft)[::hop] * stft_window(nfft)
+    P = np.abs(np.fft.rfft(frames, axis=1))**2
+    f = np.fft.rfftfreq(nfft, 1/fs)
+    P[:, f < STFT_WALL_HZ] = 0    # wall filter
+    centres = np.arange(len(P)) * hop + nfft / 2  # [samples]
+
+    #NOISE FLOOR (baseline frames, before bs)
+    baseline = centres + nfft / 2 <= bs * fs
+    noise = P[baseline].mean(axis=0) if baseline.any() else np.zeros(P.shape[1])
+    P = np.clip(P - STFT_NOISE_FACTOR * noise, 0, None)
+    power = P.sum(axis=1)
+    flow = power > STFT_FLOW_SNR * noise.sum()
+
+    #FREQUENCY ENVELOPE
+    v = np.zeros(len(P))
+    if envelope == 'max':
+        cumulative = np.cumsum(P, axis=1)
+        v[flow] = f[np.argmax(cumulative[flow] >= STFT_MAX_PERCENTILE * power[flow, None], axis=1)]
+    elif envelope == 'mean':
+        v[flow] = P[flow] @ f / power[flow]
+    else:
+        raise ValueError("Unknown frequency envelope: " + str(envelope))
+
+    #SMOOTHING (at the frame rate), INTERPOLATION AND NORMALIZATION
+    if span_frames > 0:
+        v = smoothing.smooth(v, span_frames / len(v), smoothing_method)
+    v = np.interp(np.arange(len(x)), centres, v)
+    v = v - np.amin(v)
+    v = v / max(np.amax(v), np.finfo(float).tiny)
+
+    latency = footprint_percentage(v, fs, th, bs, mpw)
+
     return latency,v
 
+# Latency engines: name --> function(x, fs, smoothing_method, span=, th=, bs=, mpw=) returning (latency, envelope)
+LATENCY_ENGINES = {'td' : vPWV_TD_percentage,
+                   'stft' : vPWV_FD_percentage,
+                   'stft_mean' : functools.partial(vPWV_FD_percentage, envelope='mean'),
+                  }
+
+def latency_engine(name=None):
+    """ Latency function of the engine name (see LATENCY_ENGINES, None = LATENCY_ENGINE) """
+    name = LATENCY_ENGINE if name is None else name
+    if name not in LATENCY_ENGINES:
+        raise ValueError("Unknown latency engine: " + str(name) + " (available: " + ", ".join(LATENCY_ENGINES) + ")")
+    return LATENCY_ENGINES[name]
+
+def align_latency(latency, doppler_start, trigger_time, fs):
+    """ It refers the latency to the valve trigger edge instead of the first Doppler sample.
+
+    INPUT:
+    - latency = latency from the first Doppler sample [s] (see vPWV_TD_percentage)
+    - doppler_start = time.monotonic() of the first Doppler sample [s] (see ADS1256.ADS1256_SampleTimes)
+    - trigger_time = (t0, t1) time.monotonic() before and after the valve pin was driven HIGH [s] (see TriggerWorker)
+    - fs = sampling frequency [Hz]
+
+    OUTPUT:
+    - latency = latency from the trigger edge [s]
+    - uncertainty = residual alignment uncertainty [s]: half of the trigger time window plus one sampling period
+                    (the time at which DRDY went LOW is known only to within one sample)
+    """
+    t0, t1 = trigger_time
+    edge = (t0 + t1) / 2
+    return latency + (doppler_start - edge), (t1 - t0) / 2 + 1 / fs
+
+def check_block(x, name, resample=True):
+    """ It checks the timing of the last ADS1256_ReadBlock (achieved sample rate, lost samples, DRDY timeouts, see
+    ADS1256.ADS1256_BlockQuality) and prints a warning if the acquisition did not keep up with the ADC.
+
+    INPUT:
+    - x = samples returned by ADS1256_ReadBlock
+    - name = signal name, for the warning
+    - resample = if samples were lost, x is linearly interpolated onto the uniform grid of the nominal sampling frequency
+
+    OUTPUT:
+    - x = samples (resampled if needed)
+    - quality = dict of ADS1256_BlockQuality plus
+        - fs : sampling frequency of the returned samples [Hz] (the effective one, len(x)/duration, if not resampled)
+        - resampled : True if x was resampled
+    """
+    quality = ADC.ADS1256_BlockQuality()
+    fs = quality['fs_nominal']
+    quality['fs'] = fs
+    quality['resampled'] = False
+    if quality['missed'] or quality['timeouts']:
+        print("WARNING: %s acquisition fell behind the ADC: %d samples lost in %d gaps, %d DRDY timeouts, %.1f SPS achieved"
+              % (name, quality['missed'], len(quality['gaps']), quality['timeouts'], quality['fs_measured']))
+    if quality['missed']:
+        if resample:
+            times, t0 = ADC.ADS1256_SampleTimes(len(x))
+            grid = t0 + np.arange(len(x) + quality['missed']) / fs
+            x = np.interp(grid, times, x).astype(x.dtype)
+            quality['resampled'] = True
+        else:
+            quality['fs'] = fs * len(x) / (len(x) + quality['missed'])
+    return x, quality
+
+def check_sequence(x, seq, fs, name, resample=True):
+    """ check_block for the samples read from the ring buffer of the acquisition process: the samples lost are
+    the jumps of the conversion numbers seq (see acquisition.SequenceClock).
+
+    INPUT:
+    - x = samples
+    - seq = conversion number of each sample
+    - fs = nominal sampling frequency [Hz]
+    - name, resample = see check_block
+
+    OUTPUT:
+    - x, quality = see check_block. DRDY timeouts are not reported by the acquisition process (timeouts = 0);
+      fs_measured is the rate of the samples acquired, len(x) / duration
+    """
+    steps = np.diff(seq) - 1
+    missed = int(np.sum(steps))
+    quality = {'fs_nominal' : fs, 'fs_measured' : fs * len(x) / max(len(x) + missed, 1), 'missed' : missed,
+               'gaps' : [(int(j) + 1, int(steps[j])) for j in np.nonzero(steps > 0)[0]], 'timeouts' : 0,
+               'fs' : fs, 'resampled' : False}
+    if missed:
+        print("WARNING: %s acquisition fell behind the ADC: %d samples lost in %d gaps, %.1f SPS achieved"
+              % (name, missed, len(quality['gaps']), quality['fs_measured']))
+        if resample:
+            x = np.interp(np.arange(seq[0], seq[-1] + 1), seq, x).astype(x.dtype)
+            quality['resampled'] = True
+        else:
+            quality['fs'] = quality['fs_measured']
+    return x, quality
+
+def ecg_threshold_calibration(ECG, fs, max_beats=15, start=0.15, step=0.02):
+    """ It sets the threshold for the R-wave detection on the ECG monitoring, in a single pass.
+    The threshold starts at mean + start*(max - min) and it is raised by step*(max - min) until no more than max_beats peaks 
+    are above it (more than 15 peaks in 10 s on a relaxed patient --> the threshold is also intercepting T-waves).
+    The peaks (local maxima at least 200 ms apart) are found once and sorted by height: the threshold is raised directly
+    above the height of the (max_beats+1)-th highest peak.
+
+    INPUT:
+    - ECG = ECG monitoring
+    - fs = sampling frequency [Hz]
+
+    OUTPUT:
+    - ecg_threshold: If ECG >= ecg_threshold --> R-wave
+    """
+    ECG = np.asarray(ECG, dtype=float)
+    span = np.amax(ECG) - np.amin(ECG)
+    ecg_threshold = np.mean(ECG) + start*span
+
+    from scipy.signal import find_peaks
+    peaks, properties = find_peaks(ECG, distance=max(1, int(0.2*fs)))
+    heights = np.sort(ECG[peaks])[::-1]
+    if span > 0 and len(heights) > max_beats and heights[max_beats] >= ecg_threshold:
+        ecg_threshold += (np.floor((heights[max_beats] - ecg_threshold) / (step*span)) + 1) * step*span
+    return ecg_threshold
+
+def r_wave_detected(sample, ecg_threshold, t=None):
+    """ R-wave detection on one ECG sample, with r_wave if initialised, otherwise with the fixed threshold.
+    The time of each R wave (t = acquisition time of the sample, default now) is passed to rr_tracker """
+    if r_wave is None:
+        detected = sample >= ecg_threshold
+    else:
+        detected = r_wave.push(sample)
+    if detected and rr_tracker is not None:
+        rr_tracker.push(time.monotonic() if t is None else t)
+    return detected
+
+def pulse_timing(phase):
+    """ Predictive trigger: the pulse is scheduled at the given phase of the cardiac cycle following the last R wave,
+    predicted from the RR interval estimate (rr_tracker).
+
+    INPUT:
+    - phase = fraction of the RR interval after the predicted R wave (None --> no prediction)
+
+    OUTPUT:
+    - fire_at = monotonic time [s] of the pulse (None if phase is None or the RR interval is not known yet or stale:
+      the pulse is then delivered "delay" s after the R wave, see deliver_pulse)
+    - timing = dict with
+        - r_wave_time : time of the R wave detected by the trigger search [s]
+        - r_wave_predicted : time at which that R wave had been predicted from the previous ones [s]
+        - rr, rr_std : RR interval estimate and its standard deviation [s]
+        - rr_age : time since the last consecutive-beat interval of the estimate [s]
+        - rr_stale : True if the estimate was too old to schedule the pulse (see detectors.RRTracker, max_age)
+        - predicted_r_wave : predicted time of the next R wave, the one the pulse is scheduled on [s]
+        - fire_target : fire_at (nan if not scheduled)
+    """
+    timing = {'r_wave_time' : np.nan, 'r_wave_predicted' : np.nan, 'rr' : np.nan, 'rr_std' : np.nan,
+              'rr_age' : np.nan, 'rr_stale' : False, 'predicted_r_wave' : np.nan, 'fire_target' : np.nan}
+    if rr_tracker is None or rr_tracker.last_beat is None:
+        return None, timing
+    timing['r_wave_time'] = rr_tracker.last_beat
+    timing['r_wave_predicted'] = rr_tracker.last_predicted
+    timing['rr'] = rr_tracker.rr()
+    timing['rr_std'] = rr_tracker.rr_std()
+    timing['rr_age'] = rr_tracker.age(rr_tracker.last_beat)
+    timing['rr_stale'] = rr_tracker.stale(rr_tracker.last_beat)
+    timing['predicted_r_wave'] = rr_tracker.last_beat + timing['rr']
+    if phase is None or not rr_tracker.ready(rr_tracker.last_beat):
+        if phase is not None:
+            print("WARNING: RR interval estimate not available or stale (%.0f s old): pulse delivered after the R wave, not at phase %.2f"
+                  % (timing['rr_age'], phase))
+        return None, timing
+    fire_at = timing['predicted_r_wave'] + phase * timing['rr']
+    timing['fire_target'] = fire_at
+    return fire_at, timing
+
 # ------------------------------------ MAIN -----------------------------------------
 
+def start_workers():
+    """ It sets the input and output pins and starts the acquisition process (if ACQUISITION_PROCESS, see acquisition_engine)
+    and the trigger process (TriggerWorker).
+    The processes are forked: call it from the main thread before any other thread is started 
+    (see controller.MeasurementController.start). A process forked while another thread holds a lock 
+    (e.g. the one of sys.stdout, used by print) inherits the lock held and can deadlock on it.
+    initialization() calls it if the processes are not running. """
+    global trigger_worker, acquisition_engine
+
+    GPIO.setmode(GPIO.BCM)
+    GPIO.setwarnings(False)
+    GPIO.setup(16, GPIO.OUT) 
+    GPIO.setup(18, GPIO.OUT) 
+
+    stop_workers()
+    if ACQUISITION_PROCESS and ADS1256new.ScanMode == 0:
+        import acquisition
+        acquisition_engine = acquisition.AcquisitionEngine()
+        acquisition_engine.start()
+    trigger_worker = TriggerWorker(16)
+
+def set_scan_mode(mode):
+    """ It selects the scan mode (ADS1256new.ScanMode: 0 = sequential, 1 = scan, see search_trigger_point).
+    The acquisition process only runs in sequential mode: if the processes are running they are stopped and started
+    again (start_workers), so call it from the main thread with no measurement in progress.
+    The ADC of this process is replaced, as its shadow registers are stale after the acquisition process wrote the chip """
+    global ADC
+    if mode not in (0, 1):
+        raise ValueError("Scan mode must be 0 (sequential) or 1 (scan)")
+    if mode == ADS1256new.ScanMode:
+        return
+    running = trigger_worker is not None
+    stop_workers()
+    ADS1256new.ScanMode = mode
+    if 'ADC' in globals():
+        ADC = ADS1256new.ADS1256()
+    if running:
+        start_workers()
+
+def stop_workers():
+    """ It stops the trigger process, after the deflation of the last pulse, and the acquisition process """
+    global trigger_worker, acquisition_engine
+    if trigger_worker is not None:
+        trigger_worker.close()
+        trigger_worker = None
+    if acquisition_engine is not None:
+        acquisition_engine.close()
+        acquisition_engine = None
+
 def initialization():
     """ Initialisation function to be called only once at the start of the measurement process 
-    - Sets the input and output pins
+    - Starts the trigger and acquisition processes, if start_workers() has not been called
     - Sets the global variables useful for the measurement
-    - Monitors 10 s of ECG and sets the threshold to find the R wave
+    - Monitors 10 s of ECG, sets the threshold to find the R wave and trains the R-wave detector (r_wave)
     
     OUTPUT: 
         - ecg_threshold: Threshold to be imposed on the ECG signal. 
                          If ECG > ecg_threshold --> R-wave
     """
-    
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-    GPIO.setup(16, GPIO.OUT) 
-    GPIO.setup(18, GPIO.OUT) 
- 
+
     #PARAMETERS
-    global fs_r, fs_e, fs_d, ecg_threshold
+    global fs_r, fs_e, fs_d, ecg_threshold, r_wave, rr_tracker
     fs_r = 50 #frequenza di campionamento per il respiro
     fs_e = 500 #frequenza di campionamento per l'ecg
     fs_d = 15000 #frequenza di campionamento per il doppler
     
-    ECG_monitoring = [None]*10*fs_e
-    
 
     global ADC
     ADC = ADS1256new.ADS1256()
 
+    #TRIGGER AND ACQUISITION PROCESSES (started once, see start_workers)
+    if trigger_worker is None or not trigger_worker.process.is_alive():
+        start_workers()
+
     #ECG MONITORING
     print("10 s ECG monitoring")
-    ADC_configuration("E")
+    reader = open_signal("E")
 
-    for i in range(0,len(ECG_monitoring)):
-        ECG_monitoring[i]=ADC_reading()
+    ECG_monitoring, quality, t0 = read_signal(reader, 10*fs_e, fs_e, "ECG")
+    show("E", ECG_monitoring)
  
-    config.digital_write(config.CS_PIN, GPIO.HIGH)  
-    config.spi_writebyte([ADS1256new.CMD['CMD_SDATAC']]) 
+    close_signal(reader)
 
-    ecg_threshold = np.mean(ECG_monitoring)+0.15*(np.amax(ECG_monitoring) - np.amin(ECG_monitoring))
+    ecg_threshold = ecg_threshold_calibration(ECG_monitoring, fs_e)
 
-    peaks = find_peaks(ECG_monitoring, threshold=ecg_threshold)
-
-    # If the threshold detects more than 15 peaks in 10 seconds on a relaxed patient, it is probably also intercepting T-waves. Threshold too low. 
-    while len(peaks)>15: 
-        ecg_threshold = ecg_threshold + 0.02*(np.amax(ECG_monitoring) - np.amin(ECG_monitoring))
-        peaks = find_peaks(ECG_monitoring, threshold=ecg_threshold)
+    r_wave = detectors.RWaveDetector(fs_e)
+    rr_tracker = detectors.RRTracker()
+    for i, sample in enumerate(ECG_monitoring):
+        if r_wave.push(sample):
+            rr_tracker.push(t0 + i / quality['fs'])
 
     return ecg_threshold , ECG_monitoring
 
-def measure_loop(delay, ecg_threshold):
-    """Function to be called in a cycle for repeated measurements after the initialisation phase. 
-    - It acquires the respiratory signal and detects the expiration phase 
-    - It acquires the ecg and detects the R wave
-    - It sends the pressure pulse
-    - It acquires the Doppler signal 
-    - It processes the Doppler signal 
+def search_trigger_point(ecg_threshold, ready=None, refresh_rr=False):
+    """ It waits for the trigger point: R wave within 1 s from the expiratory phase. 
+    See search_trigger_point_sequential (ADS1256new.ScanMode = 0) and search_trigger_point_scan (ADS1256new.ScanMode = 1, 
+    the scan sees every beat: refresh_rr is not needed) """
+    if ADS1256new.ScanMode == 1:
+        return search_trigger_point_scan(ecg_threshold, ready)
+    return search_trigger_point_sequential(ecg_threshold, ready, refresh_rr)
 
-    Input: 
-    - Delay : Optional delay between R-wave detection and pressure pulse delivery 
-    - ecg_threshold : Threshold for R-wave detection, calculated above
- 
-    Output: 
-    - Latency : Latency between pressure pulse and footprint 
-    - ECG : Acquired ECG singal 
-    - Breath : Acquired respiratory singal 
-    - Doppler : Acquired Echo-doppler signal
+def search_trigger_point_sequential(ecg_threshold, ready=None, refresh_rr=False):
+    """ It acquires the respiratory signal and detects the expiration phase, then it acquires the ecg and detects the R wave.
+    The search is repeated until an R wave is found within 1 s from the expiration phase.
+
+    Input:
+    - ecg_threshold : Threshold for R-wave detection (used only if the R-wave detector r_wave is not initialised)
+    - ready : Optional function returning True when the pressure pulse can be delivered (e.g. the cuff of the previous pulse is deflated).
+              An R wave detected while ready() is False is discarded and the search starts again.
+    - refresh_rr : if the RR interval estimate (rr_tracker) is not ready or stale at the R wave, the ECG is acquired
+                   up to the next R wave (at most rr_tracker.max_rr s), which becomes the trigger point: the interval
+                   between the two consecutive beats updates the estimate (predictive trigger, see pulse_timing)
+
+    Output:
+    - Breath : Acquired respiratory singal (last 5 s before the expiratory phase)
+    - ECG : Acquired ECG singal (from the expiratory phase to the R wave)
     """
     #Parametes: 
-    breath=[]
-    ECG=[]
-    refresh_time = 1 * fs_r 
-    doppler_samples=fs_d*1 #1 s
-    doppler=[None]*doppler_samples
+    expiration = detectors.ExpirationDetector(fs_r, window=5, refresh=1, num_samples=5)
     go_trigger=0
     
     while go_trigger==0:
 
         #EXPIRATORY PHASE DETECTION
         flag_exp=0 
-        ADC_configuration("R")
-        num_samples = 5
+        reader = open_signal("R")
          
         print("Searching for expiratory phase")
         
-        for i in range(0,fs_r*5): #5s 
-            breath.append(ADC_reading())
-
-        breath_threshold=np.mean(breath)
-
-        while flag_exp == 0: 
-            breath.append(ADC_reading()) 
-
-            if (len(breath) % refresh_time == 0): #threshold update
-                breath5s = breath[-5*fs_r:] #consider the last 5 seconds 
-                breath_threshold=np.mean(breath5s)
-            
-            pre = breath[len(breath)-num_samples*2:len(breath)-num_samples]
-            post = breath[len(breath)-num_samples:len(breath)]            
-
-            if np.amin(pre)>=breath_threshold and np.amax(post)<=breath_threshold:
-                flag_exp = 1
+        # 5 s of signal for the threshold, then the threshold (mean of the last 5 s) is updated every second
+        expiration.reset()
+        for sample, t in samples(reader): 
+            check_interrupt()
+            show("R", sample)
+            flag_exp = expiration.push(sample)
+            if flag_exp:
+                break
                     
-        config.digital_write(config.CS_PIN, GPIO.HIGH)
-        config.spi_writebyte([ADS1256new.CMD['CMD_SDATAC']])  
+        # the continuous read is stopped by the next open_signal (no extra DRDY wait before the R-wave search)
+        breath = expiration.window()
 
         #R-WAVE DETECTION
         print("Searching for R-wave")
         flag_ondaR = 0 
-        ADC_configuration("E")
+        ECG=[]
+        max_samples = 1*fs_e
+        refreshing = False
+        reader = open_signal("E")
+        if r_wave is not None:
+            r_wave.restart()
         
-        while flag_ondaR == 0 and len(ECG)<=1*fs_e:
-            ECG.append(ADC_reading())
+        for sample, t in samples(reader):
+            check_interrupt()
+            ECG.append(sample)
+            show("E", sample)
             
-            if ECG[-1] >= ecg_threshold:
-                flag_ondaR = 1
-                go_trigger=1 
-                print("R-wave detected")
+            if r_wave_detected(sample, ecg_threshold, t):
+                if refresh_rr and not refreshing and rr_tracker is not None and not rr_tracker.ready(t):
+                    print("R-wave detected, RR interval estimate stale: waiting for the next R wave")
+                    refreshing = True
+                    max_samples = len(ECG) + int(rr_tracker.max_rr * fs_e)
+                else:
+                    flag_ondaR = 1
+                    go_trigger=1 
+                    print("R-wave detected")
+            if flag_ondaR == 1 or len(ECG) > max_samples:
+                break
         
         if go_trigger==0:
             print("R-wave detection Failed")
+        elif ready is not None and not ready():
+            go_trigger=0
+            print("Cuff not deflated yet, R-wave discarded")
         
-        config.digital_write(config.CS_PIN, GPIO.HIGH) 
-        config.spi_writebyte([ADS1256new.CMD['CMD_SDATAC']])  
+        # the ADC is left in RDATAC mode: the next open_signal stops it (no extra DRDY wait before the pulse)
+
+    return breath, ECG
+
+def search_trigger_point_scan(ecg_threshold, ready=None):
+    """ Scan mode version of search_trigger_point: breath and ECG are acquired together (round-robin scan of the two channels),
+    so the expiratory phase is monitored also while the R wave is searched. 
+    If the R wave is not found within 1 s, the search goes on with the next expiratory phase, without acquiring 5 s of breath again.
+
+    Input, Output: see search_trigger_point_sequential
+    """
+    expiration = detectors.ExpirationDetector(fs_r, window=5, refresh=1, num_samples=5)
+    ch_e = ADC_SETTINGS["E"][2]
+    ch_r = ADC_SETTINGS["R"][2]
+    breath_every = int(round(fs_e / fs_r))
+
+    ADC_scan_configuration()
+    if r_wave is not None:
+        r_wave.restart()
+    print("Searching for expiratory phase (scan mode)")
 
-    time.sleep(delay) #optional delay
+    start = time.monotonic()
+    k = 0               # slot number: one ECG sample per slot
+    expiration_at = None  # slot of the last expiratory phase, None --> no R wave search in progress
+    while True:
+        check_interrupt()
+        wait = start + k / fs_e - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
 
-    ADC_configuration("D")
+        ecg = ADC.ADS1256_ScanRead(ch_e)
+        show("E", ecg)
+        r_detected = r_wave_detected(ecg, ecg_threshold) # the detector sees the whole ECG stream
+        if k % breath_every == 0:
+            sample = ADC.ADS1256_ScanRead(ch_r)
+            show("R", sample)
+            expired = expiration.push(sample)
+        else:
+            expired = False
+        if expired:
+            print("Searching for R-wave")
+            breath = expiration.window()
+            ECG = []
+            expiration_at = k
+
+        if expiration_at is not None:
+            ECG.append(ecg)
+            if r_detected:
+                if ready is None or ready():
+                    print("R-wave detected")
+                    return breath, ECG
+                print("Cuff not deflated yet, R-wave discarded")
+                expiration_at = None
+            elif k - expiration_at >= 1*fs_e:
+                print("R-wave detection Failed")
+                expiration_at = None
+        k += 1
+
+def deliver_pulse(delay, fire_at=None):
+    """ It sends the pressure pulse and acquires 1 s of Doppler signal.
+
+    Input:
+    - Delay : Optional delay between R-wave detection and pressure pulse delivery
+    - fire_at : monotonic time [s] of the pulse (predictive trigger, see pulse_timing). If given, delay is not used:
+                the Doppler acquisition starts DOPPLER_LEAD s before the pulse, which is timed by the trigger process
+
+    Output:
+    - Doppler : Acquired Echo-doppler signal
+    - trigger_time : (t0, t1) monotonic time [s] before and after the valve pin was driven HIGH (see TriggerWorker)
+    - doppler_start : monotonic time [s] of the first Doppler sample
+    - quality : timing of the acquisition, see check_block (quality['fs'] is the sampling frequency of Doppler)
+    """
+    doppler_samples=fs_d*1 #1 s
+
+    if fire_at is None:
+        time.sleep(delay) #optional delay
+    else:
+        sleep_until(fire_at - DOPPLER_LEAD, 0)
+
+    reader = open_signal("D")
 
     #INFLATION TRIGGER
-    process1 = Process(target = trigger)  
-    process1.start()
+    trigger_worker.fire(fire_at)
 
-    #DOPPLER SIGNAL ACQUISTION
-    for i in range(0,len(doppler)):
-        doppler[i]=ADC_reading()
+    #DOPPLER SIGNAL ACQUISTION (not interrupted: the pulse has been delivered)
+    doppler, quality, doppler_start = read_signal(reader, doppler_samples, fs_d, "Doppler", RESAMPLE_GAPS, interruptible=False)
+    if reader is not None:
+        close_signal(reader)
    
     print("Doppler signal has been acquired")       
+    show("D", doppler)
+
+    return doppler, trigger_worker.wait_fired(), doppler_start, quality
+
+def measure_loop(delay, ecg_threshold, phase=None, engine=None):
+    """Function to be called in a cycle for repeated measurements after the initialisation phase. 
+    - It acquires the respiratory signal and detects the expiration phase 
+    - It acquires the ecg and detects the R wave
+    - It sends the pressure pulse
+    - It acquires the Doppler signal 
+    - It processes the Doppler signal 
+
+    See pipeline.MeasurementPipeline to process the Doppler signal while the next pulse is being searched.
+
+    Input: 
+    - Delay : Optional delay between R-wave detection and pressure pulse delivery 
+    - ecg_threshold : Threshold for R-wave detection, calculated above
+    - phase : None --> the pulse is delivered "delay" s after the R-wave detection.
+              Otherwise predictive trigger: the pulse is scheduled at this fraction of the RR interval after the next
+              R wave, predicted from the running RR interval estimate (see pulse_timing); delay is not used
+    - engine : latency engine for this measurement (see LATENCY_ENGINES), None --> LATENCY_ENGINE
+ 
+    Output: 
+    - Latency : Latency between pressure pulse (valve trigger edge) and footprint 
+    - Breath : Acquired respiratory singal (last 5 s before the expiratory phase)
+    - ECG : Acquired ECG singal 
+    - Doppler : Acquired Echo-doppler signal
+    - Info : dict with
+        - trigger_time : (t0, t1) monotonic time [s] before and after the valve pin was driven HIGH
+        - doppler_start : monotonic time [s] of the first Doppler sample
+        - latency_from_start : latency from the first Doppler sample [s]
+        - latency_uncertainty : residual alignment uncertainty [s] (see align_latency)
+        - fs : sampling frequency of Doppler [Hz] used for the latency
+        - fs_measured : achieved Doppler sample rate [Hz]
+        - missed : Doppler samples lost (Doppler is resampled if RESAMPLE_GAPS)
+        - drdy_timeouts : DRDY timeouts during the Doppler acquisition
+        - R-wave timing: r_wave_time, r_wave_predicted, rr, rr_std, rr_age, rr_stale, predicted_r_wave, fire_target (see pulse_timing).
+          In sequential mode the search sees one beat per pulse: with a phase, the search waits for a second R wave
+          whenever the RR estimate is stale (see search_trigger_point_sequential, refresh_rr); scan mode keeps it updated.
+          rr_stale: the pulse fell back to "delay" after the R wave
+        - engine : latency engine used
+    """
+    engine = LATENCY_ENGINE if engine is None else engine
+    latency_function = latency_engine(engine)   # unknown engines fail before the pulse is delivered
+    breath, ECG = search_trigger_point(ecg_threshold, refresh_rr=phase is not None)
+
+    fire_at, timing = pulse_timing(phase)
+    doppler, trigger_time, doppler_start, quality = deliver_pulse(delay, fire_at)
     
-    #Calculation of latency between start of acquisition and peak footprint
-    latency, envelope = vPWV_TD_percentage(doppler, fs_d)
-    print("Computed latency: ", latency, "\n\n\n") 
+    #Calculation of latency between start of acquisition and peak footprint, then from the trigger edge
+    latency_from_start, envelope = latency_function(doppler, quality['fs'])
+    latency, uncertainty = align_latency(latency_from_start, doppler_start, trigger_time, quality['fs'])
+    print("Computed latency: ", latency, "+/-", uncertainty, "\n\n\n") 
     
-    process1.join() #waits for the process to be completed before going on
+    #waits for the cuff deflation before going on (interrupt() only skips the wait: the result is returned)
+    while trigger_worker.busy() and not (interrupt is not None and interrupt()):
+        trigger_worker.receive(0.05)
+
+    info = measurement_info(trigger_time, doppler_start, latency_from_start, uncertainty, quality, timing, engine)
+    return latency, breath, ECG, doppler, info
+
+def measurement_info(trigger_time, doppler_start, latency_from_start, uncertainty, quality, timing, engine):
+    """ Info output of measure_loop (also used by pipeline.MeasurementPipeline for its results).
 
-    return latency, breath, ECG, doppler
+    INPUT:
+    - trigger_time, doppler_start : see deliver_pulse
+    - latency_from_start, uncertainty : latency from the first Doppler sample and alignment uncertainty (see align_latency)
+    - quality : see check_block
+    - timing : see pulse_timing
+    - engine : latency engine used
 
+    OUTPUT:
+    - info : see measure_loop
+    """
+    info = {'trigger_time' : trigger_time, 'doppler_start' : doppler_start,
+            'latency_from_start' : latency_from_start, 'latency_uncertainty' : uncertainty,
+            'fs' : quality['fs'], 'fs_measured' : quality['fs_measured'], 'missed' : quality['missed'],
+            'drdy_timeouts' : quality['timeouts'], 'engine' : engine}
+    info.update(timing)
+    return info